@@ -0,0 +1,211 @@
+# Захват пакетов через AF_PACKET с кольцевым буфером TPACKET_V3 (только Linux)
+
+import ctypes
+import mmap
+import select
+import socket
+import struct
+import time
+from logger_config import service_logger
+from packet_processor import PORT_PROTOS
+import metrics
+
+SOL_PACKET = 263
+PACKET_RX_RING = 5
+PACKET_STATISTICS = 6
+PACKET_VERSION = 10
+TPACKET_V3 = 2
+ETH_P_ALL = 0x0003
+SO_ATTACH_FILTER = 26
+
+TP_STATUS_KERNEL = 0
+TP_STATUS_USER = 1
+
+BPF_RET_K = 0x06
+
+DEFAULT_BLOCK_SIZE = 1 << 20     # Размер блока кольца, кратен размеру страницы
+DEFAULT_BLOCK_COUNT = 64
+DEFAULT_FRAME_SIZE = 2048
+DEFAULT_SNAPLEN = 128            # Для признаков достаточно заголовков
+DEFAULT_RETIRE_TIMEOUT_MS = 100  # Через сколько ядро отдаёт неполный блок
+STATS_LOG_INTERVAL = 60
+
+# struct tpacket_req3
+_REQ3 = struct.Struct('=7I')
+# struct tpacket_block_desc: num_pkts и offset_to_first_pkt из tpacket_hdr_v1
+_BLOCK_STATUS_OFFSET = 8
+_BLOCK_HDR = struct.Struct('=II')
+_BLOCK_HDR_OFFSET = 12
+# struct tpacket3_hdr: tp_next_offset, tp_sec, tp_nsec, tp_snaplen, tp_len, tp_status, tp_mac, tp_net
+_PKT_HDR = struct.Struct('=6I2H')
+_STATUS = struct.Struct('=I')
+# struct tpacket_stats_v3: tp_packets, tp_drops, tp_freeze_q_cnt
+_STATS_V3 = struct.Struct('=3I')
+_PORTS = struct.Struct('!HH')
+
+
+class _SockFilter(ctypes.Structure):
+    _fields_ = [('code', ctypes.c_uint16), ('jt', ctypes.c_uint8),
+                ('jf', ctypes.c_uint8), ('k', ctypes.c_uint32)]
+
+
+class _SockFprog(ctypes.Structure):
+    _fields_ = [('len', ctypes.c_uint16), ('filter', ctypes.POINTER(_SockFilter))]
+
+
+def attach_bpf(sock, instructions):
+    """Подключение классической BPF-программы [(code, jt, jf, k), ...] к сокету"""
+    filters = (_SockFilter * len(instructions))(*instructions)
+    prog = _SockFprog(len(instructions), filters)
+    sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, bytes(prog))
+
+
+class AFPacketCapture:
+    """Сокет AF_PACKET с отображённым в память кольцом TPACKET_V3."""
+
+    def __init__(self, iface, block_size=DEFAULT_BLOCK_SIZE, block_count=DEFAULT_BLOCK_COUNT,
+                 snaplen=DEFAULT_SNAPLEN, frame_size=DEFAULT_FRAME_SIZE,
+                 retire_timeout_ms=DEFAULT_RETIRE_TIMEOUT_MS, capture_filter=None):
+        if block_size % mmap.PAGESIZE or block_size % frame_size:
+            raise ValueError("block_size должен быть кратен размеру страницы и frame_size")
+        self.iface = iface
+        self.block_size = block_size
+        self.block_count = block_count
+        self.snaplen = snaplen
+        self.frame_size = frame_size
+        self.retire_timeout_ms = retire_timeout_ms
+        self.capture_filter = capture_filter
+        self.sock = None
+        self.ring = None
+        self.poller = None
+        self.current_block = 0
+        self.total_packets = 0
+        self.total_drops = 0
+        self.total_freezes = 0
+
+    def open(self):
+        sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.htons(ETH_P_ALL))
+        try:
+            sock.setsockopt(SOL_PACKET, PACKET_VERSION, TPACKET_V3)
+            # Ядро обрезает кадры до snaplen ещё до копирования в кольцо; фильтр захвата
+            # к тому же отбрасывает не-IPv4 и скрытые хосты, и они не доходят до Python
+            if self.capture_filter is not None:
+                self.capture_filter.attach(sock, self.snaplen)
+            else:
+                attach_bpf(sock, [(BPF_RET_K, 0, 0, self.snaplen)])
+            frame_count = self.block_size // self.frame_size * self.block_count
+            sock.setsockopt(SOL_PACKET, PACKET_RX_RING, _REQ3.pack(
+                self.block_size, self.block_count, self.frame_size, frame_count,
+                self.retire_timeout_ms, 0, 0))
+            self.ring = mmap.mmap(sock.fileno(), self.block_size * self.block_count,
+                                  mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+            if self.iface:
+                sock.bind((self.iface, ETH_P_ALL))
+        except Exception:
+            sock.close()
+            raise
+        self.sock = sock
+        self.poller = select.poll()
+        self.poller.register(sock.fileno(), select.POLLIN | select.POLLERR)
+        self.current_block = 0
+        service_logger.info(f"AF_PACKET захват открыт: {self.iface or 'все интерфейсы'}, "
+                            f"блоки {self.block_count}x{self.block_size}, snaplen {self.snaplen}")
+        return self
+
+    def close(self):
+        if self.sock is not None and self.capture_filter is not None:
+            self.capture_filter.detach(self.sock)
+        if self.ring is not None:
+            self.ring.close()
+            self.ring = None
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def read_stats(self):
+        """Счётчики ядра PACKET_STATISTICS (сбрасываются при каждом чтении) с накоплением итогов"""
+        packets, drops, freezes = _STATS_V3.unpack(
+            self.sock.getsockopt(SOL_PACKET, PACKET_STATISTICS, _STATS_V3.size))
+        self.total_packets += packets
+        self.total_drops += drops
+        metrics.CAPTURE_KERNEL_PACKETS.labels(self.iface or 'all').inc(packets)
+        metrics.CAPTURE_DROPS.labels(self.iface or 'all').inc(drops)
+        self.total_freezes += freezes
+        return packets, drops, freezes
+
+    def _parse_block(self, offset):
+        """Разбор IPv4-кадров блока в записи (timestamp, src_ip, dst_ip, proto, length, sport, dport)"""
+        ring = self.ring
+        num_pkts, pos = _BLOCK_HDR.unpack_from(ring, offset + _BLOCK_HDR_OFFSET)
+        pos += offset
+        unpack_hdr = _PKT_HDR.unpack_from
+        unpack_ports = _PORTS.unpack_from
+        inet_ntoa = socket.inet_ntoa
+        batch = []
+        for _ in range(num_pkts):
+            next_offset, sec, nsec, snaplen, length, _status, mac, net = unpack_hdr(ring, pos)
+            ip_pos = pos + net
+            captured = snaplen - (net - mac)
+            if captured >= 20 and ring[ip_pos] >> 4 == 4:
+                proto = ring[ip_pos + 9]
+                l4_pos = ip_pos + (ring[ip_pos] & 0x0F) * 4
+                # Порты есть только в первом фрагменте и только если заголовок L4 попал в snaplen
+                if (proto in PORT_PROTOS and l4_pos + 4 <= ip_pos + captured
+                        and not (ring[ip_pos + 6] & 0x1F or ring[ip_pos + 7])):
+                    sport, dport = unpack_ports(ring, l4_pos)
+                else:
+                    sport = dport = 0
+                batch.append((
+                    sec + nsec * 1e-9,
+                    inet_ntoa(ring[ip_pos + 12:ip_pos + 16]),
+                    inet_ntoa(ring[ip_pos + 16:ip_pos + 20]),
+                    proto,
+                    length,
+                    sport,
+                    dport,
+                ))
+            pos += next_offset
+        return batch
+
+    def next_batch(self, timeout_ms=1000):
+        """Пачка пакетов из очередного заполненного блока; None, если блоков нет за timeout_ms"""
+        offset = self.current_block * self.block_size
+        status_offset = offset + _BLOCK_STATUS_OFFSET
+        if not _STATUS.unpack_from(self.ring, status_offset)[0] & TP_STATUS_USER:
+            self.poller.poll(timeout_ms)
+            if not _STATUS.unpack_from(self.ring, status_offset)[0] & TP_STATUS_USER:
+                return None
+        try:
+            return self._parse_block(offset)
+        finally:
+            # Возвращаем блок ядру
+            _STATUS.pack_into(self.ring, status_offset, TP_STATUS_KERNEL)
+            self.current_block = (self.current_block + 1) % self.block_count
+
+
+def afpacket_sniff(iface, batch_handler, stop_event, block_size=DEFAULT_BLOCK_SIZE,
+                   block_count=DEFAULT_BLOCK_COUNT, snaplen=DEFAULT_SNAPLEN, capture_filter=None):
+    """Захват до установки stop_event с передачей пакетов в batch_handler блоками"""
+    with AFPacketCapture(iface, block_size, block_count, snaplen, capture_filter=capture_filter) as capture:
+        next_stats = time.monotonic() + STATS_LOG_INTERVAL
+        while not stop_event.is_set():
+            batch = capture.next_batch()
+            if batch:
+                batch_handler(batch)
+            if time.monotonic() >= next_stats:
+                packets, drops, freezes = capture.read_stats()
+                level = service_logger.warning if drops else service_logger.info
+                level(f"AF_PACKET {iface}: получено {packets}, потеряно ядром {drops}, "
+                      f"заморозок очереди {freezes} (всего потерь {capture.total_drops})")
+                next_stats += STATS_LOG_INTERVAL
+        capture.read_stats()
+        service_logger.info(f"AF_PACKET {iface}: захват остановлен, всего получено {capture.total_packets}, "
+                            f"потеряно {capture.total_drops}")
+
+__all__ = ['AFPacketCapture', 'afpacket_sniff', 'attach_bpf']
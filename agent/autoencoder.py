@@ -1,12 +1,7 @@
 import numpy as np
 import os
-from tensorflow.keras.models import Model
-from tensorflow.keras.layers import Input, Dense
-from tensorflow.keras.callbacks import EarlyStopping
-from sklearn.preprocessing import RobustScaler, MinMaxScaler
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
+from diagnostics import diagnostics, pyplot
+import quantile_sketch
 
 class AutoEncoder:
     def __init__(self, input_dim, encoding_dim=4, hidden_layers=[32, 16, 8], activation='relu', optimizer='adam', loss='mae'):
@@ -19,30 +14,69 @@ class AutoEncoder:
         self.autoencoder = None
         self.encoder = None
         self.history = None
+        from sklearn.preprocessing import RobustScaler, MinMaxScaler
         self.robust_scaler = RobustScaler()
         self.minmax_scaler = MinMaxScaler()
+        # Замороженные параметры scaler-ов для инференса (см. freeze_scalers)
+        self.frozen = False
+        self.feature_scale = None
+        self.feature_offset = None
+        self.impute_medians = None
+        # Распределение ошибок восстановления на обучающей выборке - задаёт порог, при работе не меняется
+        self.error_sketch = quantile_sketch.TDigest()
+        # Ошибки при работе (выше порога - обрезанные до него), сохраняются рядом с версией
+        self.live_sketch = quantile_sketch.TDigest()
 
     def preprocess_data(self, X):
         """Предобработка данных с RobustScaler и MinMaxScaler."""
         # Замена бесконечных значений и NaN
         X = np.where(np.isinf(X), np.nan, X)
         col_medians = np.nanmedian(X, axis=0)
-        for i in range(X.shape[1]):
-            X[:, i] = np.where(np.isnan(X[:, i]), col_medians[i], X[:, i])
+        X = np.where(np.isnan(X), col_medians, X)
         # Ограничение выбросов
         X = np.clip(X, -1e6, 1e6)
         X_robust = self.robust_scaler.fit_transform(X)
         X_scaled = self.minmax_scaler.fit_transform(X_robust)
         return X_scaled
 
+    def freeze_scalers(self):
+        """Сведение обученных RobustScaler и MinMaxScaler в одно преобразование X * scale + offset.
+
+        Медианы для заполнения пропусков берутся из RobustScaler.center_ - это медианы обучающей выборки.
+        Вызывать после обучения или загрузки scaler-ов.
+        """
+        rb, mm = self.robust_scaler, self.minmax_scaler
+        center = rb.center_ if rb.with_centering else np.zeros_like(mm.scale_)
+        robust_scale = rb.scale_ if rb.with_scaling else np.ones_like(mm.scale_)
+        self.feature_scale = mm.scale_ / robust_scale
+        self.feature_offset = mm.min_ - center * self.feature_scale
+        self.impute_medians = np.asarray(center, dtype=np.float64)
+        self.frozen = True
+
+    def transform_frozen(self, X):
+        """Инференсная предобработка: только преобразование с параметрами обучения, без fit."""
+        X = np.array(X, dtype=np.float64)
+        missing = ~np.isfinite(X)
+        if missing.any():
+            X[missing] = np.broadcast_to(self.impute_medians, X.shape)[missing]
+        np.clip(X, -1e6, 1e6, out=X)
+        X *= self.feature_scale
+        X += self.feature_offset
+        return X
+
     def inverse_preprocess(self, X_scaled):
         """Обратное преобразование данных."""
+        if self.frozen:
+            return (X_scaled - self.feature_offset) / self.feature_scale
         X_robust = self.minmax_scaler.inverse_transform(X_scaled)
         X_original = self.robust_scaler.inverse_transform(X_robust)
         return X_original
 
     def build_model(self, input_dim=None):
         """Построение архитектуры автоэнкодера."""
+        # TensorFlow нужен только для построения и обучения; инференс может идти через numpy_inference
+        from tensorflow.keras.models import Model
+        from tensorflow.keras.layers import Input, Dense
         if input_dim is None:
             input_dim = self.input_dim
         
@@ -64,6 +98,7 @@ class AutoEncoder:
 
     def train(self, X_train, epochs=100, batch_size=64, validation_split=0.2, verbose=1, threshold_percentile=98):
         """Обучение автоэнкодера."""
+        from tensorflow.keras.callbacks import EarlyStopping
         self.X_transformed = self.preprocess_data(X_train)
         self.input_dim = X_train.shape[1]
         
@@ -80,6 +115,8 @@ class AutoEncoder:
             callbacks=[early_stopping],
             verbose=verbose
         )
+        self.freeze_scalers()
+        self.error_sketch = quantile_sketch.TDigest().update(self.reconstruction_errors(X_train))
         self.plot_training_history()
         return self.history
 
@@ -88,23 +125,31 @@ class AutoEncoder:
         if self.autoencoder is None:
             raise ValueError("Модель не построена. Сначала вызовите train().")
         
-        X_processed = self.preprocess_data(X)
+        # В режиме инференса scaler-ы не переобучаются на каждой пачке
+        X_processed = self.transform_frozen(X) if self.frozen else self.preprocess_data(X)
         X_reconstructed = self.autoencoder.predict(X_processed, verbose=0)
         X_reconstructed = self.inverse_preprocess(X_reconstructed)
         return X_reconstructed
 
+    def reconstruction_errors(self, X):
+        """MSE восстановления каждой строки в исходных единицах."""
+        return np.mean(np.square(X - self.predict(X)), axis=1)
+
     def detect_anomalies(self, X, threshold_percentile=90):
         """Обнаружение аномалий на основе ошибки восстановления."""
-        X_reconstructed = self.predict(X)
-        mse = np.mean(np.square(X - X_reconstructed), axis=1)
-        threshold = np.percentile(mse, threshold_percentile)
+        mse = self.reconstruction_errors(X)
+        # Порог - квантиль распределения ошибок обучающей выборки, а не перцентиль текущей пачки
+        threshold = quantile_sketch.threshold(self.error_sketch, self.live_sketch, mse, threshold_percentile)
         anomalies = (mse > threshold).astype(int)
         
-        self.plot_anomalies(X, anomalies, mse, threshold)
+        # Графики строятся подсистемой диагностики по её режиму, а не на каждой пачке
+        diagnostics.record('ae', mse, threshold, X=X, anomalies=anomalies)
         return anomalies, mse, threshold
 
-    def plot_anomalies(self, X, anomalies, mse, threshold, prefix='ae'):
+    @staticmethod
+    def plot_anomalies(X, anomalies, mse, threshold, prefix='ae'):
         """Визуализация аномалий."""
+        plt = pyplot()
         os.makedirs('autoencoder_png', exist_ok=True)
         plt.figure(figsize=(12, 6))
         plt.hist(mse, bins=100, color='skyblue', edgecolor='black', alpha=0.7)
@@ -129,6 +174,7 @@ class AutoEncoder:
         """Визуализация кривых обучения."""
         if self.history is None:
             return
+        plt = pyplot()
         os.makedirs('autoencoder_png', exist_ok=True)
         plt.figure(figsize=(10, 6))
         plt.plot(self.history.history['loss'], label='Training Loss')
@@ -139,4 +185,7 @@ class AutoEncoder:
         plt.legend()
         plt.grid(True)
         plt.savefig(f'autoencoder_png/{prefix}_training_history.png')
-        plt.close()
\ No newline at end of file
+        plt.close()
+
+
+diagnostics.register('ae', lambda scores, threshold, X, anomalies: AutoEncoder.plot_anomalies(X, anomalies, scores, threshold))
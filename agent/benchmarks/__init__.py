@@ -0,0 +1,2 @@
+# Бенчмарки горячих путей агента: захват, агрегация окон, инференс моделей.
+# Запуск из каталога agent: python -m benchmarks.run --help
@@ -0,0 +1,261 @@
+# Запуск бенчмарков, сохранение результатов в JSON и сравнение с базовой линией
+#
+#   python -m benchmarks.run                        # все группы, результат в benchmarks/results/
+#   python -m benchmarks.run --save-baseline        # сделать результат новой базовой линией
+#   python -m benchmarks.run --only capture,aggregate --threshold 0.15
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+from benchmarks.synthetic import generate_traffic, to_scapy_packets, random_features
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+AGENT_DIR = os.path.dirname(BENCH_DIR)
+RESULTS_DIR = os.path.join(BENCH_DIR, 'results')
+BASELINE_PATH = os.path.join(BENCH_DIR, 'baseline.json')
+REGRESSION_THRESHOLD = 0.10  # Допустимое ухудшение относительно базовой линии
+
+IP_COUNTS = [10, 100, 1000, 10000]
+BATCH_SIZES = [1, 8, 32, 128, 512]
+
+# Бюджет времени импорта: превышение считается регрессией независимо от базовой линии
+STARTUP_BUDGET_MS = {
+    'import_main_ms': 500,
+    'capture_ready_ms': 1000,
+}
+# Код, выполняемый в чистом интерпретаторе: импорт main и модулей, нужных захвату scapy
+STARTUP_SCRIPTS = {
+    'import_main_ms': "import main",
+    'capture_ready_ms': "import main, scapy.sendrecv, scapy.layers.inet",
+}
+HEAVY_MODULES = ('tensorflow', 'sklearn', 'pandas', 'matplotlib', 'scapy', 'aiohttp', 'joblib', 'sqlalchemy')
+
+
+def _timeit(func, repeat=5):
+    """Медиана и минимум времени выполнения func в секундах"""
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples), min(samples)
+
+
+def bench_capture(args):
+    """Пропускная способность packet_handler (scapy) и packet_batch_handler (разобранные пакеты)"""
+    from logger_config import packet_log_due
+    from stats_table import ShardedStatsTable
+    from packet_processor import packet_handler, packet_batch_handler
+
+    packet_log_due.enabled = False
+    records = generate_traffic(args.ips, args.rate, args.duration, args.sizes, seed=args.seed)
+    packets = to_scapy_packets(records[:args.scapy_packets])
+    results = {}
+
+    def run_scapy():
+        table = ShardedStatsTable()
+        for pkt in packets:
+            packet_handler(pkt, table)
+
+    def run_batch(flows=None):
+        table = ShardedStatsTable()
+        for i in range(0, len(records), 1024):
+            packet_batch_handler(records[i:i + 1024], table, flows)
+
+    def run_batch_flows():
+        from flow_table import FlowTable
+        run_batch(FlowTable())
+
+    median, _ = _timeit(run_scapy, args.repeat)
+    results['packet_handler_pps'] = {'value': len(packets) / median, 'unit': 'packets/s', 'higher_is_better': True}
+    median, _ = _timeit(run_batch, args.repeat)
+    results['packet_batch_handler_pps'] = {'value': len(records) / median, 'unit': 'packets/s', 'higher_is_better': True}
+    median, _ = _timeit(run_batch_flows, args.repeat)
+    results['packet_batch_handler_flows_pps'] = {'value': len(records) / median, 'unit': 'packets/s',
+                                                 'higher_is_better': True}
+    return results
+
+
+def bench_aggregate(args):
+    """Задержка закрытия окна (aggregate_and_store по всем IP) в зависимости от числа IP"""
+    from logger_config import packet_log_due
+    from traffic_stats import TrafficStats, HostTable
+    from stats_table import ShardedStatsTable
+    from packet_processor import packet_batch_handler, close_window
+
+    packet_log_due.enabled = False
+    results = {}
+    for num_ips in IP_COUNTS:
+        records = generate_traffic(num_ips, max(args.rate, num_ips * 4), args.duration, args.sizes, seed=args.seed)
+        samples = []
+        for _ in range(args.repeat):
+            table = ShardedStatsTable()
+            packet_batch_handler(records, table)
+            stats_dict = HostTable(TrafficStats)
+            start = time.perf_counter()
+            close_window(table, stats_dict, records[-1][0])
+            samples.append(time.perf_counter() - start)
+        active = len(stats_dict)
+        results[f'close_window_ms[ips={num_ips}]'] = {
+            'value': statistics.median(samples) * 1e3, 'unit': 'ms', 'higher_is_better': False,
+            'active_ips': active,
+        }
+    return results
+
+
+def _load_models():
+    from main import load_or_train_autoencoder, load_or_train_lstm
+    return load_or_train_autoencoder(), load_or_train_lstm()
+
+
+def bench_inference(args):
+    """Задержка AutoEncoder.detect_anomalies и SimpleLSTM.detect_anomalies по размеру пачки"""
+    try:
+        ae, lstm = _load_models()
+    except ImportError as e:
+        print(f"Инференс пропущен: {e}", file=sys.stderr)
+        return {}
+    results = {}
+    for batch_size in BATCH_SIZES:
+        X = random_features(batch_size, seed=args.seed)
+        for name, model in (('ae', ae), ('lstm', lstm)):
+            if model is None:
+                continue
+            model.detect_anomalies(X.copy())  # Прогрев
+            median, _ = _timeit(lambda: model.detect_anomalies(X.copy()), args.repeat)
+            results[f'{name}_detect_ms[batch={batch_size}]'] = {
+                'value': median * 1e3, 'unit': 'ms', 'higher_is_better': False,
+            }
+    return results
+
+
+def _run_python(code, *flags):
+    return subprocess.run([sys.executable, *flags, '-c', code], cwd=AGENT_DIR, capture_output=True,
+                          text=True, check=True)
+
+
+def _heaviest_imports(code, top=10):
+    """Самые долгие импорты первых двух уровней по -X importtime (кумулятивно, мс)"""
+    stderr = _run_python(code, '-X', 'importtime').stderr
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        _, cumulative, name = line.split('|')
+        if cumulative.strip().isdigit() and not name.startswith('     '):
+            rows.append((int(cumulative) / 1e3, name.strip()))
+    return [{'module': name, 'ms': round(ms, 1)} for ms, name in sorted(rows, reverse=True)[:top]]
+
+
+def bench_startup(args):
+    """Время импорта агента в чистом интерпретаторе и какие тяжёлые модули он тянет при старте"""
+    results = {}
+    for name, code in STARTUP_SCRIPTS.items():
+        timed = (f"import time; _t = time.perf_counter(); {code}; "
+                 f"print(time.perf_counter() - _t)")
+        samples = [float(_run_python(timed).stdout.split()[-1]) for _ in range(args.repeat)]
+        results[name] = {
+            'value': statistics.median(samples) * 1e3, 'unit': 'ms', 'higher_is_better': False,
+            'budget': STARTUP_BUDGET_MS[name],
+        }
+    loaded = _run_python(f"import sys, main; print(' '.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))")
+    results['import_main_ms']['heavy_modules'] = loaded.stdout.split()
+    results['import_main_ms']['top_imports'] = _heaviest_imports("import main")
+    return results
+
+
+BENCHMARKS = {
+    'startup': bench_startup,
+    'capture': bench_capture,
+    'aggregate': bench_aggregate,
+    'inference': bench_inference,
+}
+
+
+def compare(results, baseline, threshold):
+    """Список регрессий: метрики, ухудшившиеся сильнее threshold относительно базовой линии"""
+    regressions = []
+    for name, metric in results['metrics'].items():
+        base = baseline.get('metrics', {}).get(name)
+        if not base or not base['value']:
+            continue
+        change = (metric['value'] - base['value']) / base['value']
+        worse = -change if metric['higher_is_better'] else change
+        metric['baseline'] = base['value']
+        metric['change'] = change
+        if worse > threshold:
+            regressions.append((name, base['value'], metric['value'], change))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарки агента")
+    parser.add_argument('--only', help=f"Группы через запятую: {','.join(BENCHMARKS)}")
+    parser.add_argument('--ips', type=int, default=500, help="Число удалённых IP в синтетическом трафике")
+    parser.add_argument('--rate', type=int, default=20_000, help="Средняя частота пакетов, пакетов/с")
+    parser.add_argument('--duration', type=float, default=5.0, help="Длительность трафика, с")
+    parser.add_argument('--sizes', default='bimodal', help="Распределение размеров: uniform, bimodal, lognormal")
+    parser.add_argument('--scapy-packets', type=int, default=20_000, help="Сколько пакетов прогонять через scapy")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="Файл результатов (по умолчанию benchmarks/results/<время>.json)")
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--save-baseline', action='store_true', help="Записать результат как базовую линию")
+    parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD)
+    args = parser.parse_args()
+
+    groups = args.only.split(',') if args.only else list(BENCHMARKS)
+    results = {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'params': {k: v for k, v in vars(args).items() if k not in ('output', 'baseline', 'save_baseline')},
+        'metrics': {},
+    }
+    for group in groups:
+        print(f"== {group}", file=sys.stderr)
+        results['metrics'].update(BENCHMARKS[group](args))
+
+    regressions = []
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+    over_budget = [(name, metric['budget'], metric['value'])
+                   for name, metric in results['metrics'].items()
+                   if 'budget' in metric and metric['value'] > metric['budget']]
+
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, datetime.now().strftime('%Y%m%d_%H%M%S') + '.json')
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2, ensure_ascii=False)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+
+    for name, metric in results['metrics'].items():
+        change = f" ({metric['change']:+.1%})" if 'change' in metric else ''
+        print(f"{name:40s} {metric['value']:14.3f} {metric['unit']}{change}")
+    print(f"Результаты: {output}")
+    if regressions:
+        print(f"Регрессии (порог {args.threshold:.0%}):")
+        for name, base, value, change in regressions:
+            print(f"  {name}: {base:.3f} -> {value:.3f} ({change:+.1%})")
+    if over_budget:
+        print("Превышен бюджет:")
+        for name, budget, value in over_budget:
+            print(f"  {name}: {value:.1f} > {budget}")
+    if regressions or over_budget:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
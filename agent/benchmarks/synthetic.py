@@ -0,0 +1,74 @@
+# Генерация синтетического трафика для бенчмарков
+
+import numpy as np
+
+SIZE_DISTRIBUTIONS = ('uniform', 'bimodal', 'lognormal')
+
+
+def _sizes(rng, count, distribution):
+    if distribution == 'uniform':
+        sizes = rng.integers(60, 1515, count)
+    elif distribution == 'bimodal':
+        # Типичная смесь: подтверждения TCP и полные кадры
+        sizes = np.where(rng.random(count) < 0.6, rng.integers(60, 100, count), rng.integers(1200, 1515, count))
+    elif distribution == 'lognormal':
+        sizes = np.clip(rng.lognormal(5.5, 1.0, count), 60, 1514).astype(np.int64)
+    else:
+        raise ValueError(f"Неизвестное распределение размеров: {distribution}")
+    return sizes
+
+
+def generate_traffic(num_ips=100, rate_pps=10_000, duration=5.0, size_distribution='bimodal',
+                     local_ip='10.0.0.1', start_ts=1_700_000_000.0, seed=0):
+    """Список (timestamp, src_ip, dst_ip, proto, length, sport, dport) между local_ip и num_ips хостами
+
+    Пакеты приходят пуассоновским потоком со средней частотой rate_pps,
+    удалённые хосты выбираются по закону Ципфа, направление - случайно.
+    С каждым хостом по одному потоку на протокол: локальный порт 40000+, удалённый 443 или 53.
+    """
+    rng = np.random.default_rng(seed)
+    count = max(int(rate_pps * duration), 1)
+    timestamps = start_ts + np.cumsum(rng.exponential(1.0 / rate_pps, count))
+    remote_ips = [f"172.{16 + i // 65536 % 16}.{i // 256 % 256}.{i % 256}" for i in range(num_ips)]
+    hosts = (rng.zipf(1.3, count) - 1) % num_ips
+    outgoing = rng.random(count) < 0.5
+    protos = np.where(rng.random(count) < 0.8, 6, 17)
+    sizes = _sizes(rng, count, size_distribution)
+    records = []
+    for ts, host, out, proto, size in zip(timestamps.tolist(), hosts.tolist(), outgoing.tolist(),
+                                          protos.tolist(), sizes.tolist()):
+        remote = remote_ips[host]
+        local_port = 40000 + host % 20000
+        remote_port = 443 if proto == 6 else 53
+        if out:
+            records.append((ts, local_ip, remote, proto, size, local_port, remote_port))
+        else:
+            records.append((ts, remote, local_ip, proto, size, remote_port, local_port))
+    return records
+
+
+def to_scapy_packets(records):
+    """Scapy-пакеты Ether/IP/TCP|UDP с теми же адресами и размерами, что и записи
+
+    Пакеты разбираются из байтов, как при sniff(), чтобы len() не пересобирал их.
+    """
+    from scapy.layers.l2 import Ether
+    from scapy.layers.inet import IP, TCP, UDP
+    from scapy.packet import Raw
+    packets = []
+    for ts, src, dst, proto, size, sport, dport in records:
+        transport = TCP(sport=sport, dport=dport) if proto == 6 else UDP(sport=sport, dport=dport)
+        header = Ether() / IP(src=src, dst=dst) / transport
+        pkt = Ether(bytes(header / Raw(b'\x00' * max(size - len(header), 0))))
+        pkt.time = ts
+        packets.append(pkt)
+    return packets
+
+
+def random_features(rows, dim=10, seed=0):
+    """Матрица признаков, похожая по масштабу на реальные окна"""
+    rng = np.random.default_rng(seed)
+    scale = np.array([1e4, 50, 1500, 800, 1500, 800, 0.5, 0.01, 0.5, 0.01])[:dim]
+    return rng.random((rows, dim)) * scale
+
+__all__ = ['generate_traffic', 'to_scapy_packets', 'random_features', 'SIZE_DISTRIBUTIONS']
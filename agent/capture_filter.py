@@ -0,0 +1,176 @@
+# BPF-фильтр захвата: только IPv4 и без трафика скрытых хостов (локальный список и /pgadmin/hide_ip)
+#
+# Программа собирается без libpcap: заголовки читаются через расширения Linux
+# (протокол кадра и смещение от сетевого заголовка), поэтому одна и та же программа
+# подходит для любого типа канала - Ethernet, loopback, tun. Фильтр подменяется
+# на открытом сокете (SO_ATTACH_FILTER) без перезапуска захвата.
+
+import asyncio
+import ipaddress
+import os
+import threading
+from logger_config import service_logger
+import metrics
+
+CAPTURE_FILTER = 'on'            # on - локальный список и скрытые IP сервера, local - только локальный, off - без фильтра
+CAPTURE_FILTER_REFRESH = 300     # Как часто запрашивать /pgadmin/hide_ip, секунд
+HIDE_IP_PATH = '/pgadmin/hide_ip'
+REQUEST_TIMEOUT = 10
+ACCEPT_ALL = 0x40000             # Длина кадра "без обрезки" для scapy, которому нужен весь пакет
+BPF_MAXINSNS = 4096
+
+# Коды инструкций классического BPF
+BPF_LD_W_ABS = 0x20
+BPF_LD_H_ABS = 0x28
+BPF_ALU_AND_K = 0x54
+BPF_JMP_JA = 0x05
+BPF_JMP_JEQ_K = 0x15
+BPF_RET_K = 0x06
+SKF_AD_PROTOCOL = 0xFFFFF000     # SKF_AD_OFF + SKF_AD_PROTOCOL: ethertype кадра
+SKF_NET_OFF = 0xFFF00000         # Загрузка относительно начала IP-заголовка
+ETH_P_IP = 0x0800
+_SRC, _DST = 12, 16
+_STUB_DISTANCE = 200             # Не дальше этого от сравнения ставится "ret #0": переходы BPF 8-битные
+
+
+def parse_networks(items):
+    """IPv4-адреса и подсети CIDR -> отсортированный список (адрес, маска); IPv6 и ошибки пропускаются"""
+    networks = set()
+    for item in items:
+        text = str(item).strip()
+        if not text:
+            continue
+        try:
+            network = ipaddress.ip_network(text, strict=False)
+        except ValueError:
+            service_logger.warning(f"Некорректный адрес в фильтре захвата: {text}")
+            continue
+        if network.version == 4:
+            # IPv6 не проходит фильтр целиком, отдельное правило не нужно
+            networks.add((int(network.network_address), int(network.netmask)))
+    return sorted(networks)
+
+
+def compile_filter(networks, accept=ACCEPT_ALL):
+    """Программа [(code, jt, jf, k), ...]: IPv4 без адресов networks в источнике и получателе.
+
+    accept - сколько байт кадра отдавать (snaplen), 0 - отбросить. Каждое сравнение
+    переходит на ближайшую следующую заглушку "ret #0", так что программа не упирается
+    в 8-битные смещения переходов при длинном списке.
+    """
+    checks = []
+    for offset in (_SRC, _DST):
+        checks.append([(BPF_LD_W_ABS, 0, 0, SKF_NET_OFF + offset)])
+        for address, mask in networks:
+            if mask == 0xFFFFFFFF:
+                checks.append([(BPF_JMP_JEQ_K, None, 0, address)])
+            else:
+                # После AND адрес в аккумуляторе испорчен и загружается заново
+                checks.append([(BPF_ALU_AND_K, 0, 0, mask), (BPF_JMP_JEQ_K, None, 0, address),
+                               (BPF_LD_W_ABS, 0, 0, SKF_NET_OFF + offset)])
+
+    program = [(BPF_LD_H_ABS, 0, 0, SKF_AD_PROTOCOL), (BPF_JMP_JEQ_K, 1, 0, ETH_P_IP), (BPF_RET_K, 0, 0, 0)]
+    chunk = []
+
+    def close_chunk():
+        # Переходы на заглушку в конце части; сама заглушка обходится безусловным переходом
+        for i, (code, jt, jf, k) in enumerate(chunk):
+            program.append((code, len(chunk) - i if jt is None else jt, jf, k))
+        program.extend([(BPF_JMP_JA, 0, 0, 1), (BPF_RET_K, 0, 0, 0)])
+        chunk.clear()
+
+    for group in checks:
+        if len(chunk) + len(group) > _STUB_DISTANCE:
+            close_chunk()
+        chunk.extend(group)
+    if chunk:
+        close_chunk()
+    program.append((BPF_RET_K, 0, 0, accept))
+    return program
+
+
+class CaptureFilter:
+    """Текущий BPF-фильтр для всех открытых сокетов захвата.
+
+    attach() ставит фильтр на новый сокет, refresh() запрашивает скрытые IP у сервера
+    и при изменении списка пересобирает программу для всех зарегистрированных сокетов.
+    Если сервер недоступен, остаётся последний полученный список.
+    """
+
+    def __init__(self, base_url=None, local=None, mode=None):
+        self.mode = (mode or os.getenv('CAPTURE_FILTER', CAPTURE_FILTER)).lower()
+        self.base_url = base_url.rstrip('/') if base_url and self.mode == 'on' else None
+        local = os.getenv('CAPTURE_EXCLUDE', '').split(',') if local is None else local
+        self.local = parse_networks(local)
+        self.hidden = []
+        self.networks = self.local
+        self.sockets = {}  # сокет -> длина кадра для принятых пакетов
+        self.lock = threading.Lock()
+
+    def _apply(self, sock, accept):
+        from afpacket_capture import attach_bpf
+        program = compile_filter(self.networks, accept)
+        if len(program) > BPF_MAXINSNS:
+            # Ядро не примет программу: без исключений, но только IPv4
+            service_logger.error(f"Фильтр захвата слишком длинный ({len(program)} инструкций), "
+                                 f"скрытые адреса не фильтруются")
+            program = compile_filter([], accept)
+        attach_bpf(sock, program)
+
+    def attach(self, sock, accept=ACCEPT_ALL):
+        with self.lock:
+            self._apply(sock, accept)
+            self.sockets[sock] = accept
+
+    def detach(self, sock):
+        with self.lock:
+            self.sockets.pop(sock, None)
+
+    async def _fetch_hidden(self):
+        import aiohttp
+        timeout = aiohttp.ClientTimeout(total=REQUEST_TIMEOUT)
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            async with session.get(f"{self.base_url}{HIDE_IP_PATH}") as response:
+                if response.status != 200:
+                    raise RuntimeError(f"{response.status} - {await response.text()}")
+                return await response.json()
+
+    def refresh(self):
+        """Запрос скрытых IP и замена фильтра на всех сокетах; True, если список изменился"""
+        if self.base_url is None:
+            return False
+        try:
+            rows = asyncio.run(self._fetch_hidden())
+        except Exception as e:
+            service_logger.warning(f"Не удалось получить скрытые IP: {e}")
+            return False
+        hidden = parse_networks(row.get('ip', '') if isinstance(row, dict) else row for row in rows)
+        if hidden == self.hidden:
+            return False
+        with self.lock:
+            self.hidden = hidden
+            self.networks = sorted(set(self.local) | set(hidden))
+            for sock, accept in list(self.sockets.items()):
+                try:
+                    self._apply(sock, accept)
+                except OSError as e:
+                    # Сокет закрыт захватом между итерациями - просто забываем его
+                    service_logger.debug("Фильтр не обновлён на сокете: %s", e)
+                    self.sockets.pop(sock, None)
+        metrics.CAPTURE_FILTER_NETWORKS.set(len(self.networks))
+        service_logger.info(f"Фильтр захвата обновлён: скрытых адресов {len(hidden)}, "
+                            f"всего исключений {len(self.networks)}")
+        return True
+
+    def run(self, stop_event, interval=None):
+        """Периодическое обновление до установки stop_event (первое - сразу)"""
+        interval = interval if interval is not None else \
+            float(os.getenv('CAPTURE_FILTER_REFRESH', CAPTURE_FILTER_REFRESH))
+        metrics.CAPTURE_FILTER_NETWORKS.set(len(self.networks))
+        while True:
+            self.refresh()
+            if stop_event.wait(interval):
+                break
+
+
+__all__ = ['CaptureFilter', 'compile_filter', 'parse_networks', 'ACCEPT_ALL', 'CAPTURE_FILTER']
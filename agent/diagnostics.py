@@ -0,0 +1,128 @@
+# Диагностические графики моделей вне горячего пути оценки
+
+import os
+import queue
+import threading
+import numpy as np
+from logger_config import service_logger
+
+# Режим: off - только буфер оценок, sample - рисовать каждые N пачек в потоке оценки,
+# background - каждые N пачек передавать отрисовку фоновому потоку
+DIAGNOSTICS_MODE = 'background'
+DIAGNOSTICS_EVERY = 12
+RING_CAPACITY = 4096
+
+
+def pyplot():
+    """Ленивый импорт matplotlib: библиотека нужна только при отрисовке"""
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    return plt
+
+
+class ScoreRing:
+    """Кольцевой буфер последних оценок модели фиксированного размера."""
+    __slots__ = ('values', 'index', 'count')
+
+    def __init__(self, capacity=RING_CAPACITY):
+        self.values = np.zeros(capacity, dtype=np.float64)
+        self.index = 0
+        self.count = 0
+
+    def extend(self, scores):
+        scores = np.asarray(scores, dtype=np.float64).ravel()
+        capacity = len(self.values)
+        if len(scores) >= capacity:
+            self.values[:] = scores[-capacity:]
+            self.index = 0
+            self.count = capacity
+            return
+        end = self.index + len(scores)
+        if end <= capacity:
+            self.values[self.index:end] = scores
+        else:
+            split = capacity - self.index
+            self.values[self.index:] = scores[:split]
+            self.values[:end - capacity] = scores[split:]
+        self.index = end % capacity
+        self.count = min(self.count + len(scores), capacity)
+
+    def snapshot(self):
+        """Копия оценок в порядке поступления"""
+        if self.count < len(self.values):
+            return self.values[:self.count].copy()
+        return np.roll(self.values, -self.index)
+
+
+class Diagnostics:
+    """Сбор оценок в кольцевые буферы и отрисовка графиков по выбранному режиму."""
+
+    def __init__(self, mode=DIAGNOSTICS_MODE, every=DIAGNOSTICS_EVERY, capacity=RING_CAPACITY):
+        self.mode = mode
+        self.every = every
+        self.capacity = capacity
+        self.rings = {}
+        self.thresholds = {}
+        self.batches = {}
+        self.renderers = {}
+        self.jobs = queue.Queue(maxsize=2)
+        self.worker = None
+
+    def configure(self, mode=None, every=None):
+        """Настройка из аргументов или переменных окружения DIAGNOSTICS_MODE, DIAGNOSTICS_EVERY"""
+        self.mode = (mode or os.getenv('DIAGNOSTICS_MODE', DIAGNOSTICS_MODE)).lower()
+        self.every = max(int(every or os.getenv('DIAGNOSTICS_EVERY', DIAGNOSTICS_EVERY)), 1)
+
+    def register(self, name, renderer):
+        """renderer(scores, threshold, **extra) рисует графики по снимку буфера"""
+        self.renderers[name] = renderer
+
+    def record(self, name, scores, threshold, **extra):
+        """Учёт оценок пачки; отрисовка только в каждой N-й пачке и не в режиме off.
+
+        Массивы в extra передаются без копии; копируются только для фоновой отрисовки.
+        """
+        ring = self.rings.get(name)
+        if ring is None:
+            ring = self.rings[name] = ScoreRing(self.capacity)
+        ring.extend(scores)
+        self.thresholds[name] = threshold
+        if self.mode == 'off' or name not in self.renderers:
+            return
+        self.batches[name] = self.batches.get(name, 0) + 1
+        if self.batches[name] % self.every:
+            return
+        if self.mode == 'sample':
+            self._render((self.renderers[name], ring.snapshot(), threshold, extra))
+            return
+        # Вызывающий может переиспользовать массивы пачки, пока фоновый поток рисует
+        extra = {key: value.copy() if isinstance(value, np.ndarray) else value for key, value in extra.items()}
+        job = (self.renderers[name], ring.snapshot(), threshold, extra)
+        self._ensure_worker()
+        try:
+            self.jobs.put_nowait(job)
+        except queue.Full:
+            service_logger.debug("Фоновая отрисовка не успевает, график %s пропущен", name)
+
+    def _ensure_worker(self):
+        if self.worker is None or not self.worker.is_alive():
+            self.worker = threading.Thread(target=self._run, daemon=True, name="DiagnosticsThread")
+            self.worker.start()
+
+    def _run(self):
+        while True:
+            self._render(self.jobs.get())
+
+    @staticmethod
+    def _render(job):
+        renderer, scores, threshold, extra = job
+        try:
+            renderer(scores, threshold, **extra)
+        except Exception as e:
+            service_logger.error(f"Ошибка отрисовки диагностики: {e}", exc_info=True)
+
+
+diagnostics = Diagnostics()
+
+__all__ = ['diagnostics', 'Diagnostics', 'ScoreRing', 'pyplot']
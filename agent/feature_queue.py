@@ -0,0 +1,121 @@
+# Ограниченная очередь пачек признаков между анализом окон и инференсом (режим threads)
+
+import os
+import threading
+import time
+from collections import deque
+from logger_config import service_logger
+import metrics
+
+FEATURE_QUEUE_MAX_RECORDS = 65536   # Записей в очереди, как RING_CAPACITY в режиме processes
+FEATURE_QUEUE_POLICY = 'drop-oldest'
+FEATURE_QUEUE_BATCH = 8192          # Наибольшее число записей в одном вызове моделей
+FEATURE_QUEUE_MAX_DELAY = 0         # Сколько секунд ждать следующих пачек перед оценкой (0 - не ждать)
+POLICIES = ('drop-oldest', 'drop-newest', 'block')
+
+
+class FeatureQueue:
+    """Очередь пачек close_window, ограниченная числом записей.
+
+    При переполнении put() следует политике: drop-oldest отбрасывает самые старые пачки,
+    drop-newest - новую пачку, block ждёт места (анализ окон приостанавливается, пакеты
+    продолжают копиться в текущем окне). Пачка больше всей ёмкости принимается в пустую
+    очередь, чтобы писатель не ждал вечно. get_batch() ждёт данные без опроса и склеивает
+    все накопленные пачки в одну до max_records записей.
+    """
+
+    def __init__(self, max_records=None, policy=None, clock=time.monotonic):
+        self.max_records = max_records if max_records is not None else \
+            int(os.getenv('FEATURE_QUEUE_MAX_RECORDS', FEATURE_QUEUE_MAX_RECORDS))
+        self.policy = (policy or os.getenv('FEATURE_QUEUE_POLICY', FEATURE_QUEUE_POLICY)).lower()
+        if self.policy not in POLICIES:
+            raise ValueError(f"Неизвестная политика очереди признаков: {self.policy}")
+        self.clock = clock
+        self.batches = deque()  # (время постановки, пачка)
+        self.records = 0
+        self.dropped = 0
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.not_full = threading.Condition(self.lock)
+
+    def _fits(self, count):
+        return not self.batches or self.records + count <= self.max_records
+
+    def put(self, data, block=True, timeout=None):
+        """Поставить пачку; False, если она (или вытесненные ею старые пачки) отброшена"""
+        count = len(data)
+        if not count:
+            return True
+        with self.lock:
+            accepted = True
+            if not self._fits(count):
+                if self.policy == 'drop-newest':
+                    self.dropped += count
+                    self._report_drop(count)
+                    return False
+                if self.policy == 'block' and block:
+                    started = self.clock()
+                    self.not_full.wait_for(lambda: self._fits(count), timeout)
+                    metrics.QUEUE_BLOCKED_SECONDS.observe(self.clock() - started)
+                dropped = 0
+                while not self._fits(count):
+                    dropped += len(self.batches.popleft()[1])
+                if dropped:
+                    self.records -= dropped
+                    self.dropped += dropped
+                    self._report_drop(dropped)
+                    accepted = self.policy == 'drop-oldest'
+            self.batches.append((self.clock(), data))
+            self.records += count
+            self.not_empty.notify()
+            return accepted
+
+    def _report_drop(self, count):
+        service_logger.warning(f"Очередь признаков переполнена ({self.policy}), отброшено записей: {count}")
+
+    def get_batch(self, max_records=None, timeout=None, max_delay=None):
+        """Склеенные пачки из очереди (не больше max_records записей, но хотя бы одна пачка).
+
+        Ждёт первую пачку до timeout секунд (пустой список, если не дождались). Если max_delay
+        больше нуля, ещё ждёт новые пачки, пока самая старая из взятых не пролежит max_delay
+        секунд или не наберётся max_records записей.
+        """
+        max_records = max_records if max_records is not None else \
+            int(os.getenv('FEATURE_QUEUE_BATCH', FEATURE_QUEUE_BATCH))
+        max_delay = max_delay if max_delay is not None else \
+            float(os.getenv('FEATURE_QUEUE_MAX_DELAY', FEATURE_QUEUE_MAX_DELAY))
+        with self.lock:
+            if not self.not_empty.wait_for(lambda: self.batches, timeout):
+                return []
+            if max_delay > 0:
+                deadline = self.batches[0][0] + max_delay
+                self.not_empty.wait_for(lambda: self.records >= max_records or self.clock() >= deadline,
+                                        max(deadline - self.clock(), 0))
+            now = self.clock()
+            metrics.QUEUE_WAIT_SECONDS.observe(now - self.batches[0][0])
+            merged = []
+            taken = 0
+            while self.batches and (not merged or len(merged) + len(self.batches[0][1]) <= max_records):
+                merged.extend(self.batches.popleft()[1])
+                taken += 1
+            self.records -= len(merged)
+            self.not_full.notify_all()
+        metrics.COALESCED_BATCHES.observe(taken)
+        return merged
+
+    def get(self, block=True, timeout=None):
+        """Одна пачка, как queue.Queue.get; пустой список по тайм-ауту"""
+        return self.get_batch(max_records=1, timeout=timeout if block else 0, max_delay=0)
+
+    def empty(self):
+        return not self.batches
+
+    def qsize(self):
+        """Записей в очереди"""
+        return self.records
+
+    def task_done(self):
+        pass
+
+
+__all__ = ['FeatureQueue', 'POLICIES', 'FEATURE_QUEUE_MAX_RECORDS', 'FEATURE_QUEUE_POLICY', 'FEATURE_QUEUE_BATCH']
@@ -0,0 +1,266 @@
+# Локальное хранилище признаков и оценок окон, разбитое на часовые разделы
+#
+#   python feature_store.py list                                   # разделы, строки и размер
+#   python feature_store.py --flows list                           # то же для завершённых потоков
+#   python feature_store.py export out.csv --start "2025-05-01 10:00" --end "2025-05-01 12:00"
+#
+# Каждый раздел - каталог ГГГГММДД-ЧЧ, в нём по файлу на столбец с сырыми значениями.
+# Запись - дозапись в конец файлов, чтение - np.memmap без копирования.
+
+import argparse
+import os
+import shutil
+import time
+import numpy as np
+from logger_config import service_logger
+from packet_processor import FEATURE_NAMES
+from shm_ring import ip_to_int, int_to_ip
+
+STORE_DIR = 'feature_store'
+RETENTION_HOURS = 7 * 24
+MAX_STORE_MB = 1024
+SECONDS_PER_PARTITION = 3600
+
+# Столбцы и их типы; метка времени окна в секундах, ошибки моделей NaN, если окно не оценено
+COLUMNS = ([('ip', np.uint32), ('timestamp', np.float64)]
+           + [(name, np.float64) for name in FEATURE_NAMES]
+           + [('ae_error', np.float32), ('lstm_error', np.float32),
+              ('anomaly_ae', np.int8), ('anomaly_lstm', np.int8), ('anomaly_consensus', np.int8)])
+COLUMN_TYPES = dict(COLUMNS)
+TRAIN_COLUMNS = FEATURE_NAMES[:10]
+
+
+def _seconds(value):
+    """Секунды для границ диапазона: число, datetime или строка (без пояса - местное время, как метки окон)"""
+    if value is None or isinstance(value, (int, float)):
+        return value
+    import pandas as pd
+    value = pd.Timestamp(value)
+    if value.tz is None:
+        return value.to_pydatetime(warn=False).timestamp()
+    return value.timestamp()
+
+
+def _local_seconds(timestamps):
+    """Метки окон (наивное местное время, pd.Timestamp.fromtimestamp) -> секунды эпохи.
+
+    datetime.timestamp() считает наивное время местным с учётом летнего времени;
+    меток в пачке немного (по одной на окно), поэтому перевод идёт по уникальным.
+    """
+    import pandas as pd
+    values = np.asarray(timestamps, dtype='datetime64[ns]')
+    unique, inverse = np.unique(values, return_inverse=True)
+    seconds = np.array([pd.Timestamp(value).to_pydatetime(warn=False).timestamp() for value in unique],
+                       dtype=np.float64)
+    return seconds[inverse.reshape(-1)]
+
+
+def _local_times(seconds):
+    """Секунды эпохи -> наивное местное время, в котором метки окон уходят на сервер"""
+    import pandas as pd
+    unique, inverse = np.unique(np.asarray(seconds, dtype=np.float64), return_inverse=True)
+    times = pd.DatetimeIndex([pd.Timestamp.fromtimestamp(value) for value in unique])
+    return times[inverse.reshape(-1)]
+
+
+def _partition_name(key):
+    return time.strftime('%Y%m%d-%H', time.gmtime(key * SECONDS_PER_PARTITION))
+
+
+def _partition_key(name):
+    import calendar
+    return calendar.timegm(time.strptime(name, '%Y%m%d-%H')) // SECONDS_PER_PARTITION
+
+
+class FeatureStore:
+    """Столбцовое хранилище окон на диске с часовыми разделами и ограничением объёма.
+
+    Писатель один (поток оценки), читать можно из других потоков и процессов: число строк
+    раздела - минимальная длина его столбцов, поэтому недописанная строка не видна.
+    Перед первой записью в раздел столбцы обрезаются до этого числа строк, иначе после
+    сбоя посреди записи следующие строки легли бы в столбцы со сдвигом.
+    Разделы старше retention_hours и самые старые сверх max_mb удаляются при открытии
+    нового раздела.
+    """
+
+    def __init__(self, root=STORE_DIR, retention_hours=None, max_mb=None, columns=COLUMNS):
+        self.root = root
+        # Другой набор столбцов - например, завершённые потоки flow_table.FLOW_COLUMNS
+        self.columns = columns
+        self.column_types = dict(columns)
+        self.retention_hours = retention_hours if retention_hours is not None else \
+            float(os.getenv('FEATURE_STORE_RETENTION_HOURS', RETENTION_HOURS))
+        self.max_bytes = (max_mb if max_mb is not None else
+                          float(os.getenv('FEATURE_STORE_MAX_MB', MAX_STORE_MB))) * 1024 * 1024
+        self.last_key = None
+        self.aligned = set()  # Разделы, столбцы которых выровнены в этом процессе
+
+    def partitions(self):
+        """Имена разделов от старого к новому"""
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(name for name in os.listdir(self.root)
+                      if not name.startswith('.') and os.path.isdir(os.path.join(self.root, name)))
+
+    def _rows(self, path):
+        sizes = []
+        for name, dtype in self.columns:
+            try:
+                sizes.append(os.path.getsize(os.path.join(path, name)) // np.dtype(dtype).itemsize)
+            except FileNotFoundError:
+                return 0
+        return min(sizes)
+
+    def _align(self, path):
+        """Обрезать столбцы раздела до числа целых строк (хвост прерванной записи)"""
+        rows = self._rows(path)
+        for name, dtype in self.columns:
+            file_path = os.path.join(path, name)
+            size = rows * np.dtype(dtype).itemsize
+            if os.path.exists(file_path) and os.path.getsize(file_path) != size:
+                os.truncate(file_path, size)
+                service_logger.warning(f"Столбец {name} раздела {os.path.basename(path)} обрезан до {rows} строк")
+        self.aligned.add(path)
+
+    def append(self, columns):
+        """Дописать строки: словарь столбец -> массив одинаковой длины (метка времени в секундах)"""
+        timestamps = np.asarray(columns['timestamp'], dtype=np.float64)
+        if not len(timestamps):
+            return
+        keys = (timestamps // SECONDS_PER_PARTITION).astype(np.int64)
+        unique_keys = np.unique(keys)
+        for key in unique_keys:
+            # Обычно пачка целиком попадает в один раздел
+            rows = slice(None) if len(unique_keys) == 1 else keys == key
+            path = os.path.join(self.root, _partition_name(int(key)))
+            if key != self.last_key and not os.path.isdir(path):
+                os.makedirs(path)
+                self.enforce_retention()
+            self.last_key = key
+            if path not in self.aligned:
+                self._align(path)
+            try:
+                for name, dtype in self.columns:
+                    values = np.asarray(columns[name])[rows].astype(dtype, copy=False)
+                    with open(os.path.join(path, name), 'ab') as f:
+                        f.write(values.tobytes())
+            except BaseException:
+                # Часть столбцов могла дописаться: перед следующей записью раздел выравнивается заново
+                self.aligned.discard(path)
+                raise
+
+    def append_batch(self, ips, timestamps, X, errors_ae, errors_lstm, anomalies_ae, anomalies_lstm, consensus):
+        """Пачка из score_batch: IP-строки, метки окон в местном времени, матрица FEATURE_NAMES и оценки"""
+        columns = {
+            'ip': np.fromiter((ip_to_int(ip) for ip in ips), dtype=np.uint32, count=len(ips)),
+            'timestamp': _local_seconds(timestamps),
+            'ae_error': errors_ae,
+            'lstm_error': errors_lstm,
+            'anomaly_ae': anomalies_ae,
+            'anomaly_lstm': anomalies_lstm,
+            'anomaly_consensus': consensus,
+        }
+        columns.update({name: X[:, n] for n, name in enumerate(FEATURE_NAMES)})
+        self.append(columns)
+
+    def enforce_retention(self, now=None):
+        """Удаление разделов старше срока хранения и самых старых сверх лимита объёма"""
+        now = time.time() if now is None else now
+        oldest_key = (now - self.retention_hours * 3600) // SECONDS_PER_PARTITION
+        names = self.partitions()
+        sizes = {name: sum(entry.stat().st_size for entry in os.scandir(os.path.join(self.root, name)))
+                 for name in names}
+        total = sum(sizes.values())
+        # Текущий (последний) раздел не удаляется даже при превышении объёма; срок 0 - без ограничения
+        for name in names[:-1]:
+            expired = self.retention_hours > 0 and _partition_key(name) < oldest_key
+            if not expired and total <= self.max_bytes:
+                break
+            shutil.rmtree(os.path.join(self.root, name), ignore_errors=True)
+            total -= sizes[name]
+            service_logger.info(f"Раздел хранилища признаков {name} удалён")
+
+    def scan(self, start=None, end=None, columns=None):
+        """Столбцы по разделам в диапазоне start <= timestamp < end: словари np.memmap без копирования"""
+        start, end = _seconds(start), _seconds(end)
+        columns = list(columns or self.column_types)
+        for name in self.partitions():
+            key = _partition_key(name)
+            lower, upper = key * SECONDS_PER_PARTITION, (key + 1) * SECONDS_PER_PARTITION
+            if (start is not None and upper <= start) or (end is not None and lower >= end):
+                continue
+            path = os.path.join(self.root, name)
+            rows = self._rows(path)
+            if not rows:
+                continue
+            part = {column: np.memmap(os.path.join(path, column), dtype=self.column_types[column], mode='r', shape=(rows,))
+                    for column in columns}
+            if (start is not None and lower < start) or (end is not None and upper > end):
+                # Раздел на границе диапазона: отбор строк по времени (это уже копия)
+                ts = np.memmap(os.path.join(path, 'timestamp'), dtype=np.float64, mode='r', shape=(rows,))
+                mask = np.ones(rows, dtype=bool)
+                if start is not None:
+                    mask &= ts >= start
+                if end is not None:
+                    mask &= ts < end
+                if not mask.any():
+                    continue
+                if not mask.all():
+                    part = {column: values[mask] for column, values in part.items()}
+            yield part
+
+    def read(self, start=None, end=None, columns=None):
+        """Столбцы диапазона одним словарём; из одного раздела - без копирования"""
+        columns = list(columns or self.column_types)
+        parts = list(self.scan(start, end, columns))
+        if len(parts) == 1:
+            return parts[0]
+        return {column: np.concatenate([part[column] for part in parts]) if parts
+                else np.empty(0, dtype=self.column_types[column]) for column in columns}
+
+    def training_matrix(self, start=None, end=None):
+        """Матрица 10 признаков для обучения моделей в порядке записи"""
+        data = self.read(start, end, TRAIN_COLUMNS)
+        return np.column_stack([np.asarray(data[column], dtype=np.float64) for column in TRAIN_COLUMNS])
+
+    def __len__(self):
+        return sum(self._rows(os.path.join(self.root, name)) for name in self.partitions())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Локальное хранилище признаков агента")
+    parser.add_argument('--root', help="Каталог хранилища (по умолчанию feature_store или flow_store)")
+    parser.add_argument('--flows', action='store_true', help="Хранилище завершённых потоков")
+    sub = parser.add_subparsers(dest='command', required=True)
+    sub.add_parser('list')
+    export = sub.add_parser('export', help="Выгрузка диапазона в CSV")
+    export.add_argument('path')
+    export.add_argument('--start')
+    export.add_argument('--end')
+    args = parser.parse_args()
+
+    if args.flows:
+        from flow_table import FLOW_COLUMNS, FLOW_STORE_DIR
+        store = FeatureStore(args.root or FLOW_STORE_DIR, columns=FLOW_COLUMNS)
+    else:
+        store = FeatureStore(args.root or STORE_DIR)
+    if args.command == 'list':
+        for name in store.partitions():
+            path = os.path.join(store.root, name)
+            size = sum(entry.stat().st_size for entry in os.scandir(path))
+            print(f"{name}  {store._rows(path):>9} строк  {size / 1024 / 1024:8.1f} МБ")
+    else:
+        import pandas as pd
+        df = pd.DataFrame({column: np.asarray(values) for column, values in store.read(args.start, args.end).items()})
+        for column in ('ip', 'src_ip', 'dst_ip'):
+            if column in df:
+                df[column] = [int_to_ip(value) for value in df[column]]
+        df['timestamp'] = _local_times(df['timestamp'])
+        df.to_csv(args.path, index=False)
+        print(f"Выгружено {len(df)} строк в {args.path}")
+
+
+__all__ = ['FeatureStore', 'COLUMNS', 'TRAIN_COLUMNS']
+
+if __name__ == "__main__":
+    main()
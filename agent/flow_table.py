@@ -0,0 +1,142 @@
+# Двунаправленные потоки по 5-кортежу с тайм-аутами простоя и длительности, как в CICFlowMeter
+
+import os
+from collections import OrderedDict
+from threading import Lock
+import numpy as np
+from traffic_stats import DirectionStats
+from shm_ring import ip_to_int
+
+FLOW_IDLE_TIMEOUT = 60      # Секунд без пакетов, после которых поток завершён
+FLOW_ACTIVE_TIMEOUT = 120   # Наибольшая длительность потока; дальше пакеты открывают новый поток
+MAX_FLOWS = 262144          # Сверх этого числа досрочно завершаются самые давние потоки
+FLOW_STORE_DIR = 'flow_store'
+
+# Вектор признаков завершённого потока (столбцы FeatureStore); timestamp - первый пакет
+FLOW_COLUMNS = ([('src_ip', np.uint32), ('dst_ip', np.uint32), ('sport', np.uint16), ('dport', np.uint16),
+                 ('proto', np.uint8), ('timestamp', np.float64), ('duration', np.float64),
+                 ('fwd_packets', np.uint32), ('bck_packets', np.uint32),
+                 ('fwd_bytes', np.uint64), ('bck_bytes', np.uint64)]
+                + [(name, np.float64) for name in (
+                    'fl_byt_s', 'fl_pck_s', 'fwd_max_pack_size', 'fwd_avg_packet', 'bck_max_pack_size',
+                    'bck_avg_packet', 'fw_iat_mean', 'fw_iat_std', 'fw_iat_min',
+                    'bck_iat_mean', 'bck_iat_std', 'bck_iat_min')])
+
+
+class Flow:
+    """Поток: направление fwd задаёт первый пакет, как в CICFlowMeter."""
+    __slots__ = ('src_ip', 'dst_ip', 'sport', 'dport', 'proto', 'start', 'last', 'fwd', 'bck')
+
+    def __init__(self, timestamp, src_ip, dst_ip, proto, sport, dport):
+        self.src_ip = src_ip
+        self.dst_ip = dst_ip
+        self.sport = sport
+        self.dport = dport
+        self.proto = proto
+        self.start = timestamp
+        self.last = timestamp
+        self.fwd = DirectionStats()
+        self.bck = DirectionStats()
+
+    def add(self, timestamp, src_ip, sport, length):
+        if timestamp > self.last:
+            self.last = timestamp
+        if src_ip == self.src_ip and sport == self.sport:
+            self.fwd.add(timestamp, length)
+        else:
+            self.bck.add(timestamp, length)
+
+    def features(self):
+        """Строка FLOW_COLUMNS"""
+        fwd, bck = self.fwd, self.bck
+        duration = self.last - self.start
+        rate_duration = max(duration, 1e-6)
+        return (ip_to_int(self.src_ip), ip_to_int(self.dst_ip), self.sport, self.dport, self.proto,
+                self.start, duration, fwd.count, bck.count, fwd.bytes, bck.bytes,
+                (fwd.bytes + bck.bytes) / rate_duration, (fwd.count + bck.count) / rate_duration,
+                fwd.max_size, fwd.avg_size(), bck.max_size, bck.avg_size(),
+                fwd.iat_mean, fwd.iat_std(), fwd.min_iat(),
+                bck.iat_mean, bck.iat_std(), bck.min_iat())
+
+
+def flow_key(src_ip, dst_ip, proto, sport, dport):
+    """Ключ, одинаковый для обоих направлений потока"""
+    if (src_ip, sport) <= (dst_ip, dport):
+        return src_ip, sport, dst_ip, dport, proto
+    return dst_ip, dport, src_ip, sport, proto
+
+
+class FlowTable:
+    """Активные потоки в OrderedDict по ключу 5-кортежа в порядке последнего пакета.
+
+    Каждый пакет обновляет ровно одну запись. Поток завершается, если пакет пришёл после
+    простоя дольше idle_timeout или поток длится дольше active_timeout (пакет открывает
+    новый поток), а также при периодической проверке expire(). Давние потоки лежат
+    в начале словаря, поэтому expire() снимает только истёкшие, не перебирая все.
+    """
+
+    def __init__(self, idle_timeout=None, active_timeout=None, max_flows=None):
+        self.idle_timeout = idle_timeout if idle_timeout is not None else \
+            float(os.getenv('FLOW_IDLE_TIMEOUT', FLOW_IDLE_TIMEOUT))
+        self.active_timeout = active_timeout if active_timeout is not None else \
+            float(os.getenv('FLOW_ACTIVE_TIMEOUT', FLOW_ACTIVE_TIMEOUT))
+        self.max_flows = max_flows if max_flows is not None else int(os.getenv('MAX_FLOWS', MAX_FLOWS))
+        self.flows = OrderedDict()
+        self.finished = []
+        self.lock = Lock()
+
+    def __len__(self):
+        return len(self.flows)
+
+    def _add(self, timestamp, src_ip, dst_ip, proto, length, sport, dport):
+        flows = self.flows
+        key = flow_key(src_ip, dst_ip, proto, sport, dport)
+        flow = flows.get(key)
+        if flow is not None:
+            if timestamp - flow.last > self.idle_timeout or timestamp - flow.start > self.active_timeout:
+                self.finished.append(flows.pop(key))
+                flow = None
+            else:
+                flows.move_to_end(key)
+        if flow is None:
+            flow = flows[key] = Flow(timestamp, src_ip, dst_ip, proto, sport, dport)
+            if len(flows) > self.max_flows:
+                self.finished.append(flows.popitem(last=False)[1])
+        flow.add(timestamp, src_ip, sport, length)
+
+    def add_packet(self, timestamp, src_ip, dst_ip, proto, length, sport=0, dport=0):
+        with self.lock:
+            self._add(timestamp, src_ip, dst_ip, proto, length, sport, dport)
+
+    def add_batch(self, batch):
+        """Пачка записей (timestamp, src_ip, dst_ip, proto, length, sport, dport) под одной блокировкой"""
+        with self.lock:
+            add = self._add
+            for record in batch:
+                add(*record)
+
+    def expire(self, now, flush=False):
+        """Завершённые потоки: простаивающие к моменту now (flush - все); список Flow"""
+        deadline = now - self.idle_timeout
+        with self.lock:
+            finished, self.finished = self.finished, []
+            flows = self.flows
+            while flows:
+                key, flow = next(iter(flows.items()))
+                if not flush and flow.last > deadline:
+                    break
+                del flows[key]
+                finished.append(flow)
+        return finished
+
+
+def flow_columns(flows):
+    """Список Flow -> словарь столбцов FLOW_COLUMNS для FeatureStore.append"""
+    rows = [flow.features() for flow in flows]
+    if not rows:
+        return {name: np.empty(0, dtype=dtype) for name, dtype in FLOW_COLUMNS}
+    values = list(zip(*rows))
+    return {name: np.asarray(column, dtype=dtype) for (name, dtype), column in zip(FLOW_COLUMNS, values)}
+
+
+__all__ = ['FlowTable', 'Flow', 'flow_key', 'flow_columns', 'FLOW_COLUMNS', 'FLOW_STORE_DIR']
@@ -1,40 +1,241 @@
 # Настройка логгеров
 
+import atexit
 import logging
-from logging.handlers import RotatingFileHandler
+import os
+import queue
+import socket
+import struct
+import threading
+import time
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
 
 # Получаем логгеры
 service_logger = logging.getLogger('service')
 packet_logger = logging.getLogger('packet')
 
-def init_loggers():
+# Режим записи: sync - обработчики в вызывающем потоке, async - через очередь в фоновом потоке
+LOG_MODE = 'sync'
+# Формат лога пакетов: text, binary (компактные записи фиксированной длины) или off
+PACKET_LOG_FORMAT = 'text'
+# Писать в лог пакетов каждый N-й пакет
+PACKET_LOG_SAMPLE = 1
+
+# Запись бинарного лога пакетов: время, src, dst, протокол, размер
+PACKET_RECORD = struct.Struct('=d4s4sBI')
+
+_listener = None
+
+
+class RateLimitFilter(logging.Filter):
+    """Ограничение числа записей в секунду (token bucket) с подсчётом отброшенных."""
+
+    def __init__(self, rate, burst=None):
+        super().__init__()
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(rate, 1))
+        self.tokens = self.burst
+        self.last = time.monotonic()
+        self.suppressed = 0
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if self.tokens < 1:
+                self.suppressed += 1
+                return False
+            self.tokens -= 1
+            suppressed, self.suppressed = self.suppressed, 0
+        if suppressed:
+            record.msg = f"{record.getMessage()} (пропущено записей: {suppressed})"
+            record.args = None
+        return True
+
+
+class PacketLogSampler:
+    """Решает, писать ли очередной пакет в лог, до создания LogRecord."""
+
+    def __init__(self, every=1, enabled=True):
+        self.every = max(int(every), 1)
+        self.enabled = enabled
+        self.counter = 0
+
+    def __call__(self):
+        if not self.enabled:
+            return False
+        if self.every == 1:
+            return True
+        # Счётчик без блокировки: для выборки допустима неточность между потоками
+        self.counter += 1
+        if self.counter >= self.every:
+            self.counter = 0
+            return True
+        return False
+
+
+packet_log_due = PacketLogSampler()
+
+
+class BinaryPacketHandler(logging.Handler):
+    """Запись пакетов в бинарный файл записями PACKET_RECORD с ротацией по размеру.
+
+    Ожидает записи вида packet_logger.info(msg, timestamp, src_ip, dst_ip, proto, length).
+    """
+
+    def __init__(self, filename, maxBytes=0, backupCount=0):
+        super().__init__()
+        self.filename = filename
+        self.maxBytes = maxBytes
+        self.backupCount = backupCount
+        self.stream = open(filename, 'ab')
+
+    def _rotate(self):
+        self.stream.close()
+        for i in range(self.backupCount - 1, 0, -1):
+            src = f"{self.filename}.{i}"
+            if os.path.exists(src):
+                os.replace(src, f"{self.filename}.{i + 1}")
+        if self.backupCount:
+            os.replace(self.filename, f"{self.filename}.1")
+        self.stream = open(self.filename, 'wb')
+
+    def emit(self, record):
+        try:
+            timestamp, src_ip, dst_ip, proto, length = record.args
+            self.stream.write(PACKET_RECORD.pack(
+                timestamp, socket.inet_aton(src_ip), socket.inet_aton(dst_ip), int(proto), length))
+            if self.maxBytes and self.stream.tell() >= self.maxBytes:
+                self._rotate()
+        except Exception:
+            self.handleError(record)
+
+    def flush(self):
+        with self.lock:
+            self.stream.flush()
+
+    def close(self):
+        with self.lock:
+            self.stream.close()
+        super().close()
+
+
+def read_packet_log(filename):
+    """Чтение бинарного лога пакетов: (timestamp, src_ip, dst_ip, proto, length)"""
+    with open(filename, 'rb') as f:
+        data = f.read()
+    usable = len(data) - len(data) % PACKET_RECORD.size
+    for timestamp, src, dst, proto, length in PACKET_RECORD.iter_unpack(data[:usable]):
+        yield timestamp, socket.inet_ntoa(src), socket.inet_ntoa(dst), proto, length
+
+
+class _DeferredQueueHandler(QueueHandler):
+    """Передаёт запись в очередь без форматирования - сообщение собирается в фоновом потоке.
+
+    Только для packet_logger: его аргументы - числа и строки (PACKET_LOG_MSG), изменить их
+    после вызова нельзя, а BinaryPacketHandler нужны сами аргументы, а не текст.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+def _stop_listener():
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(_stop_listener)
+
+
+def init_loggers(mode=None, packet_format=None, packet_sample=None, rate_limits=None,
+                 service_file='log_files/service.log'):
+    """Настройка логгеров; параметры по умолчанию берутся из переменных окружения
+
+    rate_limits - словарь {имя логгера: записей в секунду}, 0 - без ограничения.
+    service_file - отдельный файл нужен каждому процессу: ротация не согласуется между процессами.
+    """
+    global _listener
+    mode = (mode or os.getenv('LOG_MODE', LOG_MODE)).lower()
+    packet_format = (packet_format or os.getenv('PACKET_LOG_FORMAT', PACKET_LOG_FORMAT)).lower()
+    packet_sample = int(packet_sample or os.getenv('PACKET_LOG_SAMPLE', PACKET_LOG_SAMPLE))
+    if rate_limits is None:
+        rate_limits = {
+            'service': float(os.getenv('LOG_RATE_LIMIT_SERVICE', 0)),
+            'packet': float(os.getenv('LOG_RATE_LIMIT_PACKET', 0)),
+        }
+
     # Устанавливаем уровни логирования
     service_logger.setLevel(logging.INFO)
     packet_logger.setLevel(logging.INFO)
 
-    # Очищаем старые обработчики
+    # Очищаем старые обработчики, фильтры и фоновый поток записи
+    _stop_listener()
     for logger in [service_logger, packet_logger]:
         for handler in logger.handlers[:]:
             logger.removeHandler(handler)
+            handler.close()
+        for log_filter in logger.filters[:]:
+            logger.removeFilter(log_filter)
 
     # Настройка форматтеров
     service_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
     packet_formatter = logging.Formatter('%(asctime)s - %(message)s')
 
     # Обработчики для service логгера
-    service_handler = RotatingFileHandler('log_files/service.log', maxBytes=1_000_000, backupCount=3)
+    service_handler = RotatingFileHandler(service_file, maxBytes=1_000_000, backupCount=3)
     service_handler.setFormatter(service_formatter)
-    service_logger.addHandler(service_handler)
-
-    # Обработчики для packet логгера
-    packet_handler = RotatingFileHandler('log_files/packets.log', maxBytes=50_000_000, backupCount=5)
-    packet_handler.setFormatter(packet_formatter)
-    packet_logger.addHandler(packet_handler)
 
     # Добавляем консольный обработчик
     console_handler = logging.StreamHandler()
     console_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
-    service_logger.addHandler(console_handler)
+    service_handlers = [service_handler, console_handler]
+
+    # Обработчики для packet логгера
+    packet_handlers = []
+    if packet_format == 'binary':
+        packet_handlers.append(BinaryPacketHandler('log_files/packets.bin', maxBytes=50_000_000, backupCount=5))
+    elif packet_format != 'off':
+        packet_handler = RotatingFileHandler('log_files/packets.log', maxBytes=50_000_000, backupCount=5)
+        packet_handler.setFormatter(packet_formatter)
+        packet_handlers.append(packet_handler)
+    packet_log_due.enabled = bool(packet_handlers)
+    packet_log_due.every = max(packet_sample, 1)
+
+    for name, logger in (('service', service_logger), ('packet', packet_logger)):
+        rate = rate_limits.get(name, 0)
+        if rate:
+            logger.addFilter(RateLimitFilter(rate))
+
+    if mode == 'async':
+        # Форматы не используют поток, процесс и место вызова (%(pathname)s, %(lineno)d), поэтому
+        # LogRecord не собирает сведения о потоке и процессе (документированные флаги logging)
+        logging.logThreads = False
+        logging.logProcesses = False
+        logging.logMultiprocessing = False
+        log_queue = queue.SimpleQueue()
+        # Сообщения сервиса форматируются при вызове, как в QueueHandler: аргументы (словари,
+        # списки, статистика) могут измениться до записи в фоновом потоке
+        service_queue_handler = QueueHandler(log_queue)
+        packet_queue_handler = _DeferredQueueHandler(log_queue)
+        for handler in service_handlers:
+            handler.addFilter(lambda record: record.name == 'service')
+        for handler in packet_handlers:
+            handler.addFilter(lambda record: record.name == 'packet')
+        _listener = QueueListener(log_queue, *service_handlers, *packet_handlers, respect_handler_level=True)
+        _listener.start()
+        service_logger.addHandler(service_queue_handler)
+        if packet_handlers:
+            packet_logger.addHandler(packet_queue_handler)
+    else:
+        for handler in service_handlers:
+            service_logger.addHandler(handler)
+        for handler in packet_handlers:
+            packet_logger.addHandler(handler)
 
 # Экспортируем логгеры для использования в других модулях
-__all__ = ['init_loggers', 'service_logger', 'packet_logger']
\ No newline at end of file
+__all__ = ['init_loggers', 'service_logger', 'packet_logger', 'packet_log_due', 'read_packet_log']
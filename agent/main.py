@@ -1,29 +1,35 @@
+import argparse
 import signal
-from threading import Thread, Lock, Event
-from queue import Queue
-from collections import defaultdict
+import sys
+import _thread
+import multiprocessing
+from threading import Thread, Event
 from logger_config import init_loggers, service_logger
 from interface_selector import NetworkInterfaceSelector
-from traffic_stats import TrafficStats
-from packet_processor import periodic_analysis
-from robust_sniff import robust_sniff
-from autoencoder import AutoEncoder
-from simple_lstm import SimpleLSTM
+from traffic_stats import TrafficStats, HostTable
+from stats_table import ShardedStatsTable, STATS_SHARDS
+from packet_processor import periodic_analysis, flush_flows
+from flow_table import FlowTable, FLOW_COLUMNS, FLOW_STORE_DIR
+from window_scheduler import parse_resolutions, WINDOW_COLUMNS, WINDOW_RESOLUTIONS, WINDOW_STORE_DIR
+from robust_sniff import CaptureWorkers
+from capture_filter import CaptureFilter, CAPTURE_FILTER
+from uploader import AnomalyUploader
+from diagnostics import diagnostics
+from shm_ring import SharedRing, SharedFeatureQueue
+from feature_queue import FeatureQueue
+import numpy_inference
+import model_registry
+import metrics
+from training_data import TrainingDataFetcher
+from feature_store import FeatureStore
 import os
 import numpy as np
-import pandas as pd
-from sqlalchemy import create_engine, text
-import psycopg2
-from psycopg2 import pool
-import joblib
 import time
 from dotenv import load_dotenv
-import tensorflow as tf
-import asyncio
-import aiohttp
-from sklearn.utils.validation import check_is_fitted
 import warnings
-from datetime import datetime
+
+# Тяжёлые модули (tensorflow, sklearn, pandas, joblib, aiohttp, scapy) импортируются
+# там, где они нужны: захват стартует сразу, модели загружаются в фоновом потоке.
 
 warnings.filterwarnings("ignore", category=UserWarning)
 
@@ -37,10 +43,15 @@ HIDDEN_LAYERS = 10
 MIN_CONN = 1
 MAX_CONN = 7
 RETRAIN_INTERVAL = 60 * 60  # 20 минут в секундах
+INFERENCE_BACKEND = 'keras'  # keras или numpy (артефакты saved_ml/*.npz, без TensorFlow)
+AGENT_MODE = 'threads'  # threads - всё в одном процессе, processes - инференс в отдельном процессе
+MODEL_POLL_INTERVAL = 10  # Как часто проверять saved_ml/CURRENT на смену версии моделей
+FEATURE_STORE = 'on'  # on - окна и оценки сохраняются локально в feature_store/, off - нет
+TRAINING_SOURCE = 'server'  # server - переобучение на данных менеджера, local - на локальном хранилище
+TRAINING_WINDOW_HOURS = 24  # Глубина локальных данных для переобучения
+FLOW_TABLE = 'on'  # on - учёт потоков по 5-кортежу, завершённые потоки пишутся в flow_store/
 
 db_pool = None
-stats_lock = Lock()
-data_queue = Queue()
 stop_event = Event()
 
 ip = ''
@@ -55,6 +66,9 @@ DB_CONFIG = {
 TABLE_NAME = os.getenv('TABLE_NAME', 'traffic_with_anomalies')
 
 
+def numpy_backend():
+    return os.getenv('INFERENCE_BACKEND', INFERENCE_BACKEND).lower() == 'numpy'
+
 
 def load_or_train_autoencoder(
     model_path='saved_ml/autoencoder_model.keras',
@@ -62,8 +76,15 @@ def load_or_train_autoencoder(
     minmax_scaler_path='saved_ml/autoencoder_minmax_scaler.pkl'
 ):
     try:
-        init_loggers()
         service_logger.info("Инициализация load_or_train_autoencoder")
+        from autoencoder import AutoEncoder
+
+        if numpy_backend():
+            ae = numpy_inference.load_autoencoder()
+            if ae is not None:
+                service_logger.info(f"AutoEncoder загружен для NumPy-инференса: {numpy_inference.AE_ARTIFACT}")
+                return ae
+            service_logger.warning(f"Артефакт {numpy_inference.AE_ARTIFACT} не найден, используется Keras")
 
         #service_logger.warning(f"Таблица '{TABLE_NAME}' отсутствует. Запуск без предварительного обучения.")
         service_logger.info("Модель Autoencoder обучена")
@@ -72,6 +93,7 @@ def load_or_train_autoencoder(
         dummy_data = np.random.rand(10, 10)
         ae.robust_scaler.fit(dummy_data)
         ae.minmax_scaler.fit(ae.robust_scaler.transform(dummy_data))
+        ae.freeze_scalers()
         #service_logger.info("Scalers AutoEncoder обучены на случайных данных")
         return ae
         
@@ -80,18 +102,23 @@ def load_or_train_autoencoder(
         if choice == 'n':
             if os.path.exists(model_path) and os.path.exists(robust_scaler_path) and os.path.exists(minmax_scaler_path):
                 service_logger.info(f"Попытка загрузки модели AutoEncoder из {model_path}")
+                import joblib
+                import tensorflow as tf
                 ae_model = tf.keras.models.load_model(model_path)
                 ae = AutoEncoder(input_dim=10, encoding_dim=4, hidden_layers=[32, 16, 8])
                 ae.autoencoder = ae_model
                 ae.autoencoder.compile(optimizer='adam', loss='mae')
                 ae.robust_scaler = joblib.load(robust_scaler_path)
                 ae.minmax_scaler = joblib.load(minmax_scaler_path)
+                ae.freeze_scalers()
                 service_logger.info("Модель AutoEncoder и scalers успешно загружены")
                 return ae
             else:
                 service_logger.warning("Файлы модели или scalers отсутствуют. Переход к обучению.")
         
         service_logger.info("Начало обучения новой модели AutoEncoder")
+        import joblib
+        import pandas as pd
         with engine.connect() as conn:
             df = pd.read_sql_table(TABLE_NAME, conn)
         if df.empty:
@@ -101,6 +128,7 @@ def load_or_train_autoencoder(
             dummy_data = np.random.rand(10, 10)
             ae.robust_scaler.fit(dummy_data)
             ae.minmax_scaler.fit(ae.robust_scaler.transform(dummy_data))
+            ae.freeze_scalers()
             service_logger.info("Scalers AutoEncoder обучены на случайных данных")
             return ae
         
@@ -125,6 +153,14 @@ def load_or_train_lstm(model_path='saved_ml/lstm_model.keras', scaler_path='save
         sequence_length = 3
         
         service_logger.info("Инициализация load_or_train_lstm")
+        from simple_lstm import SimpleLSTM
+
+        if numpy_backend():
+            lstm = numpy_inference.load_lstm()
+            if lstm is not None:
+                service_logger.info(f"LSTM загружен для NumPy-инференса: {numpy_inference.LSTM_ARTIFACT}")
+                return lstm
+            service_logger.warning(f"Артефакт {numpy_inference.LSTM_ARTIFACT} не найден, используется Keras")
 
         #service_logger.warning(f"Таблица '{TABLE_NAME}' отсутствует. Запуск без предварительного обучения.")
         service_logger.info("Модель LSTM обучена")
@@ -140,11 +176,12 @@ def load_or_train_lstm(model_path='saved_ml/lstm_model.keras', scaler_path='save
         if choice == 'n':
             lstm = SimpleLSTM.load_model(model_path, scaler_path)
             if lstm:
-                service_logger.debug(f"Scaler LSTM загружен: {hasattr(lstm.scaler, 'center_')}")
+                service_logger.debug("Scaler LSTM загружен: %s", hasattr(lstm.scaler, 'center_'))
                 return lstm
             service_logger.warning("Не удалось загрузить LSTM. Переход к обучению.")
         
         service_logger.info("Начало обучения новой модели LSTM")
+        import pandas as pd
         with engine.connect() as conn:
             df = pd.read_sql_table(TABLE_NAME, conn)
         if df.empty:
@@ -183,194 +220,191 @@ def load_or_train_lstm(model_path='saved_ml/lstm_model.keras', scaler_path='save
         service_logger.error(f"Ошибка в load_or_train_lstm: {e}", exc_info=True)
         return None
 
-async def get_data_from_server(page=1, page_size=100):
-    url = f"http://{ip}:3000/pgadmin/anomalies?page={page}&page_size={page_size}"
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url) as response:
-            if response.status == 200:
-                data = await response.json()
-                service_logger.info(f"Получено {len(data['data'])} записей со страницы {page}")
-                return data['data']
-            else:
-                service_logger.error(f"Ошибка получения данных: {response.status} - {await response.text()}")
-                return []
-
-async def fetch_all_data():
-    page = 1
-    page_size = 100
-    all_data = []
-    
-    while True:
-        data = await get_data_from_server(page, page_size)
-        if not data:
-            break
-        all_data.extend(data)
-        page += 1
-    return all_data
-
-def retrain_models(ae, lstm, stop_event):
-    while True:
+def retrain_models(registry, stop_event):
+    """Переобучение в отдельном процессе на снимке данных; текущие модели продолжают оценку"""
+    from concurrent.futures import ProcessPoolExecutor
+    context = multiprocessing.get_context('spawn')
+    # С сервера запрашиваются только записи новее последней полученной, остальные берутся из кэша
+    fetcher = TrainingDataFetcher(f"http://{ip}:3000/pgadmin/anomalies/export")
+    store = FeatureStore()
+    while not stop_event.wait(RETRAIN_INTERVAL):
         try:
-            time.sleep(RETRAIN_INTERVAL)
             service_logger.info("Запуск переобучения моделей...")
-            stop_event.set()
-            
-            data = asyncio.run(fetch_all_data())
-            if not data:
+            if os.getenv('TRAINING_SOURCE', TRAINING_SOURCE).lower() == 'local':
+                hours = float(os.getenv('TRAINING_WINDOW_HOURS', TRAINING_WINDOW_HOURS))
+                X = store.training_matrix(start=time.time() - hours * 3600)
+            else:
+                X = fetcher.update()
+            if not len(X):
                 service_logger.warning("Данные с сервера не получены, переобучение пропущено")
-                stop_event.clear()
                 continue
             
-            df = pd.DataFrame(data)
-            df = df.sort_values(by='timestamp')
-            X = df[['fl_byt_s', 'fl_pck_s', 'fwd_max_pack_size', 'fwd_avg_packet',
-                    'bck_max_pack_size', 'bck_avg_packet', 'fw_iat_std', 'fw_iat_min',
-                    'bck_iat_std', 'bck_iat_min']].values
-            
-            ae.train(X, epochs=LEARNING_EPOCH_AE, batch_size=BATCH_SIZE, threshold_percentile=90)
-            ae.autoencoder.save('saved_ml/autoencoder_model.keras')
-            joblib.dump(ae.robust_scaler, 'saved_ml/autoencoder_robust_scaler.pkl')
-            joblib.dump(ae.minmax_scaler, 'saved_ml/autoencoder_minmax_scaler.pkl')
-            service_logger.info("AutoEncoder переобучен и сохранён")
-            
-            lstm.train(X, epochs=LEARNING_EPOCH_LSTM, batch_size=BATCH_SIZE, threshold_percentile=90)
-            lstm.save_model('saved_ml/lstm_model.keras', 'saved_ml/lstm_scaler.pkl')
-            service_logger.info("LSTM переобучен и сохранён")
-            
-            stop_event.clear()
-            service_logger.info("Переобучение завершено")
+            # Свежий процесс на каждое обучение: память TensorFlow освобождается вместе с ним
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                version = pool.submit(model_registry.train_version, X, LEARNING_EPOCH_AE,
+                                      LEARNING_EPOCH_LSTM, BATCH_SIZE).result()
+            model_registry.publish(version)
+            if registry.swap(version):
+                service_logger.info(f"Переобучение завершено, версия моделей {version}")
         
         except Exception as e:
             service_logger.error(f"Ошибка в retrain_models: {e}", exc_info=True)
-            time.sleep(5)
 
-async def send_data_to_server(session, url, data):
-    try:
-        async with session.post(url, json=data, headers={'Content-Type': 'application/json'}, timeout=aiohttp.ClientTimeout(total=10)) as response:
-            if response.status == 200:
-                service_logger.info(f"Данные успешно отправлены на сервер: {url}")
-            else:
-                service_logger.warning(f"Ошибка при отправке данных на сервер: {response.status} - {await response.text()}")
-    except asyncio.TimeoutError:
-        service_logger.error(f"Тайм-аут при отправке данных на сервер: {url}")
-    except aiohttp.ClientError as e:
-        service_logger.error(f"Не удалось отправить данные на сервер: {e}")
-
-def predict_and_save_anomalies(ae, lstm, interval, data_queue, stop_event):
-    EXPRESS_SERVER_URL = f"http://{ip}:3000/pgadmin/anomalies"
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-
-    while True:
-        if stop_event.is_set():
-            time.sleep(5)
+def watch_models(registry, stop_event):
+    """Подхват версии из saved_ml/CURRENT, изменённой другим процессом или вручную (откат)"""
+    while not stop_event.wait(MODEL_POLL_INTERVAL):
+        try:
+            registry.poll()
+        except Exception as e:
+            service_logger.error(f"Ошибка проверки версии моделей: {e}", exc_info=True)
+
+def score_batch(ae, lstm, data, store=None):
+    """Проверка пачки признаков из очереди и оценка аномалий; список записей для сервера или None"""
+    import pandas as pd
+
+    # Логирование структуры данных для диагностики
+    service_logger.debug("Структура данных из data_queue: %s", data)
+    service_logger.debug("Тип данных: %s", type(data))
+
+    # Проверяем, что данные - список словарей
+    if not isinstance(data, list):
+        service_logger.error(f"Данные из очереди не являются списком: {type(data)}")
+        return None
+
+    # Проверяем корректность каждого элемента
+    processed_data = []
+    feature_names = ['fl_byt_s', 'fl_pck_s', 'fwd_max_pack_size', 'fwd_avg_packet',
+                     'bck_max_pack_size', 'bck_avg_packet', 'fw_iat_std', 'fw_iat_min',
+                     'bck_iat_std', 'bck_iat_min', 'packet_count']
+
+    for item in data:
+        if not isinstance(item, dict):
+            service_logger.warning(f"Элемент не является словарем: {item}")
+            continue
+        if 'ip' not in item or 'timestamp' not in item:
+            service_logger.warning(f"Отсутствуют обязательные ключи в элементе: {item}")
+            continue
+        if not all(feature in item for feature in feature_names):
+            service_logger.warning(f"Отсутствуют необходимые признаки в элементе: {item}")
             continue
+        processed_data.append(item)
 
-        try:
-            while data_queue.empty():
-                time.sleep(1)
-            data = data_queue.get()
-            if not data:
-                data_queue.task_done()
-                continue
+    if not processed_data:
+        service_logger.warning("Нет корректных данных для обработки")
+        return None
 
-            # Логирование структуры данных для диагностики
-            service_logger.debug(f"Структура данных из data_queue: {data}")
-            service_logger.debug(f"Тип данных: {type(data)}")
+    # Создаем DataFrame
+    df = pd.DataFrame(processed_data)
+    if 'timestamp' not in df.columns:
+        service_logger.error("Столбец 'timestamp' отсутствует в DataFrame")
+        return None
 
-            # Проверяем, что данные - список словарей
-            if not isinstance(data, list):
-                service_logger.error(f"Данные из очереди не являются списком: {type(data)}")
-                data_queue.task_done()
-                continue
+    # Сортировка по времени
+    df = df.sort_values(by='timestamp')
+    X = df[feature_names].values
+    timestamps = df['timestamp'].values
+    ips = df['ip'].values
 
-            # Проверяем корректность каждого элемента
-            processed_data = []
-            feature_names = ['fl_byt_s', 'fl_pck_s', 'fwd_max_pack_size', 'fwd_avg_packet',
-                             'bck_max_pack_size', 'bck_avg_packet', 'fw_iat_std', 'fw_iat_min',
-                             'bck_iat_std', 'bck_iat_min', 'packet_count']
-
-            for item in data:
-                if not isinstance(item, dict):
-                    service_logger.warning(f"Элемент не является словарем: {item}")
-                    continue
-                if 'ip' not in item or 'timestamp' not in item:
-                    service_logger.warning(f"Отсутствуют обязательные ключи в элементе: {item}")
-                    continue
-                if not all(feature in item for feature in feature_names):
-                    service_logger.warning(f"Отсутствуют необходимые признаки в элементе: {item}")
-                    continue
-                processed_data.append(item)
-
-            if not processed_data:
-                service_logger.warning("Нет корректных данных для обработки")
-                data_queue.task_done()
-                continue
+    # Проверка наличия данных для анализа
+    if X.size == 0:
+        service_logger.warning("Нет данных для анализа аномалий")
+        return None
 
-            # Создаем DataFrame
-            df = pd.DataFrame(processed_data)
-            if 'timestamp' not in df.columns:
-                service_logger.error("Столбец 'timestamp' отсутствует в DataFrame")
-                data_queue.task_done()
+    # Используем только первые 10 признаков для анализа аномалий, исключая packet_count
+    with metrics.MODEL_SECONDS.labels('ae').time():
+        anomalies_ae, errors_ae, _ = ae.detect_anomalies(X[:, :10]) if ae else [None] * len(X)
+    # Каждый IP оценивается по своей истории окон, а не по соседним строкам чужих хостов
+    with metrics.MODEL_SECONDS.labels('lstm').time():
+        anomalies_lstm, errors_lstm, _ = lstm.score_sequences(ips, X[:, :10]) if lstm else [0] * len(X)
+    metrics.SCORED_RECORDS.inc(len(X))
+    metrics.ANOMALIES.labels('ae').inc(int(np.sum(np.asarray(anomalies_ae) == 1)))
+    metrics.ANOMALIES.labels('lstm').inc(int(np.sum(np.asarray(anomalies_lstm) == 1)))
+
+    if store is not None:
+        try:
+            consensus = (np.asarray(anomalies_ae) == 1) & (np.asarray(anomalies_lstm) == 1)
+            store.append_batch(ips, timestamps, X, errors_ae, errors_lstm, anomalies_ae, anomalies_lstm, consensus)
+        except Exception as e:
+            service_logger.error(f"Ошибка записи в хранилище признаков: {e}", exc_info=True)
+
+    results = []
+    for i in range(len(X)):
+        anomaly_ae = anomalies_ae[i] if anomalies_ae is not None else None
+        anomaly_lstm = anomalies_lstm[i] if anomalies_lstm is not None else 0
+        anomaly_consensus = 1 if (anomaly_ae == 1 and anomaly_lstm == 1) else 0
+
+        features = X[i].tolist()
+        result = {
+            'user_id': 1,
+            'ip': ips[i],
+            'timestamp': str(timestamps[i]),
+            'fl_byt_s': features[0],
+            'fl_pck_s': features[1],
+            'fwd_max_pack_size': features[2],
+            'fwd_avg_packet': features[3],
+            'bck_max_pack_size': features[4],
+            'bck_avg_packet': features[5],
+            'fw_iat_std': features[6],
+            'fw_iat_min': features[7],
+            'bck_iat_std': features[8],
+            'bck_iat_min': features[9],
+            'packet_count': int(features[10]),
+            'anomaly_ae': int(anomaly_ae) if anomaly_ae is not None else None,
+            'anomaly_lstm': int(anomaly_lstm),
+            'anomaly_consensus': int(anomaly_consensus)
+        }
+        results.append(result)
+    return results
+
+def load_models(registry, models_ready, stop_event, feature_queue):
+    """Загрузка моделей в фоне, пока уже идёт захват; пачки признаков тем временем ждут в очереди"""
+    started = time.perf_counter()
+    if not registry.load_current():
+        ae = load_or_train_autoencoder()
+        lstm = load_or_train_lstm() if ae is not None else None
+        if ae is None or lstm is None:
+            service_logger.critical("Не удалось инициализировать модели. Программа завершена.")
+            _thread.interrupt_main()
+            return
+        registry.install(None, ae, lstm)
+
+    service_logger.info(f"Модели загружены за {time.perf_counter() - started:.1f} с, "
+                        f"версия {registry.current[0]}, записей в очереди: {feature_queue.qsize()}")
+    models_ready.set()
+
+    Thread(target=watch_models, args=(registry, stop_event), daemon=True, name="ModelWatchThread").start()
+    if isinstance(registry.current[1].autoencoder, numpy_inference.SequentialNet):
+        service_logger.info("NumPy-инференс: переобучение на этом агенте отключено")
+        return
+    service_logger.info("Запуск потока переобучения")
+    Thread(target=retrain_models, args=(registry, stop_event), daemon=True, name="RetrainThread").start()
+
+def predict_and_save_anomalies(registry, models_ready, interval, data_queue, stop_event, uploader, store=None):
+    # До загрузки моделей пачки накапливаются в очереди и оцениваются после
+    models_ready.wait()
+    while not stop_event.is_set():
+        try:
+            # Ожидание без опроса; накопившиеся пачки склеиваются в один вызов моделей.
+            # Тайм-аут нужен только для проверки stop_event
+            data = data_queue.get_batch(timeout=interval)
+            if not data:
                 continue
 
-            # Сортировка по времени
-            df = df.sort_values(by='timestamp')
-            X = df[feature_names].values
-            timestamps = df['timestamp'].values
-            ips = df['ip'].values
-
-            # Проверка наличия данных для анализа
-            if X.size == 0:
-                service_logger.warning("Нет данных для анализа аномалий")
-                data_queue.task_done()
+            # Пара моделей читается одним кортежем: подмена версии не смешает старую и новую
+            _, ae, lstm = registry.current
+            with metrics.SCORE_BATCH_SECONDS.time():
+                results = score_batch(ae, lstm, data, store)
+            if not results:
                 continue
 
-            # Используем только первые 10 признаков для анализа аномалий, исключая packet_count
-            anomalies_ae, _, _ = ae.detect_anomalies(X[:, :10]) if ae else [None] * len(X)
-            anomalies_lstm, _, _ = lstm.detect_anomalies(X[:, :10]) if lstm else [0] * len(X)
-
-            results = []
-            for i in range(len(X)):
-                anomaly_ae = anomalies_ae[i] if anomalies_ae is not None else None
-                anomaly_lstm = anomalies_lstm[i] if anomalies_lstm is not None else 0
-                anomaly_consensus = 1 if (anomaly_ae == 1 and anomaly_lstm == 1) else 0
-
-                features = X[i].tolist()
-                result = {
-                    'user_id': 1,
-                    'ip': ips[i],
-                    'timestamp': str(timestamps[i]),
-                    'fl_byt_s': features[0],
-                    'fl_pck_s': features[1],
-                    'fwd_max_pack_size': features[2],
-                    'fwd_avg_packet': features[3],
-                    'bck_max_pack_size': features[4],
-                    'bck_avg_packet': features[5],
-                    'fw_iat_std': features[6],
-                    'fw_iat_min': features[7],
-                    'bck_iat_std': features[8],
-                    'bck_iat_min': features[9],
-                    'packet_count': int(features[10]),
-                    'anomaly_ae': int(anomaly_ae) if anomaly_ae is not None else None,
-                    'anomaly_lstm': int(anomaly_lstm),
-                    'anomaly_consensus': int(anomaly_consensus)
-                }
-                results.append(result)
-
-            async def run_async_tasks():
-                async with aiohttp.ClientSession() as session:
-                    await send_data_to_server(session, EXPRESS_SERVER_URL, results)
-            loop.run_until_complete(run_async_tasks())
-
-            data_queue.task_done()
-            service_logger.info(f"Отправлено {len(results)} записей на сервер")
+            # Отправка идёт в фоновом потоке и не задерживает следующую пачку
+            uploader.submit(results)
+            registry.save_live()
 
         except Exception as e:
             service_logger.error(f"Ошибка в predict_and_save_anomalies: {e}", exc_info=True)
             time.sleep(interval)
-
-    loop.close()
+    registry.save_live(force=True)
 
 def cleanup(signum, frame):
     global db_pool
@@ -382,59 +416,158 @@ def cleanup(signum, frame):
         service_logger.info("Все соединения с PostgreSQL закрыты")
     exit(0)
 
-def main(ae, lstm):
+def start_inference(feature_queue):
+    """Загрузка моделей, оценка и отправка результатов в потоках текущего процесса"""
+    uploader = AnomalyUploader(f"http://{ip}:3000/pgadmin/anomalies").start()
+    registry = model_registry.ModelRegistry(numpy_backend())
+    models_ready = Event()
+    store = FeatureStore() if os.getenv('FEATURE_STORE', FEATURE_STORE).lower() == 'on' else None
+
+    model_thread = Thread(
+        target=load_models,
+        args=(registry, models_ready, stop_event, feature_queue),
+        daemon=True,
+        name="ModelLoadThread"
+    )
+    predict_thread = Thread(
+        target=predict_and_save_anomalies,
+        args=(registry, models_ready, PREDICT_INTERVAL, feature_queue, stop_event, uploader, store),
+        daemon=True,
+        name="PredictThread"
+    )
+    service_logger.info("Загрузка моделей в фоне")
+    model_thread.start()
+    service_logger.info("Запуск потока предсказания")
+    predict_thread.start()
+    return uploader
+
+def inference_process(ring_name, ring_semaphore, manager_ip, stop):
+    """Процесс инференса: читает пачки признаков из разделяемой памяти, оценивает и отправляет"""
+    global ip
+    ip = manager_ip
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    init_loggers(packet_format='off', service_file='log_files/service_inference.log')
+    diagnostics.configure()
+    # Метрики процесса инференса - на следующем порту после эндпоинта процесса захвата
+    port = int(os.getenv('METRICS_PORT', metrics.METRICS_PORT))
+    if port:
+        metrics.start_http_server(port + 1)
+    ring = SharedRing.attach(ring_name, semaphore=ring_semaphore)
+    uploader = None
+    try:
+        uploader = start_inference(SharedFeatureQueue(ring))
+        stop.wait()
+    except Exception as e:
+        service_logger.critical(f"Критическая ошибка в процессе инференса: {e}", exc_info=True)
+    finally:
+        stop_event.set()
+        if uploader:
+            uploader.stop()
+        ring.close()
+
+def start_inference_process():
+    """Запуск процесса инференса; захват передаёт ему признаки через кольцо в разделяемой памяти"""
+    context = multiprocessing.get_context('spawn')
+    ring = SharedRing.create(semaphore=context.Semaphore(0))
+    stop = context.Event()
+    process = context.Process(
+        target=inference_process,
+        args=(ring.name, ring.semaphore, ip, stop),
+        # Не демон: процессу инференса нужен дочерний процесс переобучения
+        daemon=False,
+        name="InferenceProcess"
+    )
+    process.start()
+    service_logger.info(f"Процесс инференса запущен, pid {process.pid}")
+    return process, stop, ring
+
+def main():
+    uploader = None
+    inference = None
+    flows = flow_store = None
+    capture_filter = None
     try:
         init_loggers()
+        diagnostics.configure()
         signal.signal(signal.SIGINT, cleanup)
         signal.signal(signal.SIGTERM, cleanup)
 
         service_logger.info("Запуск анализа сетевого трафика")
-        stats_dict = defaultdict(TrafficStats)
-        selector = NetworkInterfaceSelector()
-        interface_info = None
-
-        if selector.get_network_interfaces():
+        metrics.start_http_server()
+        stats_table = ShardedStatsTable(STATS_SHARDS)
+        # История по IP ограничена: HOST_TTL_SECONDS простоя и не больше MAX_HOSTS записей
+        stats_dict = HostTable(TrafficStats)
+        if os.getenv('FLOW_TABLE', FLOW_TABLE).lower() == 'on':
+            # Каждый пакет обновляет одну запись потока; признаки по IP считаются как прежде
+            flows = FlowTable()
+            flow_store = FeatureStore(FLOW_STORE_DIR, columns=FLOW_COLUMNS)
+        # Окна остальных разрешений собираются из окон наименьшего и пишутся в window_store/<секунды>s
+        resolutions = parse_resolutions(os.getenv('WINDOW_RESOLUTIONS', WINDOW_RESOLUTIONS), INTERVAL_SECONDS)
+        window_stores = {resolution: FeatureStore(os.path.join(WINDOW_STORE_DIR, f"{resolution:g}s"),
+                                                  columns=WINDOW_COLUMNS)
+                         for resolution in resolutions if resolution != INTERVAL_SECONDS}
+        service_logger.info(f"Разрешения окон, с: {', '.join(f'{resolution:g}' for resolution in resolutions)}")
+        if os.getenv('CAPTURE_FILTER', CAPTURE_FILTER).lower() != 'off':
+            # Не-IPv4 и скрытые на сервере хосты отбрасываются ядром; список обновляется в фоне
+            capture_filter = CaptureFilter(f"http://{ip}:3000")
+            Thread(target=capture_filter.run, args=(stop_event,), daemon=True, name="CaptureFilterThread").start()
+        # Интерфейсы или шаблоны из CAPTURE_INTERFACES (--interfaces); без них - выбор в консоли
+        interfaces = os.getenv('CAPTURE_INTERFACES', '').strip()
+        if not interfaces:
+            if not sys.stdin.isatty():
+                service_logger.critical("Не заданы интерфейсы захвата: CAPTURE_INTERFACES или --interfaces")
+                return
+            selector = NetworkInterfaceSelector()
+            if not selector.get_network_interfaces():
+                service_logger.info("Выбор интерфейса отменён")
+                return
             selector.print_selected_interface()
-            interface_info = selector.get_selected_info()
+            interfaces = selector.get_selected_info()['interface_name']
+
+        mode = os.getenv('AGENT_MODE', AGENT_MODE).lower()
+        service_logger.info(f"Режим агента: {mode}")
+        if mode == 'processes':
+            # Инференс и обучение не конкурируют с захватом за GIL
+            inference = start_inference_process()
+            feature_queue = SharedFeatureQueue(inference[2])
         else:
-            service_logger.info("Выбор интерфейса отменён")
-            return
+            # Ограниченная очередь: при отставании инференса действует FEATURE_QUEUE_POLICY
+            feature_queue = FeatureQueue()
+        service_logger.info(f"Очередь признаков: политика переполнения {feature_queue.policy}")
+        metrics.QUEUE_DEPTH.set_function(feature_queue.qsize)
+        metrics.QUEUE_DROPS.labels(feature_queue.policy).set_function(lambda: feature_queue.dropped)
 
         analysis_thread = Thread(
             target=periodic_analysis,
-            args=(stats_dict, INTERVAL_SECONDS, stats_lock, ae, data_queue, stop_event),
+            args=(stats_table, stats_dict, INTERVAL_SECONDS, feature_queue, stop_event, flows, flow_store,
+                  window_stores),
             daemon=True,
             name="AnalysisThread"
         )
-        predict_thread = Thread(
-            target=predict_and_save_anomalies,
-            args=(ae, lstm, PREDICT_INTERVAL, data_queue, stop_event),
-            daemon=True,
-            name="PredictThread"
-        )
-        retrain_thread = Thread(
-            target=retrain_models,
-            args=(ae, lstm, stop_event),
-            daemon=True,
-            name="RetrainThread"
-        )
+        # Поток захвата на каждый интерфейс; все пишут в общие stats_table и flows
+        workers = CaptureWorkers(interfaces, stats_table, stop_event, flows, capture_filter)
         sniff_thread = Thread(
-            target=robust_sniff,
-            args=(interface_info['interface_name'] if interface_info else None, stats_dict, stats_lock, stop_event),
+            target=workers.run,
             daemon=True,
             name="SniffThread"
         )
 
-        service_logger.info("Запуск потока анализа")
-        analysis_thread.start()
-        service_logger.info("Запуск потока предсказания")
-        predict_thread.start()
-        service_logger.info("Запуск потока переобучения")
-        retrain_thread.start()
+        # Захват и анализ окон стартуют сразу, модели догружаются параллельно
         service_logger.info("Запуск потока сниффинга")
         sniff_thread.start()
+        service_logger.info("Запуск потока анализа")
+        analysis_thread.start()
 
-        sniff_thread.join()
+        if inference is None:
+            uploader = start_inference(feature_queue)
+            sniff_thread.join()
+        else:
+            process = inference[0]
+            while sniff_thread.is_alive():
+                sniff_thread.join(1)
+                if not process.is_alive():
+                    service_logger.critical(f"Процесс инференса завершился с кодом {process.exitcode}")
+                    break
 
     except KeyboardInterrupt:
         service_logger.info("Завершение работы по сигналу пользователя")
@@ -443,24 +576,45 @@ def main(ae, lstm):
         raise
     finally:
         stop_event.set()
+        if uploader:
+            # Неотправленные пачки остаются в локальной очереди на диске
+            uploader.stop()
+        if inference:
+            process, stop, ring = inference
+            stop.set()
+            process.join(15)
+            if process.is_alive():
+                process.terminate()
+            ring.close()
+        if flows is not None:
+            try:
+                # Незавершённые потоки записываются как есть
+                flush_flows(flows, flow_store, time.time(), flush=True)
+            except Exception as e:
+                service_logger.error(f"Ошибка записи потоков: {e}", exc_info=True)
         time.sleep(2)
         service_logger.info("Все потоки завершены")
 
 if __name__ == "__main__":
-    load_dotenv(override=True)
-
-    ip = input("Введите ip адрес менеджера: ")
-
-    ae = load_or_train_autoencoder()
-    if ae is None:
-        service_logger.error("Не удалось инициализировать AutoEncoder. Программа завершена.")
-        exit(1)
-    
-    lstm = load_or_train_lstm()
-    if lstm is None:
-        service_logger.error("Не удалось инициализировать LSTM. Программа завершена.")
-        exit(1)
-    
-    main(ae, lstm)
+    # В сборке PyInstaller дочерние процессы spawn (инференс, переобучение) запускают тот же exe
+    multiprocessing.freeze_support()
+    parser = argparse.ArgumentParser(description="Агент анализа сетевого трафика")
+    parser.add_argument('--config', help="Файл настроек в формате .env (по умолчанию .env агента)")
+    parser.add_argument('--manager-ip', help="IP менеджера (иначе MANAGER_IP или запрос в консоли)")
+    parser.add_argument('--interfaces',
+                        help="Интерфейсы или шаблоны через запятую, например eth0,enp* (иначе CAPTURE_INTERFACES)")
+    args = parser.parse_args()
+    load_dotenv(args.config, override=True)
+    # Аргументы командной строки важнее файла настроек и окружения
+    if args.interfaces:
+        os.environ['CAPTURE_INTERFACES'] = args.interfaces
+
+    ip = args.manager_ip or os.getenv('MANAGER_IP', '').strip()
+    if not ip:
+        if not sys.stdin.isatty():
+            sys.exit("Не задан IP менеджера: MANAGER_IP или --manager-ip")
+        ip = input("Введите ip адрес менеджера: ")
+
+    main()
     if db_pool:
         db_pool.closeall()
\ No newline at end of file
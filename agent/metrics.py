@@ -0,0 +1,255 @@
+# Метрики конвейера агента (счётчики, показатели, гистограммы) и HTTP-эндпоинт в формате Prometheus
+#
+#   curl http://127.0.0.1:9108/metrics
+#
+# Обновление метрики - несколько операций над атрибутами без блокировок: каждую метрику
+# (или её вариант с метками) обновляет один поток, а HTTP-поток только читает значения.
+
+import os
+import threading
+import time
+from bisect import bisect_left
+from logger_config import service_logger
+
+METRICS_PORT = 9108             # 0 - эндпоинт выключен
+METRICS_ADDR = '127.0.0.1'      # Только локальный доступ
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Counter:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self, name, labels):
+        yield name, labels, self.value
+
+
+class Gauge:
+    """Текущее значение; set_function - значение вычисляется при чтении (глубина очереди и т. п.)"""
+    __slots__ = ('value', 'function')
+
+    def __init__(self):
+        self.value = 0
+        self.function = None
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def set_function(self, function):
+        self.function = function
+
+    def samples(self, name, labels):
+        value = self.value
+        if self.function is not None:
+            try:
+                value = self.function()
+            except Exception:
+                value = float('nan')
+        yield name, labels, value
+
+
+class Histogram:
+    """Гистограмма с фиксированными границами: observe - bisect и два сложения"""
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.bounds = tuple(buckets)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def time(self):
+        return _Timer(self)
+
+    def samples(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(self.bounds + (float('inf'),), self.counts):
+            cumulative += count
+            yield f'{name}_bucket', labels + (('le', _format(bound)),), cumulative
+        yield f'{name}_sum', labels, self.sum
+        yield f'{name}_count', labels, self.count
+
+
+class _Timer:
+    __slots__ = ('histogram', 'start')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class MetricFamily:
+    """Метрика с именем и описанием; с метками - набор вариантов, создаваемых labels(...)"""
+
+    def __init__(self, kind, name, documentation, labelnames=(), factory=None):
+        self.kind = kind
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.factory = factory
+        self.children = {}
+        self.lock = threading.Lock()
+        self.metric = None if self.labelnames else factory()
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(values, self.factory())
+        return child
+
+    def collect(self):
+        if self.metric is not None:
+            yield from self.metric.samples(self.name, ())
+            return
+        for values, child in list(self.children.items()):
+            yield from child.samples(self.name, tuple(zip(self.labelnames, values)))
+
+
+class Registry:
+    def __init__(self):
+        self.families = {}
+        self.lock = threading.Lock()
+
+    def register(self, kind, name, documentation, labelnames, factory):
+        with self.lock:
+            family = self.families.get(name)
+            if family is None:
+                family = self.families[name] = MetricFamily(kind, name, documentation, labelnames, factory)
+            return family
+
+    def exposition(self):
+        """Текст в формате Prometheus 0.0.4"""
+        lines = []
+        for family in list(self.families.values()):
+            lines.append(f'# HELP {family.name} {family.documentation}')
+            lines.append(f'# TYPE {family.name} {family.kind}')
+            for name, labels, value in family.collect():
+                if labels:
+                    label_text = ','.join(f'{key}="{_escape(str(val))}"' for key, val in labels)
+                    lines.append(f'{name}{{{label_text}}} {_format(value)}')
+                else:
+                    lines.append(f'{name} {_format(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def _metric(family):
+    # Без меток возвращается сама метрика: на горячем пути нет лишнего уровня обращения
+    return family.metric if family.metric is not None else family
+
+
+def counter(name, documentation, labelnames=()):
+    return _metric(REGISTRY.register('counter', name, documentation, labelnames, Counter))
+
+
+def gauge(name, documentation, labelnames=()):
+    return _metric(REGISTRY.register('gauge', name, documentation, labelnames, Gauge))
+
+
+def histogram(name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+    return _metric(REGISTRY.register('histogram', name, documentation, labelnames, lambda: Histogram(buckets)))
+
+
+def _format(value):
+    if value != value:
+        return 'NaN'
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _escape(text):
+    return text.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def start_http_server(port=None, addr=None):
+    """Запуск эндпоинта /metrics в фоновом потоке; None, если METRICS_PORT=0 или порт занят"""
+    # http.server импортируется только при включённом эндпоинте и не замедляет запуск
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/metrics', '/'):
+                self.send_error(404)
+                return
+            body = REGISTRY.exposition().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    port = int(os.getenv('METRICS_PORT', METRICS_PORT)) if port is None else port
+    addr = os.getenv('METRICS_ADDR', METRICS_ADDR) if addr is None else addr
+    if not port:
+        return None
+    try:
+        server = ThreadingHTTPServer((addr, port), MetricsHandler)
+    except OSError as e:
+        service_logger.error(f"Эндпоинт метрик не запущен на {addr}:{port}: {e}")
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True, name="MetricsThread").start()
+    service_logger.info(f"Метрики: http://{addr}:{port}/metrics")
+    return server
+
+
+# Метрики стадий конвейера
+PACKETS = counter('agent_packets_total', "Пакеты IPv4, учтённые в окнах", ('interface',))
+CAPTURE_KERNEL_PACKETS = counter('agent_capture_kernel_packets_total', "Пакеты, полученные сокетом захвата",
+                                 ('interface',))
+CAPTURE_DROPS = counter('agent_capture_drops_total', "Пакеты, потерянные ядром при захвате", ('interface',))
+CAPTURE_WORKERS = gauge('agent_capture_workers', "Интерфейсы с работающим потоком захвата")
+CAPTURE_FILTER_NETWORKS = gauge('agent_capture_filter_networks', "Адреса и подсети, исключённые BPF-фильтром захвата")
+WINDOWS = counter('agent_windows_total', "Закрытые окна анализа")
+WINDOWS_SKIPPED = counter('agent_windows_skipped_total', "Границы окон, пропущенные из-за отставания анализа")
+WINDOW_RECORDS = counter('agent_window_records_total', "Записи признаков по IP из закрытых окон")
+WINDOW_CLOSE_SECONDS = histogram('agent_window_close_seconds', "Время закрытия окна и расчёта признаков по IP")
+TRACKED_HOSTS = gauge('agent_tracked_hosts', "IP с историей признаков")
+ACTIVE_FLOWS = gauge('agent_active_flows', "Активные потоки в таблице потоков")
+FINISHED_FLOWS = counter('agent_finished_flows_total', "Завершённые потоки, записанные в хранилище")
+QUEUE_DEPTH = gauge('agent_feature_queue_depth', "Записи в очереди признаков")
+QUEUE_DROPS = gauge('agent_feature_queue_dropped', "Записи, отброшенные при переполнении очереди признаков",
+                    ('policy',))
+QUEUE_BLOCKED_SECONDS = histogram('agent_feature_queue_blocked_seconds', "Ожидание места в очереди (политика block)")
+QUEUE_WAIT_SECONDS = histogram('agent_feature_queue_wait_seconds', "Время пачки в очереди до оценки")
+COALESCED_BATCHES = histogram('agent_feature_queue_coalesced_batches', "Пачки окон, склеенные в один вызов моделей",
+                              buckets=(1, 2, 3, 4, 6, 8, 12, 16, 32))
+SCORED_RECORDS = counter('agent_scored_records_total', "Записи, оценённые моделями")
+SCORE_BATCH_SECONDS = histogram('agent_score_batch_seconds', "Время оценки пачки целиком")
+MODEL_SECONDS = histogram('agent_model_inference_seconds', "Время оценки пачки моделью", ('model',))
+ANOMALIES = counter('agent_anomalies_total', "Записи, отмеченные моделью как аномальные", ('model',))
+UPLOAD_SECONDS = histogram('agent_upload_seconds', "Длительность запроса отправки на сервер")
+UPLOADED_RECORDS = counter('agent_uploaded_records_total', "Записи, принятые сервером")
+UPLOAD_FAILURES = counter('agent_upload_failures_total', "Неудачные запросы отправки")
+SPOOLED_RECORDS = counter('agent_spooled_records_total', "Записи, сохранённые в локальную очередь на диске")
+
+__all__ = ['Counter', 'Gauge', 'Histogram', 'REGISTRY', 'counter', 'gauge', 'histogram', 'start_http_server',
+           'METRICS_PORT']
@@ -0,0 +1,323 @@
+# Версии моделей в saved_ml/versions с атомарным переключением и откатом
+#
+#   python model_registry.py list        # версии, текущая помечена *
+#   python model_registry.py rollback    # вернуть предыдущую версию
+#   python model_registry.py use <имя>   # переключиться на указанную версию
+#
+# Работающий агент замечает смену указателя CURRENT и подменяет модели без остановки.
+
+import argparse
+import json
+import os
+import shutil
+import threading
+import time
+import numpy as np
+from logger_config import service_logger
+from quantile_sketch import TDigest
+
+MODELS_DIR = 'saved_ml'  # Модели без версии (load_or_train_* в main.py)
+VERSIONS_DIR = 'saved_ml/versions'
+CURRENT_FILE = 'saved_ml/CURRENT'
+MAX_VERSIONS = 5
+PROBE_ROWS = 256  # Строк обучающей выборки для проверки модели перед переключением
+LIVE_SAVE_INTERVAL = 300  # Как часто сохранять распределения ошибок при работе, секунд
+
+AE_MODEL = 'autoencoder_model.keras'
+AE_ROBUST_SCALER = 'autoencoder_robust_scaler.pkl'
+AE_MINMAX_SCALER = 'autoencoder_minmax_scaler.pkl'
+LSTM_MODEL = 'lstm_model.keras'
+LSTM_SCALER = 'lstm_scaler.pkl'
+AE_ARTIFACT = 'autoencoder_model.npz'
+LSTM_ARTIFACT = 'lstm_model.npz'
+AE_ERRORS = 'autoencoder_errors.npz'
+LSTM_ERRORS = 'lstm_errors.npz'
+AE_LIVE_ERRORS = 'autoencoder_errors_live.npz'
+LSTM_LIVE_ERRORS = 'lstm_errors_live.npz'
+
+
+def list_versions():
+    """Готовые версии от старой к новой (имена сортируются по времени создания)"""
+    if not os.path.isdir(VERSIONS_DIR):
+        return []
+    return sorted(name for name in os.listdir(VERSIONS_DIR)
+                  if not name.startswith('.') and os.path.isdir(os.path.join(VERSIONS_DIR, name)))
+
+
+def current_version():
+    try:
+        with open(CURRENT_FILE, encoding='utf-8') as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def publish(version):
+    """Атомарная смена текущей версии: запись во временный файл и os.replace"""
+    if not os.path.isdir(os.path.join(VERSIONS_DIR, version)):
+        raise ValueError(f"Версия {version} не найдена в {VERSIONS_DIR}")
+    tmp_path = CURRENT_FILE + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(version)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, CURRENT_FILE)
+
+
+def previous_version(version=None):
+    """Версия, предшествующая version (по умолчанию текущей), или None"""
+    version = version or current_version()
+    versions = list_versions()
+    if version not in versions:
+        return versions[-1] if versions else None
+    index = versions.index(version)
+    return versions[index - 1] if index > 0 else None
+
+
+def withdraw():
+    """Убрать указатель CURRENT: откатиться некуда, агент остаётся на моделях без версии"""
+    try:
+        os.remove(CURRENT_FILE)
+    except FileNotFoundError:
+        pass
+
+
+def rollback(version=None):
+    """Вернуть указатель на предыдущую версию; возвращает её имя или None"""
+    previous = previous_version(version)
+    if previous is None:
+        return None
+    publish(previous)
+    return previous
+
+
+def _prune(keep):
+    versions = list_versions()
+    for name in versions[:-MAX_VERSIONS]:
+        if name not in keep:
+            shutil.rmtree(os.path.join(VERSIONS_DIR, name), ignore_errors=True)
+
+
+def save_version(ae, lstm, probe=None, meta=None):
+    """Сохранение пары моделей новой версией; каталог появляется целиком через os.rename"""
+    import joblib
+    import numpy_inference
+    version = time.strftime('%Y%m%d-%H%M%S')
+    final_dir = os.path.join(VERSIONS_DIR, version)
+    if os.path.exists(final_dir):
+        version += f'-{os.getpid()}'
+        final_dir = os.path.join(VERSIONS_DIR, version)
+    tmp_dir = os.path.join(VERSIONS_DIR, f'.tmp-{version}')
+    os.makedirs(tmp_dir)
+    try:
+        ae.autoencoder.save(os.path.join(tmp_dir, AE_MODEL))
+        joblib.dump(ae.robust_scaler, os.path.join(tmp_dir, AE_ROBUST_SCALER))
+        joblib.dump(ae.minmax_scaler, os.path.join(tmp_dir, AE_MINMAX_SCALER))
+        lstm.save_model(os.path.join(tmp_dir, LSTM_MODEL), os.path.join(tmp_dir, LSTM_SCALER))
+        # Распределения ошибок обучающей выборки - пороги аномалий новой версии
+        ae.error_sketch.save(os.path.join(tmp_dir, AE_ERRORS))
+        lstm.error_sketch.save(os.path.join(tmp_dir, LSTM_ERRORS))
+        # Агенты без TensorFlow берут ту же версию из NumPy-артефактов
+        numpy_inference.export_autoencoder(ae, os.path.join(tmp_dir, AE_ARTIFACT))
+        numpy_inference.export_lstm(lstm, os.path.join(tmp_dir, LSTM_ARTIFACT))
+        if probe is not None:
+            np.save(os.path.join(tmp_dir, 'probe.npy'), probe[-PROBE_ROWS:])
+        with open(os.path.join(tmp_dir, 'meta.json'), 'w', encoding='utf-8') as f:
+            json.dump(dict(meta or {}, version=version, created=time.time()), f, ensure_ascii=False)
+        os.rename(tmp_dir, final_dir)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    return version
+
+
+def load_version(version, numpy_backend=False):
+    """(ae, lstm) из каталога версии; numpy_backend - без TensorFlow, из .npz"""
+    import numpy_inference
+    path = os.path.join(VERSIONS_DIR, version)
+    if numpy_backend:
+        ae = numpy_inference.load_autoencoder(os.path.join(path, AE_ARTIFACT))
+        lstm = numpy_inference.load_lstm(os.path.join(path, LSTM_ARTIFACT))
+        if ae is None or lstm is None:
+            raise FileNotFoundError(f"В версии {version} нет NumPy-артефактов")
+        return ae, lstm
+
+    import joblib
+    import tensorflow as tf
+    from autoencoder import AutoEncoder
+    from simple_lstm import SimpleLSTM
+    ae = AutoEncoder(input_dim=10, encoding_dim=4, hidden_layers=[32, 16, 8])
+    ae.autoencoder = tf.keras.models.load_model(os.path.join(path, AE_MODEL))
+    ae.robust_scaler = joblib.load(os.path.join(path, AE_ROBUST_SCALER))
+    ae.minmax_scaler = joblib.load(os.path.join(path, AE_MINMAX_SCALER))
+    ae.freeze_scalers()
+    lstm = SimpleLSTM.load_model(os.path.join(path, LSTM_MODEL), os.path.join(path, LSTM_SCALER))
+    if lstm is None:
+        raise FileNotFoundError(f"В версии {version} нет модели LSTM")
+    ae.error_sketch = TDigest.load(os.path.join(path, AE_ERRORS)) or ae.error_sketch
+    lstm.error_sketch = TDigest.load(os.path.join(path, LSTM_ERRORS)) or lstm.error_sketch
+    return ae, lstm
+
+
+def _models_dir(version):
+    return os.path.join(VERSIONS_DIR, version) if version else MODELS_DIR
+
+
+def load_live(version, ae, lstm):
+    """Распределения ошибок при работе, сохранённые для этой версии (иначе пустые)"""
+    path = _models_dir(version)
+    ae.live_sketch = TDigest.load(os.path.join(path, AE_LIVE_ERRORS)) or TDigest()
+    lstm.live_sketch = TDigest.load(os.path.join(path, LSTM_LIVE_ERRORS)) or TDigest()
+
+
+def save_live(version, ae, lstm):
+    """Сохранение распределений ошибок при работе рядом с файлами версии"""
+    path = _models_dir(version)
+    if not os.path.isdir(path):
+        # Версия удалена при чистке старых
+        return
+    ae.live_sketch.save(os.path.join(path, AE_LIVE_ERRORS))
+    lstm.live_sketch.save(os.path.join(path, LSTM_LIVE_ERRORS))
+
+
+def validate(version, ae, lstm):
+    """Пробный прогон на сохранённых строках обучающей выборки: выходы моделей должны быть конечными"""
+    probe_path = os.path.join(VERSIONS_DIR, version, 'probe.npy')
+    if not os.path.exists(probe_path):
+        return True
+    probe = np.load(probe_path)
+    if not np.isfinite(ae.predict(probe)).all():
+        return False
+    if len(probe) > lstm.sequence_length:
+        windows = lstm.sliding_windows(lstm.scale(lstm.preprocess_data(probe)), lstm.sequence_length + 1)
+        if not np.isfinite(lstm.window_errors(windows)).all():
+            return False
+    return True
+
+
+class ModelRegistry:
+    """Текущая пара моделей для оценки и её подмена при смене версии.
+
+    current - кортеж (версия, ae, lstm), заменяется одним присваиванием, поэтому поток оценки
+    всегда видит согласованную пару. Новая версия проверяется до переключения; если она
+    не загружается или не проходит проверку, указатель CURRENT откатывается на предыдущую.
+    """
+
+    def __init__(self, numpy_backend=False):
+        self.numpy_backend = numpy_backend
+        self.current = (None, None, None)
+        self.lock = threading.Lock()
+        self.live_saved = time.monotonic()
+        self.rejected = set()  # Версии, не прошедшие загрузку или проверку, повторно не загружаются
+
+    def install(self, version, ae, lstm):
+        previous_lstm = self.current[2]
+        if previous_lstm is not None:
+            # История окон по IP хранится в исходных признаках и переходит к новой модели
+            lstm.sequences = previous_lstm.sequences
+        # Ошибки другой модели несравнимы: live-распределение берётся только своей версии
+        load_live(version, ae, lstm)
+        self.current = (version, ae, lstm)
+
+    def save_live(self, force=False):
+        """Сохранение live-распределений текущей версии не чаще LIVE_SAVE_INTERVAL.
+
+        Вызывается из потока оценки, который единственный меняет эти дайджесты.
+        """
+        version, ae, lstm = self.current
+        if ae is None or not force and time.monotonic() - self.live_saved < LIVE_SAVE_INTERVAL:
+            return
+        self.live_saved = time.monotonic()
+        try:
+            save_live(version, ae, lstm)
+        except OSError as e:
+            service_logger.warning(f"Не удалось сохранить распределения ошибок версии {version}: {e}")
+
+    def load_current(self):
+        """Загрузка версии из CURRENT при старте; False, если версий ещё нет"""
+        version = current_version()
+        if version is None or version in self.rejected:
+            return False
+        if self.swap(version):
+            return True
+        # Текущая версия отклонена и указатель откатился - пробуем предыдущую
+        restored = current_version()
+        return restored not in (None, version) and restored not in self.rejected and self.swap(restored)
+
+    def swap(self, version):
+        """Загрузить, проверить и подменить модели; при ошибке откатить CURRENT"""
+        with self.lock:
+            if version == self.current[0]:
+                return True
+            try:
+                ae, lstm = load_version(version, self.numpy_backend)
+                if not validate(version, ae, lstm):
+                    raise ValueError("модель выдаёт нечисловые значения на пробных данных")
+            except Exception as e:
+                service_logger.error(f"Версия моделей {version} отклонена: {e}")
+                self.rejected.add(version)
+                restored = self.current[0] or previous_version(version)
+                if current_version() == version:
+                    if restored:
+                        publish(restored)
+                        service_logger.warning(f"Откат к версии моделей {restored}")
+                    else:
+                        # Иначе CURRENT указывал бы на отклонённую версию и при каждом запуске
+                        withdraw()
+                        service_logger.warning("Откатиться некуда, указатель CURRENT удалён")
+                return False
+            self.install(version, ae, lstm)
+            service_logger.info(f"Модели переключены на версию {version}")
+            return True
+
+    def poll(self):
+        """Проверка указателя CURRENT (после переобучения или ручного отката)"""
+        version = current_version()
+        if version and version != self.current[0] and version not in self.rejected:
+            self.swap(version)
+
+
+def train_version(X, epochs_ae, epochs_lstm, batch_size):
+    """Обучение новой пары моделей и сохранение версией; выполняется в отдельном процессе"""
+    from logger_config import init_loggers
+    from autoencoder import AutoEncoder
+    from simple_lstm import SimpleLSTM
+    init_loggers(packet_format='off', service_file='log_files/service_retrain.log')
+    started = time.perf_counter()
+    ae = AutoEncoder(input_dim=X.shape[1], encoding_dim=4, hidden_layers=[32, 16, 8])
+    ae.train(X, epochs=epochs_ae, batch_size=batch_size, verbose=0)
+    lstm = SimpleLSTM(input_dim=X.shape[1])
+    if lstm.train(X, epochs=epochs_lstm, batch_size=batch_size, verbose=0) is None:
+        raise ValueError("Недостаточно данных для обучения LSTM")
+    version = save_version(ae, lstm, probe=X, meta={'rows': len(X)})
+    _prune(keep={version, current_version()})
+    service_logger.info(f"Версия моделей {version} обучена за {time.perf_counter() - started:.0f} с на {len(X)} записях")
+    return version
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Версии моделей агента")
+    sub = parser.add_subparsers(dest='command', required=True)
+    sub.add_parser('list')
+    sub.add_parser('rollback')
+    use = sub.add_parser('use')
+    use.add_argument('version')
+    args = parser.parse_args()
+
+    if args.command == 'list':
+        current = current_version()
+        for name in list_versions():
+            print(f"{'*' if name == current else ' '} {name}")
+    elif args.command == 'rollback':
+        previous = rollback()
+        print(f"Текущая версия: {previous}" if previous else "Предыдущей версии нет")
+    else:
+        publish(args.version)
+        print(f"Текущая версия: {args.version}")
+
+
+__all__ = ['ModelRegistry', 'save_version', 'load_version', 'load_live', 'save_live', 'train_version', 'publish',
+           'withdraw', 'rollback', 'current_version', 'list_versions']
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,250 @@
+# Инференс AutoEncoder и SimpleLSTM на NumPy без TensorFlow
+#
+#   python numpy_inference.py export    # saved_ml/*.keras + scaler-ы -> saved_ml/*.npz
+#   python numpy_inference.py verify    # сравнение выходов NumPy и Keras на случайных данных
+
+import argparse
+import json
+import os
+import sys
+import numpy as np
+from quantile_sketch import TDigest
+
+AE_ARTIFACT = 'saved_ml/autoencoder_model.npz'
+LSTM_ARTIFACT = 'saved_ml/lstm_model.npz'
+PARITY_TOLERANCE = 1e-4
+
+_ACTIVATIONS = {
+    'linear': lambda x: x,
+    'relu': lambda x: np.maximum(x, 0, out=x),
+    'sigmoid': lambda x: 0.5 * (np.tanh(0.5 * x) + 1),
+    'tanh': np.tanh,
+}
+
+
+def _activation(name):
+    try:
+        return _ACTIVATIONS[name]
+    except KeyError:
+        raise ValueError(f"Функция активации не поддерживается: {name}") from None
+
+
+class SequentialNet:
+    """Последовательность слоёв Dense и LSTM с весами Keras, вычисляемая матричными умножениями NumPy.
+
+    Повторяет интерфейс model.predict(X, verbose=0), поэтому подставляется вместо модели Keras
+    в AutoEncoder.autoencoder и SimpleLSTM.model.
+    """
+
+    def __init__(self, layers):
+        # layers: [{'type': 'dense'|'lstm', 'activation': ..., 'weights': [...], ...}]
+        self.layers = layers
+        self._forward = [self._dense if layer['type'] == 'dense' else self._lstm for layer in layers]
+
+    @staticmethod
+    def _dense(layer, x):
+        kernel, bias = layer['weights']
+        return _activation(layer['activation'])(x @ kernel + bias)
+
+    @staticmethod
+    def _lstm(layer, x):
+        """LSTM с порядком вентилей Keras: input, forget, cell, output"""
+        kernel, recurrent, bias = layer['weights']
+        act = _activation(layer['activation'])
+        gate = _activation(layer['recurrent_activation'])
+        units = recurrent.shape[0]
+        batch, steps = x.shape[0], x.shape[1]
+        # Входная часть всех шагов считается одним умножением
+        z_input = x @ kernel + bias
+        h = np.zeros((batch, units), dtype=x.dtype)
+        c = np.zeros((batch, units), dtype=x.dtype)
+        outputs = np.empty((batch, steps, units), dtype=x.dtype) if layer['return_sequences'] else None
+        for t in range(steps):
+            z = z_input[:, t] + h @ recurrent
+            i = gate(z[:, :units])
+            f = gate(z[:, units:2 * units])
+            g = act(z[:, 2 * units:3 * units])
+            o = gate(z[:, 3 * units:])
+            c = f * c + i * g
+            h = o * act(c)
+            if outputs is not None:
+                outputs[:, t] = h
+        return outputs if outputs is not None else h
+
+    def predict(self, X, verbose=0, batch_size=None):
+        x = np.asarray(X, dtype=np.float32)
+        for forward, layer in zip(self._forward, self.layers):
+            x = forward(layer, x)
+        return x
+
+
+def keras_layers(model):
+    """Описание слоёв модели Keras для SequentialNet; Dropout и InputLayer на инференсе не нужны"""
+    layers = []
+    for layer in model.layers:
+        kind = type(layer).__name__
+        if kind in ('InputLayer', 'Dropout'):
+            continue
+        config = layer.get_config()
+        weights = [np.asarray(w, dtype=np.float32) for w in layer.get_weights()]
+        if kind == 'Dense':
+            if not config.get('use_bias', True):
+                weights.append(np.zeros(weights[0].shape[1], dtype=np.float32))
+            layers.append({'type': 'dense', 'activation': config['activation'], 'weights': weights})
+        elif kind == 'LSTM':
+            if not config.get('use_bias', True):
+                weights.append(np.zeros(weights[0].shape[1], dtype=np.float32))
+            layers.append({'type': 'lstm', 'activation': config['activation'],
+                           'recurrent_activation': config['recurrent_activation'],
+                           'return_sequences': config['return_sequences'], 'weights': weights})
+        else:
+            raise ValueError(f"Слой {layer.name} ({kind}) не поддерживается NumPy-инференсом")
+    return layers
+
+
+def _save(path, kind, layers, params, arrays):
+    meta = {'kind': kind, 'params': params, 'layers': []}
+    for n, layer in enumerate(layers):
+        spec = {k: v for k, v in layer.items() if k != 'weights'}
+        spec['weights'] = len(layer['weights'])
+        meta['layers'].append(spec)
+        for w, value in enumerate(layer['weights']):
+            arrays[f'layer{n}_{w}'] = value
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = path + '.tmp.npz'
+    np.savez(tmp_path, meta=np.array(json.dumps(meta)), **arrays)
+    os.replace(tmp_path, path)
+
+
+def _load(path, kind):
+    with np.load(path, allow_pickle=False) as data:
+        meta = json.loads(str(data['meta']))
+        if meta['kind'] != kind:
+            raise ValueError(f"{path}: ожидался артефакт {kind}, получен {meta['kind']}")
+        layers = []
+        for n, spec in enumerate(meta['layers']):
+            layer = dict(spec)
+            layer['weights'] = [data[f'layer{n}_{w}'] for w in range(spec['weights'])]
+            layers.append(layer)
+        arrays = {name: data[name] for name in data.files if name != 'meta' and not name.startswith('layer')}
+    return SequentialNet(layers), meta['params'], arrays
+
+
+def export_autoencoder(ae, path=AE_ARTIFACT):
+    """Веса автоэнкодера и замороженное преобразование scaler-ов в один .npz"""
+    if not ae.frozen:
+        ae.freeze_scalers()
+    params = {'input_dim': ae.input_dim, 'encoding_dim': ae.encoding_dim, 'hidden_layers': list(ae.hidden_layers)}
+    _save(path, 'autoencoder', keras_layers(ae.autoencoder), params, {
+        'feature_scale': ae.feature_scale,
+        'feature_offset': ae.feature_offset,
+        'impute_medians': ae.impute_medians,
+        **ae.error_sketch.state('error_'),
+    })
+
+
+def export_lstm(lstm, path=LSTM_ARTIFACT):
+    """Веса LSTM и параметры RobustScaler в один .npz"""
+    params = {'input_dim': lstm.input_dim, 'sequence_length': lstm.sequence_length, 'units': lstm.units}
+    _save(path, 'lstm', keras_layers(lstm.model), params, {
+        'scaler_center': lstm.scaler.center_,
+        'scaler_scale': lstm.scaler.scale_,
+        **lstm.error_sketch.state('error_'),
+    })
+
+
+def load_autoencoder(path=AE_ARTIFACT):
+    """AutoEncoder с NumPy-моделью и замороженными scaler-ами; None, если артефакта нет"""
+    if not os.path.exists(path):
+        return None
+    from autoencoder import AutoEncoder
+    net, params, arrays = _load(path, 'autoencoder')
+    ae = AutoEncoder(input_dim=params['input_dim'], encoding_dim=params['encoding_dim'],
+                     hidden_layers=params['hidden_layers'])
+    ae.autoencoder = net
+    ae.feature_scale = arrays['feature_scale']
+    ae.feature_offset = arrays['feature_offset']
+    ae.impute_medians = arrays['impute_medians']
+    ae.frozen = True
+    if 'error_means' in arrays:
+        ae.error_sketch = TDigest.from_state(arrays, 'error_')
+    return ae
+
+
+def load_lstm(path=LSTM_ARTIFACT):
+    """SimpleLSTM с NumPy-моделью; None, если артефакта нет"""
+    if not os.path.exists(path):
+        return None
+    from simple_lstm import SimpleLSTM
+    net, params, arrays = _load(path, 'lstm')
+    lstm = SimpleLSTM(input_dim=params['input_dim'], sequence_length=params['sequence_length'],
+                      units=params['units'], model=net)
+    lstm.scaler.center_ = arrays['scaler_center']
+    lstm.scaler.scale_ = arrays['scaler_scale']
+    lstm.scaler.n_features_in_ = len(lstm.scaler.center_)
+    if 'error_means' in arrays:
+        lstm.error_sketch = TDigest.from_state(arrays, 'error_')
+    return lstm
+
+
+def _load_keras_models():
+    import joblib
+    import tensorflow as tf
+    from autoencoder import AutoEncoder
+    from simple_lstm import SimpleLSTM
+    ae = AutoEncoder(input_dim=10, encoding_dim=4, hidden_layers=[32, 16, 8])
+    ae.autoencoder = tf.keras.models.load_model('saved_ml/autoencoder_model.keras')
+    ae.robust_scaler = joblib.load('saved_ml/autoencoder_robust_scaler.pkl')
+    ae.minmax_scaler = joblib.load('saved_ml/autoencoder_minmax_scaler.pkl')
+    ae.freeze_scalers()
+    lstm = SimpleLSTM.load_model('saved_ml/lstm_model.keras', 'saved_ml/lstm_scaler.pkl')
+    return ae, lstm
+
+
+def verify(ae_path=AE_ARTIFACT, lstm_path=LSTM_ARTIFACT, samples=256, seed=0, tolerance=PARITY_TOLERANCE):
+    """Максимальные расхождения выходов NumPy и Keras; True, если все в пределах tolerance"""
+    ae, lstm = _load_keras_models()
+    np_ae, np_lstm = load_autoencoder(ae_path), load_lstm(lstm_path)
+    rng = np.random.default_rng(seed)
+    ok = True
+    checks = []
+    if np_ae is not None:
+        X = rng.random((samples, ae.input_dim), dtype=np.float32)
+        checks.append(('autoencoder', ae.autoencoder.predict(X, verbose=0), np_ae.autoencoder.predict(X)))
+        # Сырые признаки через замороженное преобразование обеих сторон
+        X_raw = rng.lognormal(3, 2, (samples, ae.input_dim))
+        checks.append(('autoencoder+scalers', ae.autoencoder.predict(ae.transform_frozen(X_raw), verbose=0),
+                       np_ae.autoencoder.predict(np_ae.transform_frozen(X_raw))))
+    if lstm is not None and np_lstm is not None:
+        X = rng.standard_normal((samples, lstm.sequence_length, lstm.input_dim), dtype=np.float32)
+        checks.append(('lstm', lstm.model.predict(X, verbose=0), np_lstm.model.predict(X)))
+    for name, expected, actual in checks:
+        diff = float(np.max(np.abs(expected - actual) / np.maximum(np.abs(expected), 1)))
+        ok = ok and diff <= tolerance
+        print(f"{name:24s} max rel diff {diff:.2e} {'OK' if diff <= tolerance else 'FAIL'}")
+    return ok and bool(checks)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="NumPy-инференс моделей агента")
+    parser.add_argument('command', choices=['export', 'verify'])
+    parser.add_argument('--ae', default=AE_ARTIFACT, help="Артефакт автоэнкодера")
+    parser.add_argument('--lstm', default=LSTM_ARTIFACT, help="Артефакт LSTM")
+    parser.add_argument('--tolerance', type=float, default=PARITY_TOLERANCE)
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        ae, lstm = _load_keras_models()
+        export_autoencoder(ae, args.ae)
+        print(f"Сохранено: {args.ae}")
+        if lstm is not None:
+            export_lstm(lstm, args.lstm)
+            print(f"Сохранено: {args.lstm}")
+    else:
+        sys.exit(0 if verify(args.ae, args.lstm, tolerance=args.tolerance) else 1)
+
+
+__all__ = ['SequentialNet', 'export_autoencoder', 'export_lstm', 'load_autoencoder', 'load_lstm', 'verify']
+
+if __name__ == "__main__":
+    main()
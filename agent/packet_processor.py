@@ -1,9 +1,7 @@
-from scapy.all import IP
 import time
 import numpy as np
-import pandas as pd
-from logger_config import service_logger, packet_logger
-from traffic_stats import TrafficStats
+from logger_config import service_logger, packet_logger, packet_log_due
+import metrics
 
 INTERVAL_SECONDS = 5
 PREDICT_INTERVAL = 5
@@ -22,205 +20,149 @@ proto_names = {
     255: "RAW"
 }
 
-def packet_handler(pkt, stats_dict, stats_lock):
+class _Proto(int):
+    """Номер протокола, который в текстовом логе пакетов выводится по имени"""
+    __slots__ = ()
+
+    def __str__(self):
+        return proto_names.get(int(self), 'Unknown')
+
+_PROTOS = [_Proto(number) for number in range(256)]
+
+PACKET_LOG_MSG = "%s - %s -> %s Proto: %s Size: %s"
+
+# Протоколы с портами в первых 4 байтах заголовка: TCP, UDP, SCTP
+PORT_PROTOS = (6, 17, 132)
+
+def _record_packet(timestamp, src_ip, dst_ip, proto, length, stats_table):
+    """Учёт одного IP-пакета в окнах отправителя и получателя"""
+    # Сообщение форматируется только при записи обработчиком, а не в потоке захвата
+    if packet_log_due():
+        packet_logger.info(PACKET_LOG_MSG, timestamp, src_ip, dst_ip, _PROTOS[proto & 0xFF], length)
+
+    # В статистику попадают только время, размер и направление - сам пакет не сохраняется
+    stats_table.add_packet(timestamp, src_ip, dst_ip, length)
+
+def packet_handler(pkt, stats_table, flows=None, packets=None):
+    # scapy нужен только бэкенду захвата scapy; после первого пакета импорт - поиск в sys.modules
+    from scapy.layers.inet import IP
     if IP not in pkt:
         service_logger.debug("Пакет без IP пропущен")
         return
 
     timestamp = time.time()
-    src_ip = pkt[IP].src
-    dst_ip = pkt[IP].dst
+    ip_layer = pkt[IP]
+    src_ip = ip_layer.src
+    dst_ip = ip_layer.dst
+    service_logger.debug("Обработка пакета: %s -> %s", src_ip, dst_ip)
 
-    log_msg = f"{timestamp} - {src_ip} -> {dst_ip} Proto: {proto_names.get(pkt[IP].proto, 'Unknown')} Size: {len(pkt)}"
-    packet_logger.info(log_msg)
-    service_logger.debug(f"Обработка пакета: {src_ip} -> {dst_ip}")
+    _record_packet(timestamp, src_ip, dst_ip, ip_layer.proto, len(pkt), stats_table)
+    if packets is not None:
+        packets.inc()
+    if flows is not None:
+        # У TCP/UDP/SCTP слой над IP имеет sport/dport, у остальных протоколов порты нулевые
+        l4 = ip_layer.payload
+        flows.add_packet(timestamp, src_ip, dst_ip, ip_layer.proto, len(pkt),
+                         getattr(l4, 'sport', 0), getattr(l4, 'dport', 0))
 
-    with stats_lock:
-        if src_ip not in stats_dict:
-            stats_dict[src_ip] = TrafficStats()
-        if dst_ip not in stats_dict:
-            stats_dict[dst_ip] = TrafficStats()
+def packet_batch_handler(batch, stats_table, flows=None, packets=None):
+    """Учёт пачки уже разобранных пакетов (timestamp, src_ip, dst_ip, proto, length, sport, dport)
 
-        stats_dict[src_ip].add_packet(pkt, timestamp)
-        stats_dict[dst_ip].add_packet(pkt, timestamp)
+    packets - счётчик интерфейса, с которого пришла пачка: у каждого потока захвата свой.
+    """
+    for timestamp, src_ip, dst_ip, proto, length, _, _ in batch:
+        _record_packet(timestamp, src_ip, dst_ip, proto, length, stats_table)
+    if packets is not None:
+        packets.inc(len(batch))
+    if flows is not None:
+        flows.add_batch(batch)
 
-def periodic_analysis(stats_dict, interval, stats_lock, ae, data_queue, stop_event):
-    while True:
-        if stop_event.is_set():
-            service_logger.debug("Поток анализа приостановлен")
-            time.sleep(5)
-            continue
-        try:
-            time.sleep(interval)
-            service_logger.debug(f"Запуск анализа за последние {interval} сек...")
-            with stats_lock:
-                if not stats_dict:
-                    service_logger.debug("stats_dict пуст. Пропуск анализа")
-                    continue
-                ip_list = list(stats_dict.keys())
-                service_logger.debug(f"В stats_dict: {len(ip_list)} IP-адресов")
-            processed_data = []
-            feature_names = ['fl_byt_s', 'fl_pck_s', 'fwd_max_pack_size', 'fwd_avg_packet',
-                             'bck_max_pack_size', 'bck_avg_packet', 'fw_iat_std', 'fw_iat_min',
-                             'bck_iat_std', 'bck_iat_min', 'packet_count']
-            for ip in ip_list:
-                with stats_lock:
-                    stats = stats_dict.get(ip)
-                    if stats:
-                        stats.set_ip(ip)
-                        features = stats.aggregate_and_store()
-                        if features:
-                            processed_item = {
-                                'ip': ip,
-                                'timestamp': pd.Timestamp.now(),
-                            }
-                            processed_item.update({name: value for name, value in zip(feature_names, features)})
-                            service_logger.debug(f"processed_item для IP {ip}: {processed_item}")
-                            processed_data.append(processed_item)
-            if not processed_data:
-                service_logger.debug("Недостаточно данных для анализа")
-                continue
-            data_queue.put(processed_data)
-            service_logger.debug(f"Добавлено {len(processed_data)} записей в очередь")
-        except Exception as e:
-            service_logger.error(f"Ошибка в periodic_analysis: {str(e)}", exc_info=True)
-            time.sleep(interval)
+FEATURE_NAMES = ['fl_byt_s', 'fl_pck_s', 'fwd_max_pack_size', 'fwd_avg_packet',
+                 'bck_max_pack_size', 'bck_avg_packet', 'fw_iat_std', 'fw_iat_min',
+                 'bck_iat_std', 'bck_iat_min', 'packet_count']
+
+def close_window(stats_table, stats_dict, timestamp):
+    """Закрытие текущего окна: список записей признаков по IP с отметкой времени timestamp"""
+    # Подмена окон по шардам за O(1), признаки считаются уже без блокировок
+    return window_records(stats_table.swap_windows(), stats_dict, timestamp)
+
+def window_records(closed_windows, stats_dict, timestamp):
+    """Записи признаков по IP для закрытых окон [(ip, WindowAccumulator)] с пополнением истории stats_dict"""
+    started = time.perf_counter()
+    service_logger.debug("Закрыто окон: %d", len(closed_windows))
+    processed_data = []
+    for ip, window in closed_windows:
+        stats = stats_dict[ip]
+        stats.set_ip(ip)
+        features = stats.aggregate_and_store(window)
+        if features:
+            processed_item = {
+                'ip': ip,
+                'timestamp': timestamp,
+            }
+            processed_item.update({name: value for name, value in zip(FEATURE_NAMES, features)})
+            service_logger.debug("processed_item для IP %s: %s", ip, processed_item)
+            processed_data.append(processed_item)
+    # Признаки считаются только для IP с трафиком в окне; история молчащих дольше TTL забывается
+    expired = stats_dict.expire()
+    if expired:
+        service_logger.debug("Забыто неактивных IP: %d, отслеживается: %d", expired, len(stats_dict))
+    metrics.WINDOW_CLOSE_SECONDS.observe(time.perf_counter() - started)
+    metrics.WINDOWS.inc()
+    metrics.WINDOW_RECORDS.inc(len(processed_data))
+    metrics.TRACKED_HOSTS.set(len(stats_dict))
+    return processed_data
+
+def flush_flows(flows, flow_store, now, flush=False):
+    """Запись завершённых к моменту now потоков в хранилище; возвращает их число"""
+    from flow_table import flow_columns
+    finished = flows.expire(now, flush)
+    metrics.FINISHED_FLOWS.inc(len(finished))
+    metrics.ACTIVE_FLOWS.set(len(flows))
+    if finished:
+        flow_store.append(flow_columns(finished))
+        service_logger.debug("Завершено потоков: %d, активных: %d", len(finished), len(flows))
+    return len(finished)
 
-def predict_and_save_anomalies(ae, lstm, interval, data_queue, stop_event):
-    EXPRESS_SERVER_URL = "http://localhost:3000/pgadmin/anomalies"
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
+def periodic_analysis(stats_table, stats_dict, interval, data_queue, stop_event, flows=None, flow_store=None,
+                      window_stores=None):
+    """Закрытие окон на границах по часам; stats_dict (HostTable с историей по IP) используется только этим потоком
+
+    Окна длиной interval (окна моделей) уходят в data_queue. window_stores - {разрешение:
+    FeatureStore} для остальных разрешений: их окна собираются слиянием окон наименьшего
+    разрешения и пишутся в хранилище. Если передана таблица потоков, завершённые потоки
+    на каждом шаге дописываются в flow_store.
+    """
+    import pandas as pd
+    from window_scheduler import WindowScheduler, ResolutionMerger, window_columns
+    resolutions = sorted(set(window_stores or ()) | {interval})
+    scheduler = WindowScheduler(resolutions[0])
+    merger = ResolutionMerger(resolutions, stats_table.interval_gap)
     while True:
-        if stop_event.is_set():
-            time.sleep(5)
-            continue
+        boundary = scheduler.wait(stop_event)
+        if boundary is None:
+            break
         try:
-            while data_queue.empty():
-                time.sleep(1)
-            data = data_queue.get()
-            if not data:
-                data_queue.task_done()
-                continue
-            service_logger.debug(f"Структура данных из data_queue: {data}")
-            if not isinstance(data, list):
-                service_logger.error(f"Данные из очереди не являются списком: {type(data)}")
-                data_queue.task_done()
-                continue
-            processed_data = []
-            feature_names = ['fl_byt_s', 'fl_pck_s', 'fwd_max_pack_size', 'fwd_avg_packet',
-                             'bck_max_pack_size', 'bck_avg_packet', 'fw_iat_std', 'fw_iat_min',
-                             'bck_iat_std', 'bck_iat_min', 'packet_count']
-            for item in data:
-                if not isinstance(item, dict):
-                    service_logger.warning(f"Элемент не является словарем: {item}")
-                    continue
-                if 'ip' not in item or 'timestamp' not in item:
-                    service_logger.warning(f"Отсутствуют обязательные ключи в элементе: {item}")
-                    continue
-                if not all(feature in item for feature in feature_names):
-                    service_logger.warning(f"Отсутствуют необходимые признаки в элементе: {item}")
-                    continue
-                processed_data.append(item)
-            if not processed_data:
-                service_logger.warning("Нет корректных данных для обработки")
-                data_queue.task_done()
+            service_logger.debug("Закрытие окон на границе %s", boundary)
+            if flows is not None:
+                flush_flows(flows, flow_store, boundary)
+            levels = merger.close(stats_table.swap_windows(), boundary)
+            for resolution, windows in levels.items():
+                if resolution != interval:
+                    window_stores[resolution].append(window_columns(windows, boundary))
+            if interval not in levels:
                 continue
-            df = pd.DataFrame(processed_data)
-            if 'timestamp' not in df.columns:
-                service_logger.error("Столбец 'timestamp' отсутствует в DataFrame")
-                data_queue.task_done()
-                continue
-            df = df.sort_values(by='timestamp')
-            X = df[feature_names].values
-            timestamps = df['timestamp'].values
-            ips = df['ip'].values
-            if X.size == 0:
-                service_logger.warning("Нет данных для анализа аномалий")
-                data_queue.task_done()
-                continue
-            anomalies_ae, _, _ = ae.detect_anomalies(X[:, :10]) if ae else [None] * len(X)
-            anomalies_lstm, _, _ = lstm.detect_anomalies(X[:, :10]) if lstm else [0] * len(X)
-            results = []
-            for i in range(len(X)):
-                anomaly_ae = anomalies_ae[i] if anomalies_ae is not None else None
-                anomaly_lstm = anomalies_lstm[i] if anomalies_lstm is not None else 0
-                anomaly_consensus = 1 if (anomaly_ae == 1 and anomaly_lstm == 1) else 0
-                features = X[i].tolist()
-                service_logger.debug(f"features для IP {ips[i]}: {features}")
-                result = {
-                    'user_id': 1,
-                    'ip': ips[i],
-                    'timestamp': str(timestamps[i]),
-                    'fl_byt_s': features[0],
-                    'fl_pck_s': features[1],
-                    'fwd_max_pack_size': features[2],
-                    'fwd_avg_packet': features[3],
-                    'bck_max_pack_size': features[4],
-                    'bck_avg_packet': features[5],
-                    'fw_iat_std': features[6],
-                    'fw_iat_min': features[7],
-                    'bck_iat_std': features[8],
-                    'bck_iat_min': features[9],
-                    'packet_count': int(features[10]) if features[10] is not None else 0,
-                    'anomaly_ae': int(anomaly_ae) if anomaly_ae is not None else None,
-                    'anomaly_lstm': int(anomaly_lstm),
-                    'anomaly_consensus': int(anomaly_consensus)
-                }
-                results.append(result)
-            service_logger.debug(f"results для отправки: {results}")
-            async def run_async_tasks():
-                async with aiohttp.ClientSession() as session:
-                    await send_data_to_server(session, EXPRESS_SERVER_URL, results)
-            loop.run_until_complete(run_async_tasks())
-            data_queue.task_done()
-            service_logger.info(f"Отправлено {len(results)} записей на сервер")
-        except Exception as e:
-            service_logger.error(f"Ошибка в predict_and_save_anomalies: {e}", exc_info=True)
-            time.sleep(interval)
-    loop.close()
-    while True:
-        if stop_event.is_set():
-            service_logger.debug("Поток анализа приостановлен")
-            time.sleep(5)
-            continue
-        
-        try:
-            time.sleep(interval)
-            service_logger.debug(f"Запуск анализа за последние {interval} сек...")
-            with stats_lock:
-                if not stats_dict:
-                    service_logger.debug("stats_dict пуст. Пропуск анализа")
-                    continue
-                ip_list = list(stats_dict.keys())
-                service_logger.debug(f"В stats_dict: {len(ip_list)} IP-адресов")
-
-            processed_data = []
-            feature_names = ['fl_byt_s', 'fl_pck_s', 'fwd_max_pack_size', 'fwd_avg_packet',
-                             'bck_max_pack_size', 'bck_avg_packet', 'fw_iat_std', 'fw_iat_min',
-                             'bck_iat_std', 'bck_iat_min', 'packet_count']
-
-            for ip in ip_list:
-                with stats_lock:
-                    stats = stats_dict.get(ip)
-                    if stats:
-                        stats.set_ip(ip)
-                        features = stats.aggregate_and_store()
-                        if features:
-                            processed_item = {
-                                'ip': ip,
-                                'timestamp': pd.Timestamp.now(),
-                            }
-                            processed_item.update({name: value for name, value in zip(feature_names, features)})
-                            processed_data.append(processed_item)
-                
+            # Метка окна - его граница, а не момент обработки
+            processed_data = window_records(levels[interval], stats_dict, pd.Timestamp.fromtimestamp(boundary))
             if not processed_data:
                 service_logger.debug("Недостаточно данных для анализа")
                 continue
-                
             data_queue.put(processed_data)
-            service_logger.debug(f"Добавлено {len(processed_data)} записей в очередь")
+            service_logger.debug("Добавлено %d записей в очередь", len(processed_data))
         except Exception as e:
             service_logger.error(f"Ошибка в periodic_analysis: {str(e)}", exc_info=True)
             time.sleep(interval)
 
-__all__ = ['packet_handler', 'periodic_analysis']
\ No newline at end of file
+
+__all__ = ['packet_handler', 'packet_batch_handler', 'close_window', 'window_records', 'periodic_analysis',
+           'flush_flows', 'FEATURE_NAMES', 'PORT_PROTOS']
\ No newline at end of file
@@ -0,0 +1,186 @@
+# Офлайн-прогон pcap/pcapng через весь конвейер агента (без root и живого интерфейса)
+
+import argparse
+import socket
+import struct
+import time
+import pandas as pd
+from scapy.utils import RawPcapReader
+from logger_config import init_loggers, service_logger
+from traffic_stats import TrafficStats, HostTable
+from stats_table import ShardedStatsTable
+from packet_processor import packet_batch_handler, close_window, flush_flows, PORT_PROTOS
+from diagnostics import diagnostics
+
+INTERVAL_SECONDS = 5
+BATCH_SIZE = 1024
+
+# Смещение IP-заголовка и положение поля типа протокола для поддерживаемых типов канала
+DLT_NULL = 0
+DLT_EN10MB = 1
+DLT_RAW = 101
+DLT_LOOP = 108
+DLT_LINUX_SLL = 113
+DLT_LINUX_SLL2 = 276
+_RAW_LINKTYPES = (12, 14, DLT_RAW)
+
+
+def _ip_offset(frame, linktype):
+    """Смещение IPv4-заголовка в кадре или -1, если это не IPv4"""
+    if linktype == DLT_EN10MB:
+        offset = 12
+        ethertype = frame[offset] << 8 | frame[offset + 1]
+        while ethertype in (0x8100, 0x88A8) and len(frame) >= offset + 6:
+            offset += 4
+            ethertype = frame[offset] << 8 | frame[offset + 1]
+        return offset + 2 if ethertype == 0x0800 else -1
+    if linktype in _RAW_LINKTYPES:
+        return 0
+    if linktype == DLT_LINUX_SLL:
+        return 16 if frame[14:16] == b'\x08\x00' else -1
+    if linktype == DLT_LINUX_SLL2:
+        return 20 if frame[0:2] == b'\x08\x00' else -1
+    if linktype in (DLT_NULL, DLT_LOOP):
+        return 4
+    return -1
+
+
+def parse_frame(frame, linktype):
+    """(src_ip, dst_ip, proto, sport, dport) из IPv4-кадра или None; порты 0, если их нет"""
+    offset = _ip_offset(frame, linktype) if len(frame) >= 16 else -1
+    if offset < 0 or len(frame) < offset + 20 or frame[offset] >> 4 != 4:
+        return None
+    proto = frame[offset + 9]
+    l4 = offset + (frame[offset] & 0x0F) * 4
+    if proto in PORT_PROTOS and len(frame) >= l4 + 4 and not (frame[offset + 6] & 0x1F or frame[offset + 7]):
+        sport, dport = struct.unpack_from('!HH', frame, l4)
+    else:
+        sport = dport = 0
+    return (socket.inet_ntoa(frame[offset + 12:offset + 16]),
+            socket.inet_ntoa(frame[offset + 16:offset + 20]),
+            proto, sport, dport)
+
+
+def read_pcap(path):
+    """Поток (timestamp, src_ip, dst_ip, proto, length, sport, dport) из pcap или pcapng"""
+    with RawPcapReader(path) as reader:
+        linktype = getattr(reader, 'linktype', None)
+        ts_divisor = 1e9 if getattr(reader, 'nano', False) else 1e6
+        for frame, meta in reader:
+            if hasattr(meta, 'tshigh'):
+                # pcapng: 64-битная метка времени с разрешением tsresol
+                timestamp = ((meta.tshigh << 32) | meta.tslow) / meta.tsresol
+                parsed = parse_frame(frame, meta.linktype)
+            else:
+                timestamp = meta.sec + meta.usec / ts_divisor
+                parsed = parse_frame(frame, linktype)
+            if parsed is not None:
+                src_ip, dst_ip, proto, sport, dport = parsed
+                yield timestamp, src_ip, dst_ip, proto, meta.wirelen, sport, dport
+
+
+def replay_pcap(path, ae, lstm, interval=INTERVAL_SECONDS, speed=0, on_results=None, flow_store=None):
+    """Прогон файла через захват, анализ окон и оценку аномалий
+
+    Границы окон задаются метками времени пакетов, а не time.sleep(interval).
+    speed - коэффициент ускорения относительно исходного темпа, 0 - максимально быстро.
+    on_results(results) вызывается для каждой оценённой пачки. Завершённые потоки пишутся
+    в flow_store, если он передан. Возвращает сводку прогона.
+    """
+    from main import score_batch
+    from flow_table import FlowTable
+
+    stats_table = ShardedStatsTable(1)
+    stats_dict = HostTable(TrafficStats)
+    flows = FlowTable() if flow_store is not None else None
+    summary = {'packets': 0, 'windows': 0, 'records': 0, 'anomalies_ae': 0, 'anomalies_lstm': 0, 'flows': 0}
+    window_end = None
+    first_ts = None
+    wall_start = time.perf_counter()
+    batch = []
+
+    def flush_window(boundary, last=False):
+        if flows is not None:
+            # Время потоков - время записи, поэтому тайм-ауты отсчитываются от границы окна
+            summary['flows'] += flush_flows(flows, flow_store, boundary, flush=last)
+        data = close_window(stats_table, stats_dict, pd.Timestamp.fromtimestamp(boundary))
+        summary['windows'] += 1
+        if not data:
+            return
+        results = score_batch(ae, lstm, data)
+        if not results:
+            return
+        summary['records'] += len(results)
+        summary['anomalies_ae'] += sum(1 for r in results if r['anomaly_ae'] == 1)
+        summary['anomalies_lstm'] += sum(1 for r in results if r['anomaly_lstm'] == 1)
+        if on_results:
+            on_results(results)
+
+    for record in read_pcap(path):
+        timestamp = record[0]
+        if window_end is None:
+            first_ts = timestamp
+            window_end = timestamp + interval
+        if timestamp >= window_end:
+            packet_batch_handler(batch, stats_table, flows)
+            batch = []
+            flush_window(window_end)
+            # Пропуск пустых окон при длинных паузах в записи
+            window_end += interval * max(int((timestamp - window_end) // interval) + 1, 1)
+        if speed:
+            delay = (timestamp - first_ts) / speed - (time.perf_counter() - wall_start)
+            if delay > 0:
+                packet_batch_handler(batch, stats_table, flows)
+                batch = []
+                time.sleep(delay)
+        batch.append(record)
+        summary['packets'] += 1
+        if len(batch) >= BATCH_SIZE:
+            packet_batch_handler(batch, stats_table, flows)
+            batch = []
+
+    packet_batch_handler(batch, stats_table, flows)
+    if window_end is not None:
+        flush_window(window_end, last=True)
+
+    elapsed = time.perf_counter() - wall_start
+    summary['seconds'] = elapsed
+    summary['packets_per_second'] = summary['packets'] / elapsed if elapsed else 0.0
+    service_logger.info(f"Прогон {path}: {summary['packets']} пакетов, {summary['windows']} окон, "
+                        f"{summary['records']} записей за {elapsed:.2f} с "
+                        f"({summary['packets_per_second']:.0f} пакетов/с)")
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Прогон pcap/pcapng через конвейер агента")
+    parser.add_argument('pcap', help="Путь к файлу pcap или pcapng")
+    parser.add_argument('--speed', type=float, default=0,
+                        help="Коэффициент ускорения относительно записи (0 - максимально быстро)")
+    parser.add_argument('--interval', type=float, default=INTERVAL_SECONDS, help="Длина окна в секундах")
+    parser.add_argument('--output', help="CSV-файл для результатов оценки")
+    parser.add_argument('--flows', help="Каталог хранилища для завершённых потоков (FeatureStore)")
+    args = parser.parse_args()
+
+    init_loggers()
+    diagnostics.configure()
+    from main import load_or_train_autoencoder, load_or_train_lstm
+    ae = load_or_train_autoencoder()
+    lstm = load_or_train_lstm()
+
+    collected = []
+    flow_store = None
+    if args.flows:
+        from feature_store import FeatureStore
+        from flow_table import FLOW_COLUMNS
+        flow_store = FeatureStore(args.flows, columns=FLOW_COLUMNS)
+    summary = replay_pcap(args.pcap, ae, lstm, interval=args.interval, speed=args.speed,
+                          on_results=collected.extend if args.output else None, flow_store=flow_store)
+    if args.output and collected:
+        pd.DataFrame(collected).to_csv(args.output, index=False)
+        service_logger.info(f"Результаты сохранены: {args.output}")
+    print(summary)
+
+
+if __name__ == "__main__":
+    main()
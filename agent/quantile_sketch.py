@@ -0,0 +1,150 @@
+# Потоковая оценка квантилей ошибок моделей (t-digest)
+
+import os
+import numpy as np
+
+COMPRESSION = 200       # Точность: число центроидов порядка COMPRESSION
+BUFFER_FACTOR = 5       # Сколько новых значений копить до сжатия, в единицах COMPRESSION
+MIN_COUNT = 500         # До стольких наблюдений в дайджесте порог по нему не считается
+
+
+class TDigest:
+    """Сливаемый t-digest: центроиды (среднее, вес), плотнее на хвостах распределения.
+
+    Новые значения копятся в буфере и сжимаются вместе с центроидами одной сортировкой,
+    поэтому память ограничена O(COMPRESSION) при любом числе наблюдений. Квантиль -
+    интерполяция по центроидам без сортировки исходных данных. Два дайджеста
+    объединяются через merge.
+    """
+
+    __slots__ = ('compression', 'means', 'weights', 'buffer', 'buffered', 'min', 'max')
+
+    def __init__(self, compression=COMPRESSION):
+        self.compression = compression
+        self.means = np.empty(0)
+        self.weights = np.empty(0)
+        self.buffer = []  # [(значения, веса)]
+        self.buffered = 0
+        self.min = np.inf
+        self.max = -np.inf
+
+    @property
+    def count(self):
+        return float(self.weights.sum()) + sum(float(w.sum()) for _, w in self.buffer)
+
+    def __len__(self):
+        return len(self.means)
+
+    def update(self, values, weights=None):
+        """Добавить пачку значений; NaN и бесконечности пропускаются"""
+        values = np.asarray(values, dtype=np.float64).ravel()
+        weights = np.ones_like(values) if weights is None else np.asarray(weights, dtype=np.float64).ravel()
+        finite = np.isfinite(values)
+        if not finite.all():
+            values, weights = values[finite], weights[finite]
+        if not len(values):
+            return self
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+        self.buffer.append((values, weights))
+        self.buffered += len(values)
+        if self.buffered > BUFFER_FACTOR * self.compression:
+            self._compress()
+        return self
+
+    def merge(self, other):
+        """Влить центроиды другого дайджеста"""
+        other._compress()
+        if len(other.means):
+            self.update(other.means, other.weights)
+            self.min, self.max = min(self.min, other.min), max(self.max, other.max)
+        return self
+
+    def _compress(self):
+        if not self.buffer:
+            return
+        means = np.concatenate([self.means] + [v for v, _ in self.buffer])
+        weights = np.concatenate([self.weights] + [w for _, w in self.buffer])
+        self.buffer, self.buffered = [], 0
+        order = np.argsort(means, kind='stable')
+        means, weights = means[order], weights[order]
+        total = weights.sum()
+        # Масштабная функция k1: центроид занимает не больше единицы k, у краёв q - меньше точек
+        q_left = (np.cumsum(weights) - weights) / total
+        k = self.compression / (2 * np.pi) * np.arcsin(2 * q_left - 1)
+        groups = np.floor(k - k[0]).astype(np.int64)
+        starts = np.flatnonzero(np.r_[True, groups[1:] != groups[:-1]])
+        merged_weights = np.add.reduceat(weights, starts)
+        self.means = np.add.reduceat(means * weights, starts) / merged_weights
+        self.weights = merged_weights
+
+    def quantile(self, q):
+        """Значение квантиля q (0..1, можно массив); NaN, если наблюдений нет"""
+        self._compress()
+        if not len(self.means):
+            return np.nan if np.ndim(q) == 0 else np.full(np.shape(q), np.nan)
+        total = self.weights.sum()
+        centers = np.cumsum(self.weights) - self.weights / 2
+        result = np.interp(np.asarray(q, dtype=np.float64) * total,
+                           np.r_[0, centers, total], np.r_[self.min, self.means, self.max])
+        return float(result) if np.ndim(result) == 0 else result
+
+    def cdf(self, x):
+        """Доля наблюдений не больше x"""
+        self._compress()
+        if not len(self.means):
+            return np.nan
+        total = self.weights.sum()
+        centers = np.cumsum(self.weights) - self.weights / 2
+        result = np.interp(x, np.r_[self.min, self.means, self.max], np.r_[0, centers, total]) / total
+        return float(result) if np.ndim(result) == 0 else result
+
+    def state(self, prefix=''):
+        """Массивы для сохранения в .npz вместе с моделью"""
+        self._compress()
+        return {f'{prefix}means': self.means, f'{prefix}weights': self.weights,
+                f'{prefix}params': np.array([self.compression, self.min, self.max], dtype=np.float64)}
+
+    @classmethod
+    def from_state(cls, arrays, prefix=''):
+        compression, low, high = arrays[f'{prefix}params']
+        digest = cls(compression=int(compression))
+        digest.means = np.asarray(arrays[f'{prefix}means'], dtype=np.float64)
+        digest.weights = np.asarray(arrays[f'{prefix}weights'], dtype=np.float64)
+        digest.min, digest.max = float(low), float(high)
+        return digest
+
+    def save(self, path):
+        tmp_path = path + '.tmp.npz'
+        np.savez(tmp_path, **self.state())
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """Дайджест из файла; None, если файла нет"""
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as data:
+            return cls.from_state(data)
+
+
+def threshold(sketch, live, errors, percentile):
+    """Порог аномалии по распределению ошибок обучающей выборки, затем пополнение live пачкой.
+
+    sketch (обучающая выборка) при работе не меняется, поэтому поток аномалий не сдвигает
+    порог. Если в нём меньше MIN_COUNT наблюдений (модель сохранена без распределения),
+    порог берётся из live, а пока и там мало данных - перцентиль самой пачки. В live
+    ошибки выше порога попадают обрезанными до него: доля хвоста сохраняется, но атака
+    не поднимает квантиль.
+    """
+    if sketch.count >= MIN_COUNT:
+        value = sketch.quantile(percentile / 100)
+    elif live.count >= MIN_COUNT:
+        value = live.quantile(percentile / 100)
+    else:
+        value = np.percentile(errors, percentile)
+    live.update(np.minimum(errors, value))
+    return value
+
+
+__all__ = ['TDigest', 'threshold', 'MIN_COUNT']
@@ -1,12 +1,24 @@
-from scapy.all import sniff
+import fnmatch
+import os
+import re
+import struct
 import time
+from threading import Thread
 import psutil
 from logger_config import service_logger
-from packet_processor import packet_handler
+from packet_processor import packet_handler, packet_batch_handler
+import metrics
 
 RETRY_DELAY = 5
 MAX_RETRIES = 10
 
+# Бэкенд захвата: scapy (по умолчанию) или afpacket (Linux, TPACKET_V3)
+CAPTURE_BACKEND = 'scapy'
+SOCKET_STATS_INTERVAL = 10  # Как часто читать счётчики ядра сокета scapy
+INTERFACE_SCAN_INTERVAL = 10  # Как часто искать новые интерфейсы под шаблоны CAPTURE_INTERFACES
+# struct tpacket_stats: tp_packets, tp_drops (сокет без кольца)
+_SOCKET_STATS = struct.Struct('=2I')
+
 def is_interface_available(interface_name):
     interfaces = psutil.net_if_addrs()
     if interface_name not in interfaces:
@@ -15,23 +27,141 @@ def is_interface_available(interface_name):
     return interface_name in stats and stats[interface_name].isup
 
 
-def robust_sniff(iface, stats_dict, stats_lock, stop_event):
+def _afpacket_capture(iface, stats_table, stop_event, flows=None, capture_filter=None):
+    from afpacket_capture import afpacket_sniff, DEFAULT_BLOCK_SIZE, DEFAULT_BLOCK_COUNT, DEFAULT_SNAPLEN
+    packets = metrics.PACKETS.labels(iface or 'all')
+    afpacket_sniff(
+        iface,
+        lambda batch: packet_batch_handler(batch, stats_table, flows, packets),
+        stop_event,
+        block_size=int(os.getenv('AFPACKET_BLOCK_SIZE', DEFAULT_BLOCK_SIZE)),
+        block_count=int(os.getenv('AFPACKET_BLOCK_COUNT', DEFAULT_BLOCK_COUNT)),
+        snaplen=int(os.getenv('AFPACKET_SNAPLEN', DEFAULT_SNAPLEN)),
+        capture_filter=capture_filter,
+    )
+
+
+def _read_socket_stats(sock, label):
+    """Счётчики ядра PACKET_STATISTICS сокета scapy (сбрасываются при чтении) -> метрики интерфейса"""
+    from afpacket_capture import SOL_PACKET, PACKET_STATISTICS
+    received, drops = _SOCKET_STATS.unpack(sock.getsockopt(SOL_PACKET, PACKET_STATISTICS, _SOCKET_STATS.size))
+    metrics.CAPTURE_KERNEL_PACKETS.labels(label).inc(received)
+    metrics.CAPTURE_DROPS.labels(label).inc(drops)
+    if drops:
+        service_logger.warning(f"Захват {label}: потеряно ядром {drops} из {received} пакетов")
+
+
+def _scapy_capture(iface, stats_table, stop_event, flows=None, capture_filter=None):
+    # Вместо scapy.all: только разбор IPv4, втрое быстрее импорт
+    from scapy.sendrecv import sniff
+    from scapy.config import conf
+    import scapy.layers.inet  # noqa: F401 - регистрация IP/TCP/UDP в разборе кадров
+    label = iface or 'all'
+    packets = metrics.PACKETS.labels(label)
+    # Сокет открывается здесь: на него ставится своя BPF-программа (libpcap не нужен)
+    # и с него читаются счётчики потерь ядра
+    sock = conf.L2listen(iface=iface)
+    next_stats = time.monotonic() + SOCKET_STATS_INTERVAL
+
+    def handler(pkt):
+        nonlocal next_stats
+        packet_handler(pkt, stats_table, flows, packets)
+        if time.monotonic() >= next_stats:
+            _read_socket_stats(sock.ins, label)
+            next_stats += SOCKET_STATS_INTERVAL
+
+    try:
+        if capture_filter is not None:
+            capture_filter.attach(sock.ins)
+        sniff(opened_socket=sock, prn=handler, store=0, stop_filter=lambda pkt: stop_event.is_set())
+        _read_socket_stats(sock.ins, label)
+    finally:
+        if capture_filter is not None:
+            capture_filter.detach(sock.ins)
+        sock.close()
+
+
+def robust_sniff(iface, stats_table, stop_event, flows=None, capture_filter=None):
+    backend = os.getenv('CAPTURE_BACKEND', CAPTURE_BACKEND).strip().lower()
+    service_logger.info(f"Бэкенд захвата {iface or 'все интерфейсы'}: {backend}")
     retries = 0
-    while retries < MAX_RETRIES:
-        if stop_event.is_set():
-            service_logger.info("Сниффинг приостановлен во время переобучения")
-            time.sleep(5)
-            continue
-        
+    # stop_event означает завершение агента: переобучение идёт в отдельном процессе и захват не прерывает
+    while retries < MAX_RETRIES and not stop_event.is_set():
         try:
             if iface and not is_interface_available(iface):
                 time.sleep(RETRY_DELAY)
                 retries += 1
                 continue
-            
-            sniff(iface=iface, prn=lambda pkt: packet_handler(pkt, stats_dict, stats_lock), store=0)
+
+            if backend == 'afpacket':
+                _afpacket_capture(iface, stats_table, stop_event, flows, capture_filter)
+            else:
+                _scapy_capture(iface, stats_table, stop_event, flows, capture_filter)
             retries = 0
         except Exception as e:
-            service_logger.error(f"Ошибка захвата: {e}. Retry {retries + 1}/{MAX_RETRIES}")
+            service_logger.error(f"Ошибка захвата {iface}: {e}. Retry {retries + 1}/{MAX_RETRIES}")
             time.sleep(RETRY_DELAY)
-            retries += 1
\ No newline at end of file
+            retries += 1
+
+
+def match_interfaces(patterns):
+    """Имена интерфейсов системы, подходящие под шаблоны (eth0, enp*, br-*)"""
+    return [name for name in sorted(psutil.net_if_addrs())
+            if any(fnmatch.fnmatchcase(name, pattern) for pattern in patterns)]
+
+
+class CaptureWorkers:
+    """Поток robust_sniff на каждый интерфейс, подходящий под шаблоны.
+
+    run() раз в scan_interval сверяет интерфейсы системы с шаблонами и запускает захват
+    на появившихся и поднятых. Поток, завершившийся после MAX_RETRIES попыток (интерфейс
+    пропал), убирается и запускается снова, когда интерфейс вернётся. Все потоки пишут
+    в общие stats_table и flows.
+    """
+
+    def __init__(self, patterns, stats_table, stop_event, flows=None, capture_filter=None, scan_interval=None):
+        if isinstance(patterns, str):
+            patterns = re.split(r'[,\s]+', patterns)
+        self.patterns = [pattern for pattern in patterns if pattern]
+        self.stats_table = stats_table
+        self.stop_event = stop_event
+        self.flows = flows
+        self.capture_filter = capture_filter
+        self.scan_interval = scan_interval if scan_interval is not None else \
+            float(os.getenv('INTERFACE_SCAN_INTERVAL', INTERFACE_SCAN_INTERVAL))
+        self.workers = {}
+
+    def scan(self):
+        """Запуск захвата на новых интерфейсах; список запущенных"""
+        for name, thread in list(self.workers.items()):
+            if not thread.is_alive():
+                service_logger.warning(f"Захват {name} остановлен, ожидание интерфейса")
+                del self.workers[name]
+        started = []
+        for name in match_interfaces(self.patterns):
+            if name in self.workers or not is_interface_available(name):
+                continue
+            thread = Thread(target=robust_sniff,
+                            args=(name, self.stats_table, self.stop_event, self.flows, self.capture_filter),
+                            daemon=True, name=f"SniffThread-{name}")
+            thread.start()
+            self.workers[name] = thread
+            started.append(name)
+        if started:
+            service_logger.info(f"Запущен захват: {', '.join(started)}; всего интерфейсов {len(self.workers)}")
+        metrics.CAPTURE_WORKERS.set(len(self.workers))
+        return started
+
+    def run(self):
+        """Поиск интерфейсов до установки stop_event"""
+        service_logger.info(f"Интерфейсы захвата: {', '.join(self.patterns)}")
+        while True:
+            if not self.scan() and not self.workers:
+                service_logger.debug("Нет поднятых интерфейсов под шаблоны %s", self.patterns)
+            if self.stop_event.wait(self.scan_interval):
+                break
+        for thread in self.workers.values():
+            thread.join(RETRY_DELAY)
+
+
+__all__ = ['robust_sniff', 'is_interface_available', 'match_interfaces', 'CaptureWorkers', 'CAPTURE_BACKEND']
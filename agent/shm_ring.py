@@ -0,0 +1,187 @@
+# Передача пачек признаков между процессами захвата и инференса через разделяемую память
+
+import os
+import socket
+import struct
+import time
+import numpy as np
+from multiprocessing import shared_memory
+from logger_config import service_logger
+from packet_processor import FEATURE_NAMES
+from feature_queue import FEATURE_QUEUE_BATCH, FEATURE_QUEUE_MAX_DELAY
+
+# Запись фиксированной длины: IPv4 как uint32, метка времени окна (секунды), признаки FEATURE_NAMES
+RECORD_FIELDS = 2 + len(FEATURE_NAMES)
+RING_CAPACITY = 65536
+# Заголовок: head (записано), tail (прочитано), dropped (отброшено при переполнении)
+_HEADER = 3
+_HEAD, _TAIL, _DROPPED = range(_HEADER)
+_HEADER_BYTES = 64
+
+
+class SharedRing:
+    """Кольцевой буфер записей float64 в multiprocessing.shared_memory.
+
+    Один писатель и один читатель: head меняет только писатель, tail - только читатель,
+    поэтому блокировки не нужны. Записи пишутся до сдвига head, читатель не видит
+    незаконченную пачку. Семафор будит читателя, когда появляются данные.
+    """
+
+    def __init__(self, name=None, capacity=RING_CAPACITY, semaphore=None, create=False):
+        size = _HEADER_BYTES + capacity * RECORD_FIELDS * 8
+        # Читатель запускается через spawn и делит resource_tracker с создателем, сегмент удаляет создатель
+        self.shm = shared_memory.SharedMemory(name=name, create=create, size=size if create else 0)
+        self.owner = create
+        self.capacity = capacity
+        self.header = np.ndarray((_HEADER,), dtype=np.uint64, buffer=self.shm.buf)
+        self.records = np.ndarray((capacity, RECORD_FIELDS), dtype=np.float64,
+                                  buffer=self.shm.buf, offset=_HEADER_BYTES)
+        if create:
+            self.header[:] = 0
+        self.semaphore = semaphore
+
+    @classmethod
+    def create(cls, capacity=RING_CAPACITY, semaphore=None):
+        return cls(capacity=capacity, semaphore=semaphore, create=True)
+
+    @classmethod
+    def attach(cls, name, capacity=RING_CAPACITY, semaphore=None):
+        return cls(name=name, capacity=capacity, semaphore=semaphore)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    @property
+    def dropped(self):
+        return int(self.header[_DROPPED])
+
+    def __len__(self):
+        return int(self.header[_HEAD] - self.header[_TAIL])
+
+    def write(self, records):
+        """Записать пачку целиком; при нехватке места пачка отбрасывается, захват не ждёт"""
+        count = len(records)
+        head = int(self.header[_HEAD])
+        if count > self.capacity - (head - int(self.header[_TAIL])):
+            self.header[_DROPPED] += count
+            return False
+        start = head % self.capacity
+        first = min(count, self.capacity - start)
+        self.records[start:start + first] = records[:first]
+        self.records[:count - first] = records[first:]
+        self.header[_HEAD] = head + count
+        if self.semaphore is not None:
+            self.semaphore.release()
+        return True
+
+    def read(self, timeout=None, max_records=None):
+        """Записи, накопленные к моменту вызова, не больше max_records (копия); пустой массив по тайм-ауту"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not len(self):
+            if self.semaphore is None:
+                return self.records[:0].copy()
+            remaining = None if deadline is None else max(deadline - time.monotonic(), 0)
+            # Лишние отметки семафора от уже прочитанных пачек просто пропускаются
+            if not self.semaphore.acquire(timeout=remaining) and not len(self):
+                return self.records[:0].copy()
+        tail, head = int(self.header[_TAIL]), int(self.header[_HEAD])
+        start, count = tail % self.capacity, head - tail
+        if max_records is not None:
+            count = min(count, max_records)
+        first = min(count, self.capacity - start)
+        data = np.concatenate((self.records[start:start + first], self.records[:count - first]))
+        self.header[_TAIL] = tail + count
+        return data
+
+    def close(self):
+        self.header = self.records = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+def ip_to_int(ip):
+    return struct.unpack('!I', socket.inet_aton(ip))[0]
+
+
+def int_to_ip(value):
+    return socket.inet_ntoa(struct.pack('!I', int(value)))
+
+
+def encode_batch(data):
+    """Список словарей close_window -> массив записей (IPv6 и некорректные записи пропускаются)"""
+    import pandas as pd
+    rows = []
+    for item in data:
+        try:
+            rows.append([ip_to_int(item['ip']), pd.Timestamp(item['timestamp']).value / 1e9]
+                        + [item[name] for name in FEATURE_NAMES])
+        except (OSError, KeyError, TypeError, ValueError):
+            service_logger.debug("Запись не помещается в формат кольца: %s", item)
+    return np.array(rows, dtype=np.float64).reshape(-1, RECORD_FIELDS)
+
+
+def decode_batch(records):
+    """Массив записей -> список словарей в формате close_window"""
+    import pandas as pd
+    timestamps = pd.to_datetime(records[:, 1], unit='s').round('us')
+    features = records[:, 2:].tolist()
+    return [dict(zip(FEATURE_NAMES, values), ip=int_to_ip(ip), timestamp=ts)
+            for ip, ts, values in zip(records[:, 0], timestamps, features)]
+
+
+class SharedFeatureQueue:
+    """Обёртка над SharedRing с интерфейсом FeatureQueue для periodic_analysis и predict_and_save_anomalies.
+
+    Писатель не ждёт читателя в другом процессе: при переполнении кольца новая пачка
+    отбрасывается (политика drop-newest).
+    """
+    policy = 'drop-newest'
+
+    def __init__(self, ring):
+        self.ring = ring
+        self.reported_drops = 0
+
+    @property
+    def dropped(self):
+        return self.ring.dropped
+
+    def put(self, data):
+        records = encode_batch(data)
+        if len(records) and not self.ring.write(records):
+            dropped = self.ring.dropped
+            service_logger.warning(f"Кольцо признаков переполнено, отброшено записей: {dropped - self.reported_drops}")
+            self.reported_drops = dropped
+
+    def get(self, block=True, timeout=None):
+        return decode_batch(self.ring.read(timeout if block else 0))
+
+    def get_batch(self, max_records=None, timeout=None, max_delay=None):
+        """Все записи кольца, не больше max_records; см. FeatureQueue.get_batch"""
+        max_records = max_records if max_records is not None else \
+            int(os.getenv('FEATURE_QUEUE_BATCH', FEATURE_QUEUE_BATCH))
+        max_delay = max_delay if max_delay is not None else \
+            float(os.getenv('FEATURE_QUEUE_MAX_DELAY', FEATURE_QUEUE_MAX_DELAY))
+        records = self.ring.read(timeout, max_records)
+        if len(records) and max_delay > 0:
+            # Время постановки в кольце не хранится: задержка отсчитывается от первой прочитанной пачки
+            deadline = time.monotonic() + max_delay
+            while len(records) < max_records and time.monotonic() < deadline:
+                more = self.ring.read(deadline - time.monotonic(), max_records - len(records))
+                if len(more):
+                    records = np.concatenate((records, more))
+        return decode_batch(records)
+
+    def empty(self):
+        return not len(self.ring)
+
+    def qsize(self):
+        return len(self.ring)
+
+    def task_done(self):
+        pass
+
+
+__all__ = ['SharedRing', 'SharedFeatureQueue', 'encode_batch', 'decode_batch', 'ip_to_int', 'int_to_ip',
+           'RECORD_FIELDS', 'RING_CAPACITY']
@@ -1,24 +1,34 @@
 import numpy as np
 import os
-from tensorflow.keras.models import Sequential
-from tensorflow.keras.layers import LSTM, Dense, Dropout
-from tensorflow.keras.regularizers import l2
-from tensorflow.keras.optimizers import Adam
-from tensorflow.keras.callbacks import EarlyStopping
-from sklearn.preprocessing import RobustScaler
-import matplotlib.pyplot as plt
+from numpy.lib.stride_tricks import sliding_window_view
+from diagnostics import diagnostics, pyplot
+from traffic_stats import SequenceStore
+import quantile_sketch
 
 class SimpleLSTM:
-    def __init__(self, input_dim, sequence_length=3, units=32, dropout=0.3):
+    def __init__(self, input_dim, sequence_length=3, units=32, dropout=0.3, model=None):
         self.input_dim = input_dim
         self.sequence_length = sequence_length
         self.min_data_points = sequence_length
         self.units = units
         self.dropout = dropout
+        from sklearn.preprocessing import RobustScaler
         self.scaler = RobustScaler()
-        self.model = self._build_model()
+        # model - готовая модель (например, numpy_inference.SequentialNet) вместо новой сети Keras
+        self.model = model if model is not None else self._build_model()
+        # Окно одного IP: sequence_length входных строк и следующая за ними строка-цель
+        self.sequences = SequenceStore(sequence_length + 1, input_dim)
+        # Распределение ошибок предсказания на обучающей выборке - задаёт порог, при работе не меняется
+        self.error_sketch = quantile_sketch.TDigest()
+        # Ошибки при работе (выше порога - обрезанные до него), сохраняются рядом с версией
+        self.live_sketch = quantile_sketch.TDigest()
 
     def _build_model(self):
+        # TensorFlow нужен только для построения и обучения; инференс может идти через numpy_inference
+        from tensorflow.keras.models import Sequential
+        from tensorflow.keras.layers import LSTM, Dense, Dropout
+        from tensorflow.keras.regularizers import l2
+        from tensorflow.keras.optimizers import Adam
         model = Sequential([
             LSTM(self.units, 
                  input_shape=(self.sequence_length, self.input_dim),
@@ -42,8 +52,18 @@ class SimpleLSTM:
         X = np.clip(X, -1e6, 1e6)
         return X
 
+    def scale(self, X):
+        """Масштабирование и ограничение выбросов, как при обучении."""
+        return np.clip(self.scaler.transform(X), -10, 10)
+
+    @staticmethod
+    def sliding_windows(data, length):
+        """Скользящие окна длины length как представление без копирования."""
+        return sliding_window_view(data, (length, data.shape[1]))[:, 0]
+
     def visualize_sequences(self, X, num_samples=3):
         """Визуализация последовательностей."""
+        plt = pyplot()
         os.makedirs('lstm_png', exist_ok=True)
         for i in range(min(num_samples, len(X))):
             group = X[i]
@@ -81,6 +101,7 @@ class SimpleLSTM:
 
     def train(self, X_data, epochs=7, batch_size=16, validation_split=0.2, verbose=1, threshold_percentile=98):
         """Обучение модели LSTM."""
+        from tensorflow.keras.callbacks import EarlyStopping
         X_data = self.preprocess_data(X_data)
         self.scaler.fit(X_data)
         self.visualize_sequences([X_data[:self.sequence_length * 3]], num_samples=3)
@@ -103,19 +124,18 @@ class SimpleLSTM:
             callbacks=[early_stopping],
             verbose=verbose
         )
+        windows = np.concatenate((X_sequences, y_sequences[:, np.newaxis]), axis=1)
+        self.error_sketch = quantile_sketch.TDigest().update(self.window_errors(windows))
         self.plot_training_history(history)
         return history
 
     def predict(self, X_data):
         """Предсказание следующих значений."""
-        X_data = self.preprocess_data(X_data)
-        scaled_data = self.scaler.transform(X_data)
-        scaled_data = np.clip(scaled_data, -10, 10)
+        scaled_data = self.scale(self.preprocess_data(X_data))
         
         predictions = []
         if len(scaled_data) >= self.sequence_length:
-            X_seq = np.array([scaled_data[i:i + self.sequence_length] 
-                              for i in range(len(scaled_data) - self.sequence_length + 1)])
+            X_seq = self.sliding_windows(scaled_data, self.sequence_length)
             pred = self.model.predict(X_seq, verbose=0)
             predictions.append(pred)
         else:
@@ -123,29 +143,57 @@ class SimpleLSTM:
         
         return predictions
 
+    def window_errors(self, windows):
+        """MSE предсказания последней строки каждого окна по предыдущим - один вызов predict."""
+        y_pred = self.model.predict(windows[:, :self.sequence_length], verbose=0)
+        return np.mean(np.square(windows[:, self.sequence_length] - y_pred), axis=1)
+
     def detect_anomalies(self, X_data, threshold_percentile=90):
-        """Обнаружение аномалий на основе ошибки предсказания."""
+        """Обнаружение аномалий на основе ошибки предсказания для одного временного ряда."""
         X_data = self.preprocess_data(X_data)
-        scaled_data = self.scaler.transform(X_data)
-        scaled_data = np.clip(scaled_data, -10, 10)
-        errors = []
-        
-        if len(scaled_data) > self.sequence_length:
-            X_seq = np.array([scaled_data[i:i + self.sequence_length] 
-                              for i in range(len(scaled_data) - self.sequence_length)])
-            if X_seq.shape[0] == 0:
-                return np.array([0] * len(X_data)), np.array([]), 0
-            y_true = scaled_data[self.sequence_length:]
-            y_pred = self.model.predict(X_seq, verbose=0)
-            mse = np.mean(np.square(y_true - y_pred), axis=1)
-            errors.extend(mse)
-        
-        if not errors:
-            return np.array([0] * len(X_data)), np.array([]), 0
+        if len(X_data) <= self.sequence_length:
+            return np.zeros(len(X_data), dtype=int), np.array([]), 0
+
+        scaled_data = self.scale(X_data)
+        errors = self.window_errors(self.sliding_windows(scaled_data, self.sequence_length + 1))
+        threshold = quantile_sketch.threshold(self.error_sketch, self.live_sketch, errors, threshold_percentile)
         
-        errors = np.array(errors)
-        threshold = np.percentile(errors, threshold_percentile)
+        # Гистограмма строится подсистемой диагностики по её режиму, а не на каждой пачке
+        diagnostics.record('lstm', errors, threshold)
         
+        anomalies = np.zeros(len(X_data), dtype=int)
+        anomalies[self.sequence_length:] = errors > threshold
+        return anomalies, errors, threshold
+
+    def score_sequences(self, ips, X_data, threshold_percentile=90):
+        """Оценка пачки строк разных IP по собственной истории каждого IP.
+
+        Строка попадает в кольцо своего IP; все IP с полным окном оцениваются одним
+        вызовом predict. Строки без накопленной истории не считаются аномальными,
+        их ошибка - NaN.
+        """
+        X_data = self.preprocess_data(X_data)
+        anomalies = np.zeros(len(X_data), dtype=int)
+        errors = np.full(len(X_data), np.nan)
+        scored, windows = self.sequences.extend(ips, X_data)
+        if not len(scored):
+            return anomalies, errors, 0
+
+        shape = windows.shape
+        scaled = self.scale(windows.reshape(-1, shape[2])).reshape(shape)
+        errors[scored] = self.window_errors(scaled)
+        # Порог - квантиль распределения ошибок обучающей выборки, а не перцентиль текущей пачки
+        threshold = quantile_sketch.threshold(self.error_sketch, self.live_sketch, errors[scored], threshold_percentile)
+
+        diagnostics.record('lstm', errors[scored], threshold)
+
+        anomalies[scored] = errors[scored] > threshold
+        return anomalies, errors, threshold
+
+    @staticmethod
+    def plot_error_distribution(errors, threshold):
+        """Гистограмма ошибок предсказания."""
+        plt = pyplot()
         plt.figure(figsize=(10, 6))
         plt.hist(errors, bins=50, color='skyblue', edgecolor='black', alpha=0.7)
         plt.axvline(threshold, color='red', linestyle='--', label=f'Threshold ({threshold:.4f})')
@@ -156,23 +204,10 @@ class SimpleLSTM:
         os.makedirs('lstm_png', exist_ok=True)
         plt.savefig('lstm_png/error_distribution.png')
         plt.close()
-        
-        anomalies = []
-        if len(scaled_data) > self.sequence_length:
-            X_seq = np.array([scaled_data[i:i + self.sequence_length] 
-                              for i in range(len(scaled_data) - self.sequence_length)])
-            y_true = scaled_data[self.sequence_length:]
-            y_pred = self.model.predict(X_seq, verbose=0)
-            mse = np.mean(np.square(y_true - y_pred), axis=1)
-            anomalies.extend((mse > threshold).astype(int))
-            anomalies = [0] * self.sequence_length + anomalies
-        else:
-            anomalies = [0] * len(X_data)
-        
-        return np.array(anomalies), errors, threshold
 
     def plot_training_history(self, history):
         """Визуализация истории обучения."""
+        plt = pyplot()
         plt.figure(figsize=(10, 6))
         plt.plot(history.history['loss'], label='Train Loss')
         plt.plot(history.history['val_loss'], label='Validation Loss')
@@ -198,7 +233,9 @@ class SimpleLSTM:
             return None
         model = tf.keras.models.load_model(model_path)
         scaler = joblib.load(scaler_path)
-        lstm = cls(input_dim=10)
-        lstm.model = model
+        lstm = cls(input_dim=10, model=model)
         lstm.scaler = scaler
-        return lstm
\ No newline at end of file
+        return lstm
+
+
+diagnostics.register('lstm', SimpleLSTM.plot_error_distribution)
@@ -0,0 +1,67 @@
+# Таблица окон статистики, разбитая на шарды с отдельными блокировками
+
+from threading import Lock
+from traffic_stats import WindowAccumulator
+
+STATS_SHARDS = 16
+
+
+class StatsShard:
+    __slots__ = ('lock', 'windows')
+
+    def __init__(self):
+        self.lock = Lock()
+        self.windows = {}
+
+
+class ShardedStatsTable:
+    """Окна текущего интервала по IP, распределённые по шардам по хэшу IP.
+
+    Поток захвата блокирует только шард нужного IP, а поток анализа забирает
+    окна целого шарда подменой словаря за O(1) и считает признаки уже без блокировки.
+    """
+
+    def __init__(self, num_shards=STATS_SHARDS, interval_gap=0.25):
+        self.shards = [StatsShard() for _ in range(num_shards)]
+        self.num_shards = num_shards
+        self.interval_gap = interval_gap
+
+    def _shard(self, ip):
+        return self.shards[hash(ip) % self.num_shards]
+
+    def _add(self, shard, ip, timestamp, length, is_fwd):
+        window = shard.windows.get(ip)
+        if window is None:
+            window = shard.windows[ip] = WindowAccumulator(self.interval_gap)
+        window.add(timestamp, length, is_fwd)
+
+    def add_packet(self, timestamp, src_ip, dst_ip, length):
+        """Учёт пакета в окне отправителя (fwd) и получателя (bck)"""
+        src_shard = self._shard(src_ip)
+        dst_shard = self._shard(dst_ip)
+        with src_shard.lock:
+            self._add(src_shard, src_ip, timestamp, length, True)
+            if dst_shard is src_shard:
+                self._add(dst_shard, dst_ip, timestamp, length, False)
+                return
+        with dst_shard.lock:
+            self._add(dst_shard, dst_ip, timestamp, length, False)
+
+    def swap_shard(self, index):
+        """Забрать окна шарда, оставив на их месте пустой словарь"""
+        shard = self.shards[index]
+        with shard.lock:
+            windows, shard.windows = shard.windows, {}
+        return windows
+
+    def swap_windows(self):
+        """Закрыть текущий интервал: список (ip, WindowAccumulator) по всем шардам"""
+        closed = []
+        for index in range(self.num_shards):
+            closed.extend(self.swap_shard(index).items())
+        return closed
+
+    def __len__(self):
+        return sum(len(shard.windows) for shard in self.shards)
+
+__all__ = ['ShardedStatsTable', 'STATS_SHARDS']
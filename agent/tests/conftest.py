@@ -0,0 +1,5 @@
+# Модули агента импортируются по имени, как при запуске из каталога agent
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
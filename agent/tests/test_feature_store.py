@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+from feature_store import FeatureStore, COLUMNS
+
+
+def _batch(start, count):
+    columns = {name: np.arange(start, start + count).astype(dtype) for name, dtype in COLUMNS}
+    # Все строки в одном часовом разделе
+    columns['timestamp'] = np.full(count, 3600.0 * 500000 + start)
+    return columns
+
+
+def test_partial_write_does_not_shift_later_rows(tmp_path, monkeypatch):
+    store = FeatureStore(str(tmp_path), retention_hours=0, max_mb=1024)
+    store.append(_batch(0, 3))
+
+    # Сбой после записи части столбцов
+    real_open = open
+    written = []
+
+    def failing_open(path, mode='r', *args, **kwargs):
+        if mode == 'ab' and len(written) == 4:
+            raise OSError(28, "No space left on device")
+        written.append(path)
+        return real_open(path, mode, *args, **kwargs)
+
+    monkeypatch.setattr('builtins.open', failing_open)
+    with pytest.raises(OSError):
+        store.append(_batch(3, 2))
+    monkeypatch.undo()
+
+    # Новый процесс продолжает запись в тот же раздел
+    store = FeatureStore(str(tmp_path), retention_hours=0, max_mb=1024)
+    store.append(_batch(10, 2))
+    data = store.read()
+    for name, _ in COLUMNS:
+        if name != 'timestamp':
+            assert list(np.asarray(data[name], dtype=np.int64)) == [0, 1, 2, 10, 11], name
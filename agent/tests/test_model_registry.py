@@ -0,0 +1,24 @@
+import os
+import model_registry
+
+
+def test_rejected_first_version_is_loaded_once(tmp_path, monkeypatch):
+    monkeypatch.setattr(model_registry, 'VERSIONS_DIR', str(tmp_path / 'versions'))
+    monkeypatch.setattr(model_registry, 'CURRENT_FILE', str(tmp_path / 'CURRENT'))
+    os.makedirs(tmp_path / 'versions' / '20250101-000000')
+    model_registry.publish('20250101-000000')
+    loads = []
+
+    def broken(version, numpy_backend=False):
+        loads.append(version)
+        raise ValueError("повреждённая модель")
+
+    monkeypatch.setattr(model_registry, 'load_version', broken)
+    registry = model_registry.ModelRegistry()
+    # Агент работает на моделях без версии, откатиться некуда
+    registry.poll()
+    registry.poll()
+    assert loads == ['20250101-000000']
+    assert model_registry.current_version() is None
+    assert registry.current[0] is None
+    assert not registry.load_current()
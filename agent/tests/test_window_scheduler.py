@@ -0,0 +1,38 @@
+from window_scheduler import WindowScheduler
+
+
+class _Clock:
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class _StopEvent:
+    """Ожидание сдвигает часы; factor < 1 - Event.wait вернулся раньше времени по часам"""
+
+    def __init__(self, clock, factor=1.0):
+        self.clock = clock
+        self.factor = factor
+
+    def wait(self, seconds):
+        self.clock.now += seconds * self.factor
+        return False
+
+
+def test_boundaries_only_grow_after_clock_step_back():
+    clock = _Clock(100.0)
+    scheduler = WindowScheduler(5, grace=0, clock=clock)
+    event = _StopEvent(clock)
+    assert [scheduler.wait(event), scheduler.wait(event)] == [105, 110]
+    clock.now -= 7
+    assert scheduler.wait(event) == 115
+
+
+def test_early_wakeup_does_not_repeat_boundary():
+    clock = _Clock(100.0)
+    scheduler = WindowScheduler(5, grace=0, clock=clock)
+    event = _StopEvent(clock, factor=0.5)
+    assert [scheduler.wait(event), scheduler.wait(event)] == [105, 110]
+    assert clock.now >= 110
@@ -1,98 +1,351 @@
+import os
 import time
+from collections import OrderedDict
 import numpy as np
-from scapy.all import IP
 
-class TrafficStats:
-    def __init__(self, max_history=10):
-        self.packets = []
-        self.start_time = time.time()
-        self.history = []
-        self.max_history = max_history
-        self.ip = None
-        self.interval_gap = 0.25  # Максимальный допустимый разрыв между интервалами (в секундах)
+HOST_TTL = 600        # Секунд без трафика, после которых история IP забывается
+MAX_HOSTS = 65536     # Наибольшее число IP с историей; сверх него вытесняются самые давние
 
-    def add_packet(self, pkt, timestamp):
-        self.packets.append((pkt, timestamp))
 
-    def reset_packets(self):
-        self.packets = []
-        self.start_time = time.time()
+class DirectionStats:
+    """Инкрементальная статистика пакетов одного направления (fwd или bck)."""
+    __slots__ = ('count', 'bytes', 'max_size', 'first_ts', 'last_ts', 'iat_count', 'iat_mean', 'iat_m2', 'iat_min')
+
+    def __init__(self):
+        self.count = 0
+        self.bytes = 0
+        self.max_size = 0
+        self.first_ts = 0.0
+        self.last_ts = 0.0
+        self.iat_count = 0
+        self.iat_mean = 0.0
+        self.iat_m2 = 0.0
+        self.iat_min = 0.0
+
+    def add(self, timestamp, length):
+        if self.count:
+            # Алгоритм Уэлфорда для среднего и дисперсии межпакетных интервалов
+            iat = timestamp - self.last_ts
+            n = self.iat_count + 1
+            delta = iat - self.iat_mean
+            self.iat_mean += delta / n
+            self.iat_m2 += delta * (iat - self.iat_mean)
+            if n == 1 or iat < self.iat_min:
+                self.iat_min = iat
+            self.iat_count = n
+        else:
+            self.first_ts = timestamp
+        self.count += 1
+        self.bytes += length
+        if length > self.max_size:
+            self.max_size = length
+        self.last_ts = timestamp
+
+    def _merge_iats(self, count, mean, m2, minimum):
+        # Объединение статистик Уэлфорда двух наборов интервалов (формула Чана)
+        n = self.iat_count + count
+        delta = mean - self.iat_mean
+        if not self.iat_count or minimum < self.iat_min:
+            self.iat_min = minimum
+        self.iat_mean += delta * count / n
+        self.iat_m2 += m2 + delta * delta * self.iat_count * count / n
+        self.iat_count = n
+
+    def merge(self, other):
+        """Дописать статистику следующего окна other, как если бы его пакеты пришли через add()"""
+        if not other.count:
+            return
+        if not self.count:
+            for name in self.__slots__:
+                setattr(self, name, getattr(other, name))
+            return
+        # Интервал между последним пакетом этого окна и первым пакетом следующего
+        self._merge_iats(1, other.first_ts - self.last_ts, 0.0, other.first_ts - self.last_ts)
+        if other.iat_count:
+            self._merge_iats(other.iat_count, other.iat_mean, other.iat_m2, other.iat_min)
+        self.count += other.count
+        self.bytes += other.bytes
+        if other.max_size > self.max_size:
+            self.max_size = other.max_size
+        self.last_ts = other.last_ts
+
+    def avg_size(self):
+        return self.bytes / self.count if self.count else 0
+
+    def iat_std(self):
+        # Стандартное отклонение генеральной совокупности, как np.std
+        return (self.iat_m2 / self.iat_count) ** 0.5 if self.iat_count else 0
+
+    def min_iat(self):
+        return self.iat_min if self.iat_count else 0
+
+
+class WindowAccumulator:
+    """Признаки окна, обновляемые за O(1) на каждый пакет."""
+    __slots__ = ('interval_gap', 'packets', 'bytes', 'closed_duration', 'interval_start', 'last_ts', 'first_ts',
+                 'first_end', 'fwd', 'bck')
 
-    def _split_into_intervals(self):
-        """Разделяет пакеты на временные интервалы активности"""
+    def __init__(self, interval_gap=0.25):
+        self.interval_gap = interval_gap
+        self.reset()
+
+    def reset(self):
+        self.packets = 0
+        self.bytes = 0
+        self.closed_duration = 0.0  # Длительность уже завершённых интервалов активности
+        self.interval_start = 0.0
+        self.last_ts = 0.0
+        self.first_ts = 0.0
+        self.first_end = None       # Последний пакет первого интервала активности, когда он закрыт
+        self.fwd = DirectionStats()
+        self.bck = DirectionStats()
+
+    def add(self, timestamp, length, is_fwd):
         if not self.packets:
-            return []
-
-        sorted_packets = sorted(self.packets, key=lambda x: x[1])
-        intervals = []
-        current_interval = [sorted_packets[0]]
-
-        for pkt, ts in sorted_packets[1:]:
-            last_ts = current_interval[-1][1]
-            if ts - last_ts > self.interval_gap:
-                intervals.append(current_interval)
-                current_interval = [(pkt, ts)]
-            else:
-                current_interval.append((pkt, ts))
-        intervals.append(current_interval)
-        
-        return intervals
+            self.interval_start = timestamp
+            self.last_ts = timestamp
+            self.first_ts = timestamp
+        elif timestamp - self.last_ts > self.interval_gap:
+            # Разрыв больше interval_gap закрывает текущий интервал активности
+            if self.first_end is None:
+                self.first_end = self.last_ts
+            self.closed_duration += max(self.last_ts - self.interval_start, 1e-6)
+            self.interval_start = timestamp
+            self.last_ts = timestamp
+        elif timestamp > self.last_ts:
+            # Пакеты, пришедшие не по порядку, остаются внутри текущего интервала
+            self.last_ts = timestamp
+        self.packets += 1
+        self.bytes += length
+        (self.fwd if is_fwd else self.bck).add(timestamp, length)
 
-    def set_ip(self, ip):
-        self.ip = ip
+    def merge(self, other):
+        """Дописать следующее окно other: окно крупного разрешения из мелких без повторного прохода по пакетам.
+
+        Для пакетов по порядку времени результат совпадает с их добавлением через add(): если
+        other начался не позже interval_gap после конца этого окна, текущий интервал
+        активности продолжается до конца первого интервала other.
+        """
+        if not other.packets:
+            return
+        if not self.packets:
+            for name in self.__slots__:
+                if name not in ('fwd', 'bck'):
+                    setattr(self, name, getattr(other, name))
+            self.fwd.merge(other.fwd)
+            self.bck.merge(other.bck)
+            return
+        if other.first_ts - self.last_ts > self.interval_gap:
+            if self.first_end is None:
+                self.first_end = self.last_ts
+            self.closed_duration += max(self.last_ts - self.interval_start, 1e-6) + other.closed_duration
+            self.interval_start = other.interval_start
+            self.last_ts = other.last_ts
+        elif other.first_end is None:
+            # У other один интервал активности - он продолжает текущий
+            if other.last_ts > self.last_ts:
+                self.last_ts = other.last_ts
+        else:
+            # Текущий интервал заканчивается вместе с первым интервалом other
+            end = max(self.last_ts, other.first_end)
+            if self.first_end is None:
+                self.first_end = end
+            first_duration = max(other.first_end - other.first_ts, 1e-6)
+            self.closed_duration += max(end - self.interval_start, 1e-6) + other.closed_duration - first_duration
+            self.interval_start = other.interval_start
+            self.last_ts = other.last_ts
+        self.packets += other.packets
+        self.bytes += other.bytes
+        self.fwd.merge(other.fwd)
+        self.bck.merge(other.bck)
 
-    def aggregate_and_store(self):
+    def active_duration(self):
+        return self.closed_duration + max(self.last_ts - self.interval_start, 1e-6)
+
+    def features(self):
+        """Вектор из 11 признаков окна за O(1); None, если пакетов не было"""
         if not self.packets:
             return None
+        duration = self.active_duration()
+        fwd, bck = self.fwd, self.bck
+        return [
+            self.bytes / duration,
+            self.packets / duration,
+            fwd.max_size,
+            fwd.avg_size(),
+            bck.max_size,
+            bck.avg_size(),
+            fwd.iat_std(),
+            fwd.min_iat(),
+            bck.iat_std(),
+            bck.min_iat(),
+            self.packets  # Добавляем packet_count
+        ]
 
-        intervals = self._split_into_intervals()
 
-        total_active_duration = sum(
-            max(interval[-1][1] - interval[0][1], 1e-6)
-            for interval in intervals
-        )
+class FeatureRing:
+    """Кольцо последних векторов признаков фиксированного размера.
 
-        total_bytes = sum(len(p) for p, _ in self.packets)
-        total_packets = len(self.packets)
+    Каждая строка пишется дважды (pos и pos + capacity), поэтому последние k строк
+    всегда лежат подряд и latest(k) возвращает срез без копирования.
+    """
+    __slots__ = ('data', 'capacity', 'pos', 'count')
 
-        fl_byt_s = total_bytes / total_active_duration
-        fl_pck_s = total_packets / total_active_duration
+    def __init__(self, capacity, dim, dtype=np.float64):
+        self.data = np.zeros((2 * capacity, dim), dtype=dtype)
+        self.capacity = capacity
+        self.pos = capacity - 1
+        self.count = 0
 
-        fwd_packets = [p for p, _ in self.packets if p[IP].src == self.ip]
-        bck_packets = [p for p, _ in self.packets if p[IP].dst == self.ip]
+    def __len__(self):
+        return self.count
 
-        fwd_sizes = [len(p) for p in fwd_packets]
-        fwd_max = max(fwd_sizes) if fwd_sizes else 0
-        fwd_avg = np.mean(fwd_sizes) if fwd_sizes else 0
+    def append(self, row):
+        pos = self.pos + 1
+        if pos == self.capacity:
+            pos = 0
+        self.data[pos] = row
+        self.data[pos + self.capacity] = row
+        self.pos = pos
+        if self.count < self.capacity:
+            self.count += 1
 
-        bck_sizes = [len(p) for p in bck_packets]
-        bck_max = max(bck_sizes) if bck_sizes else 0
-        bck_avg = np.mean(bck_sizes) if bck_sizes else 0
+    def latest(self, k=None):
+        """Последние k строк от старой к новой (представление без копирования)"""
+        k = self.count if k is None else min(k, self.count)
+        end = self.pos + self.capacity + 1
+        return self.data[end - k:end]
 
-        fwd_timestamps = [t for p, t in self.packets if p[IP].src == self.ip]
-        bck_timestamps = [t for p, t in self.packets if p[IP].dst == self.ip]
 
-        fwd_iat = np.diff(fwd_timestamps) if len(fwd_timestamps) > 1 else []
-        bck_iat = np.diff(bck_timestamps) if len(bck_timestamps) > 1 else []
+class HostTable:
+    """Записи по IP с забыванием простаивающих (TTL) и вытеснением давних сверх лимита (LRU).
 
-        features = [
-            fl_byt_s,
-            fl_pck_s,
-            fwd_max,
-            fwd_avg,
-            bck_max,
-            bck_avg,
-            np.std(fwd_iat) if len(fwd_iat) > 0 else 0,
-            np.min(fwd_iat) if len(fwd_iat) > 0 else 0,
-            np.std(bck_iat) if len(bck_iat) > 0 else 0,
-            np.min(bck_iat) if len(bck_iat) > 0 else 0,
-            total_packets  # Добавляем packet_count
-        ]
+    OrderedDict хранит записи в порядке последнего обращения, поэтому в начале всегда
+    самые давние: и истечение TTL, и вытеснение сверх max_entries снимают записи с начала
+    за O(1) на запись, не перебирая остальные. table[ip] создаёт запись через factory,
+    как defaultdict.
+    """
+    __slots__ = ('factory', 'ttl', 'max_entries', 'entries', 'clock', 'evicted')
+
+    def __init__(self, factory, ttl=None, max_entries=None, clock=time.monotonic):
+        self.factory = factory
+        self.ttl = ttl if ttl is not None else float(os.getenv('HOST_TTL_SECONDS', HOST_TTL))
+        self.max_entries = max_entries if max_entries is not None else int(os.getenv('MAX_HOSTS', MAX_HOSTS))
+        self.clock = clock
+        self.entries = OrderedDict()  # ip -> [время последнего обращения, запись]
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, ip):
+        return ip in self.entries
+
+    def __getitem__(self, ip):
+        return self.get(ip)
+
+    def get(self, ip, now=None):
+        """Запись IP (новая, если её нет) с отметкой обращения"""
+        now = self.clock() if now is None else now
+        entry = self.entries.get(ip)
+        if entry is None:
+            entry = self.entries[ip] = [now, self.factory()]
+            if len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evicted += 1
+        else:
+            entry[0] = now
+            self.entries.move_to_end(ip)
+        return entry[1]
+
+    def expire(self, now=None):
+        """Удалить записи без обращений дольше ttl; возвращает их число"""
+        now = self.clock() if now is None else now
+        deadline = now - self.ttl
+        expired = 0
+        entries = self.entries
+        while entries:
+            ip, (last_seen, _) = next(iter(entries.items()))
+            if last_seen > deadline:
+                break
+            del entries[ip]
+            expired += 1
+        self.evicted += expired
+        return expired
+
+    def items(self):
+        return ((ip, entry[1]) for ip, entry in self.entries.items())
+
+
+class SequenceStore:
+    """Последние векторы признаков по IP в кольцах FeatureRing для оценки последовательностей.
+
+    Кольца хранятся в HostTable: IP без новых окон дольше TTL забываются при следующей пачке.
+    """
+
+    def __init__(self, window, dim, dtype=np.float32, ttl=None, max_entries=None):
+        self.window = window
+        self.dim = dim
+        self.dtype = dtype
+        self.rings = HostTable(self._new_ring, ttl, max_entries)
+
+    def _new_ring(self):
+        return FeatureRing(self.window, self.dim, self.dtype)
+
+    def __len__(self):
+        return len(self.rings)
+
+    def extend(self, ips, rows):
+        """Добавить строки пачки в кольца своих IP
+
+        Возвращает индексы строк, для которых у IP набралось полное окно, и сами окна
+        формы (n, window, dim), собранные из представлений колец одной копией.
+        """
+        scored, views, chunks, seen = [], [], [], set()
+        now = self.rings.clock()
+        self.rings.expire(now)
+        for i, ip in enumerate(ips):
+            ring = self.rings.get(ip, now)
+            if ip in seen:
+                # Повтор IP в пачке затрёт строки уже взятого окна - копируем накопленные окна сейчас
+                chunks.append(np.stack(views))
+                views = []
+                seen.clear()
+            ring.append(rows[i])
+            if ring.count == self.window:
+                views.append(ring.latest())
+                scored.append(i)
+                seen.add(ip)
+        if views:
+            chunks.append(np.stack(views))
+        if not chunks:
+            return np.empty(0, dtype=np.intp), np.empty((0, self.window, self.dim), dtype=self.dtype)
+        windows = chunks[0] if len(chunks) == 1 else np.concatenate(chunks)
+        return np.array(scored, dtype=np.intp), windows
+
+
+class TrafficStats:
+    """История признаков одного IP; окна накапливаются в ShardedStatsTable."""
+    __slots__ = ('start_time', 'history', 'max_history', 'ip')
+
+    def __init__(self, max_history=10, ip=None):
+        self.start_time = time.time()
+        self.history = FeatureRing(max_history, 11)
+        self.max_history = max_history
+        self.ip = ip
+
+    def set_ip(self, ip):
+        self.ip = ip
+
+    def aggregate_and_store(self, window):
+        """Признаки закрытого окна с сохранением в историю"""
+        features = window.features()
+        if features is None:
+            return None
 
         self.history.append(features)
-        if len(self.history) > self.max_history:
-            self.history.pop(0)
-        self.reset_packets()
+        self.start_time = time.time()
         return features
 
-__all__ = ['TrafficStats']
\ No newline at end of file
+__all__ = ['TrafficStats', 'WindowAccumulator', 'DirectionStats', 'FeatureRing', 'SequenceStore', 'HostTable',
+           'HOST_TTL', 'MAX_HOSTS']
@@ -0,0 +1,140 @@
+# Инкрементальная загрузка обучающих данных с сервера менеджера и локальный кэш
+#
+# Агент помнит последний полученный id (high-water mark) и запрашивает только новые строки
+# через /pgadmin/anomalies/export. Диапазон новых id делится на части, которые загружаются
+# параллельно с ограничением числа одновременных запросов.
+
+import asyncio
+import json
+import os
+import random
+import numpy as np
+from logger_config import service_logger
+
+TRAIN_FEATURES = ['fl_byt_s', 'fl_pck_s', 'fwd_max_pack_size', 'fwd_avg_packet',
+                  'bck_max_pack_size', 'bck_avg_packet', 'fw_iat_std', 'fw_iat_min',
+                  'bck_iat_std', 'bck_iat_min']
+
+CACHE_DIR = 'saved_ml/train_cache'
+PAGE_SIZE = 5000            # Строк в одном запросе
+RANGE_SIZE = 50_000         # Ширина диапазона id на одну параллельную задачу
+FETCH_CONCURRENCY = 4       # Одновременных запросов к серверу
+MAX_CACHED_ROWS = 1_000_000  # Сколько последних строк хранить для обучения
+REQUEST_TIMEOUT = 60
+MAX_RETRIES = 3
+
+
+class TrainingDataFetcher:
+    """Загрузка новых строк traffic_with_anomalies по id и накопление их в локальном кэше.
+
+    update() возвращает матрицу признаков всех накопленных строк в порядке id. Если часть
+    диапазонов не загрузилась, high-water mark сдвигается только до первого пропуска,
+    и недостающие строки будут запрошены при следующем обновлении.
+    """
+
+    def __init__(self, base_url, cache_dir=CACHE_DIR, page_size=PAGE_SIZE, range_size=RANGE_SIZE,
+                 concurrency=FETCH_CONCURRENCY, max_rows=MAX_CACHED_ROWS):
+        self.base_url = base_url.rstrip('/')
+        self.cache_dir = cache_dir
+        self.page_size = page_size
+        self.range_size = range_size
+        self.concurrency = concurrency
+        self.max_rows = max_rows
+        self.cache_path = os.path.join(cache_dir, 'rows.npz')
+        self.state_path = os.path.join(cache_dir, 'state.json')
+
+    @property
+    def high_water_mark(self):
+        try:
+            with open(self.state_path, encoding='utf-8') as f:
+                return int(json.load(f)['last_id'])
+        except (FileNotFoundError, KeyError, ValueError):
+            return 0
+
+    def load(self):
+        """(ids, X) из кэша; пустые массивы, если кэша нет"""
+        if not os.path.exists(self.cache_path):
+            return np.empty(0, dtype=np.int64), np.empty((0, len(TRAIN_FEATURES)), dtype=np.float64)
+        with np.load(self.cache_path) as data:
+            return data['ids'], data['X']
+
+    def _save(self, ids, X, last_id):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # Сначала данные, затем отметка: при сбое между ними строки просто запросятся повторно
+        tmp_path = self.cache_path + '.tmp.npz'
+        np.savez(tmp_path, ids=ids, X=X)
+        os.replace(tmp_path, self.cache_path)
+        tmp_path = self.state_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'last_id': last_id}, f)
+        os.replace(tmp_path, self.state_path)
+
+    async def _get_json(self, session, path, params):
+        import aiohttp
+        url = f"{self.base_url}{path}"
+        for attempt in range(MAX_RETRIES):
+            try:
+                async with session.get(url, params=params) as response:
+                    if response.status == 200:
+                        return await response.json()
+                    service_logger.warning(f"Ошибка получения данных {url}: {response.status} - {await response.text()}")
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                service_logger.warning(f"Не удалось получить данные {url}: {e}")
+            await asyncio.sleep(min(2 ** attempt, 10) * random.uniform(0.5, 1.0))
+        raise ConnectionError(f"Сервер не вернул {url} после {MAX_RETRIES} попыток")
+
+    async def _fetch_range(self, session, semaphore, after_id, before_id):
+        """Строки after_id < id <= before_id постранично по ключу id"""
+        rows = []
+        while True:
+            async with semaphore:
+                page = await self._get_json(session, '', {
+                    'after_id': after_id, 'before_id': before_id, 'limit': self.page_size})
+            rows.extend(page['data'])
+            if page.get('nextAfterId') is None:
+                return rows
+            after_id = page['nextAfterId']
+
+    async def fetch_new(self, after_id):
+        """Новые строки после after_id: список частей (конец диапазона, строки или исключение)"""
+        import aiohttp
+        timeout = aiohttp.ClientTimeout(total=REQUEST_TIMEOUT)
+        async with aiohttp.ClientSession(timeout=timeout) as session:
+            bounds = await self._get_json(session, '/bounds', {'after_id': after_id})
+            if not bounds['count']:
+                return []
+            start, max_id = bounds['minId'] - 1, bounds['maxId']
+            service_logger.info(f"Новых записей на сервере: {bounds['count']} (id {bounds['minId']}..{max_id})")
+            ranges = [(lo, min(lo + self.range_size, max_id)) for lo in range(start, max_id, self.range_size)]
+            semaphore = asyncio.Semaphore(self.concurrency)
+            results = await asyncio.gather(
+                *(self._fetch_range(session, semaphore, lo, hi) for lo, hi in ranges),
+                return_exceptions=True)
+        return [(hi, result) for (_, hi), result in zip(ranges, results)]
+
+    def update(self):
+        """Дозагрузить новые строки в кэш и вернуть матрицу признаков всех накопленных строк"""
+        ids, X = self.load()
+        last_id = self.high_water_mark
+        parts = asyncio.run(self.fetch_new(last_id))
+
+        new_rows = []
+        for range_end, result in parts:
+            if isinstance(result, BaseException):
+                service_logger.warning(f"Диапазон до id {range_end} не загружен: {result}")
+                break
+            new_rows.extend(result)
+            last_id = range_end
+        if new_rows:
+            new_ids = np.fromiter((row['id'] for row in new_rows), dtype=np.int64, count=len(new_rows))
+            new_X = np.array([[np.nan if row.get(name) is None else row[name] for name in TRAIN_FEATURES]
+                              for row in new_rows], dtype=np.float64)
+            ids = np.concatenate((ids, new_ids))[-self.max_rows:]
+            X = np.concatenate((X, new_X))[-self.max_rows:]
+        if new_rows or last_id != self.high_water_mark:
+            self._save(ids, X, last_id)
+        service_logger.info(f"Обучающие данные: получено {len(new_rows)} новых записей, в кэше {len(ids)}")
+        return X
+
+
+__all__ = ['TrainingDataFetcher', 'TRAIN_FEATURES']
@@ -0,0 +1,258 @@
+# Фоновая отправка результатов на сервер менеджера с повторами и локальной очередью на диске
+
+import asyncio
+import json
+import os
+import random
+import threading
+import time
+from logger_config import service_logger
+import metrics
+
+SPOOL_PATH = 'spool/anomalies.ndjson'
+MAX_IN_FLIGHT = 4           # Одновременных запросов к серверу
+MAX_PENDING = 256           # Пачек в очереди, дальше - сразу на диск
+POOL_SIZE = 8               # Соединений keep-alive в пуле
+REQUEST_TIMEOUT = 10
+MAX_RETRIES = 4
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30
+SPOOL_REPLAY_INTERVAL = 30  # Как часто пробовать отправить накопленное на диске
+SPOOL_CHUNK = 500           # Записей в одном запросе при досылке
+
+
+class AnomalyUploader:
+    """Отправка пачек результатов из своего потока с asyncio-циклом.
+
+    submit() не блокирует вызывающий поток. Запросы идут через одну долгоживущую
+    aiohttp-сессию с пулом соединений, число одновременных запросов ограничено.
+    Пачки, которые не удалось отправить после повторов с экспоненциальной задержкой,
+    дописываются в NDJSON-файл и досылаются крупными частями, когда сервер снова доступен.
+    """
+
+    def __init__(self, url, spool_path=SPOOL_PATH, max_in_flight=MAX_IN_FLIGHT, max_pending=MAX_PENDING,
+                 pool_size=POOL_SIZE, timeout=REQUEST_TIMEOUT, max_retries=MAX_RETRIES):
+        self.url = url
+        self.spool_path = spool_path
+        self.max_in_flight = max_in_flight
+        self.max_pending = max_pending
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.loop = None
+        self.thread = None
+        self.session = None
+        self.queue = None
+        self.in_flight = None
+        self.ready = threading.Event()
+        self.replaying = False
+        self.stopping = False
+        self.dispatcher = None
+        self.spool_lock = threading.Lock()  # После остановки submit пишет в файл из своего потока
+        self.drain_timeout = None
+        self.sent_records = 0
+        self.spooled_records = 0
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, daemon=True, name="UploadThread")
+        self.thread.start()
+        self.ready.wait()
+        return self
+
+    def _run(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self._main())
+        self.loop.close()
+
+    async def _main(self):
+        # aiohttp загружается уже в потоке отправки, не задерживая запуск агента
+        import aiohttp
+        self.queue = asyncio.Queue()
+        self.in_flight = asyncio.Semaphore(self.max_in_flight)
+        connector = aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=60)
+        async with aiohttp.ClientSession(connector=connector,
+                                         timeout=aiohttp.ClientTimeout(total=self.timeout)) as session:
+            self.session = session
+            self.ready.set()
+            replay_task = asyncio.ensure_future(self._replay_periodically())
+            tasks = set()
+            self.dispatcher = asyncio.ensure_future(self._dispatch(tasks))
+            try:
+                await self.dispatcher
+            except asyncio.CancelledError:
+                pass
+            replay_task.cancel()
+            # Пачки, не дошедшие до отправки, - сразу на диск
+            pending = []
+            while not self.queue.empty():
+                pending.extend(self.queue.get_nowait())
+            if pending:
+                self._spool(pending)
+            if tasks:
+                # Отправляемые и ждущие повтора пачки получают drain_timeout, затем
+                # отменяются и сохраняются на диск в _deliver
+                _, unfinished = await asyncio.wait(tasks, timeout=self.drain_timeout)
+                for task in unfinished:
+                    task.cancel()
+            current = asyncio.current_task()
+            others = [task for task in asyncio.all_tasks() if task is not current]
+            for task in others:
+                task.cancel()
+            await asyncio.gather(*others, return_exceptions=True)
+
+    async def _dispatch(self, tasks):
+        while True:
+            batch = await self.queue.get()
+            try:
+                await self.in_flight.acquire()
+            except asyncio.CancelledError:
+                self._spool(batch)
+                raise
+            task = asyncio.ensure_future(self._deliver(batch))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+    def submit(self, results):
+        """Поставить пачку в очередь на отправку (потокобезопасно, без ожидания)"""
+        if not results:
+            return
+        if not self.stopping and not self.loop.is_closed():
+            try:
+                self.loop.call_soon_threadsafe(self._enqueue, results)
+                return
+            except RuntimeError:
+                # Цикл закрылся между проверкой и вызовом
+                pass
+        # Отправка остановлена: пачка сразу на диск
+        self._spool(results)
+
+    def _enqueue(self, results):
+        if self.stopping:
+            self._spool(results)
+        elif self.queue.qsize() >= self.max_pending:
+            service_logger.warning(f"Очередь отправки заполнена, {len(results)} записей сохранены на диск")
+            self._spool(results)
+        else:
+            self.queue.put_nowait(results)
+
+    def stop(self, timeout=15):
+        """Дождаться отправки до timeout секунд; всё неотправленное сохраняется на диск до возврата"""
+        if self.loop is None or not self.thread.is_alive():
+            return
+        self.drain_timeout = timeout
+        self.stopping = True
+        self.loop.call_soon_threadsafe(self._shutdown)
+        self.thread.join()
+
+    def _shutdown(self):
+        self.stopping = True
+        self.dispatcher.cancel()
+
+    async def _post(self, records):
+        import aiohttp
+        started = time.perf_counter()
+        try:
+            async with self.session.post(self.url, data=json.dumps(records, default=str),
+                                         headers={'Content-Type': 'application/json'}) as response:
+                if response.status == 200:
+                    metrics.UPLOAD_SECONDS.observe(time.perf_counter() - started)
+                    metrics.UPLOADED_RECORDS.inc(len(records))
+                    return True
+                service_logger.warning(f"Ошибка при отправке данных на сервер: {response.status} - {await response.text()}")
+        except asyncio.TimeoutError:
+            service_logger.error(f"Тайм-аут при отправке данных на сервер: {self.url}")
+        except aiohttp.ClientError as e:
+            service_logger.error(f"Не удалось отправить данные на сервер: {e}")
+        metrics.UPLOAD_SECONDS.observe(time.perf_counter() - started)
+        metrics.UPLOAD_FAILURES.inc()
+        return False
+
+    async def _deliver(self, results):
+        try:
+            for attempt in range(self.max_retries):
+                if await self._post(results):
+                    self.sent_records += len(results)
+                    service_logger.info(f"Отправлено {len(results)} записей на сервер")
+                    asyncio.ensure_future(self._replay_spool())
+                    return
+                delay = min(BACKOFF_BASE * 2 ** attempt, BACKOFF_MAX) * random.uniform(0.5, 1.0)
+                await asyncio.sleep(delay)
+            service_logger.warning(f"Сервер недоступен, {len(results)} записей сохранены на диск")
+            self._spool(results)
+        except asyncio.CancelledError:
+            service_logger.warning(f"Отправка прервана при остановке, {len(results)} записей сохранены на диск")
+            self._spool(results)
+            raise
+        finally:
+            self.in_flight.release()
+
+    def _spool(self, results):
+        """Дописать новую пачку в файл очереди"""
+        with self.spool_lock:
+            self._write_spool(results)
+            self.spooled_records += len(results)
+        metrics.SPOOLED_RECORDS.inc(len(results))
+
+    def _write_spool(self, records):
+        """Дописать записи в файл очереди без учёта в счётчиках (возврат при досылке)"""
+        os.makedirs(os.path.dirname(self.spool_path) or '.', exist_ok=True)
+        with open(self.spool_path, 'a', encoding='utf-8') as f:
+            for record in records:
+                f.write(json.dumps(record, default=str, ensure_ascii=False))
+                f.write('\n')
+
+    @staticmethod
+    def _read_spool(path):
+        with open(path, encoding='utf-8') as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    async def _replay_periodically(self):
+        while True:
+            await asyncio.sleep(SPOOL_REPLAY_INTERVAL)
+            await self._replay_spool()
+
+    async def _replay_spool(self):
+        """Дослать накопленные записи частями по SPOOL_CHUNK; неотправленное вернуть в файл"""
+        replay_path = self.spool_path + '.replay'
+        if self.replaying or not (os.path.exists(self.spool_path) or os.path.exists(replay_path)):
+            return
+        self.replaying = True
+        records, sent = [], 0
+        try:
+            # Остаток прерванной досылки читается первым, чтобы не затереть его
+            if os.path.exists(replay_path):
+                records.extend(self._read_spool(replay_path))
+            with self.spool_lock:
+                if os.path.exists(self.spool_path):
+                    # Новые неудачные пачки пишутся в свежий файл, пока идёт досылка
+                    os.replace(self.spool_path, replay_path)
+                    records.extend(self._read_spool(replay_path))
+            for start in range(0, len(records), SPOOL_CHUNK):
+                chunk = records[start:start + SPOOL_CHUNK]
+                if not await self._post(chunk):
+                    break
+                sent += len(chunk)
+            self._finish_replay(replay_path, records, sent)
+            if sent:
+                service_logger.info(f"Дослано {sent} записей из локальной очереди, осталось {len(records) - sent}")
+        except asyncio.CancelledError:
+            # Остановка посреди досылки: уже отправленные части не должны уйти повторно
+            if os.path.exists(replay_path):
+                self._finish_replay(replay_path, records, sent)
+            raise
+        except Exception as e:
+            service_logger.error(f"Ошибка досылки локальной очереди: {e}", exc_info=True)
+        finally:
+            self.replaying = False
+
+    def _finish_replay(self, replay_path, records, sent):
+        """Вернуть неотправленный остаток в файл очереди и удалить файл досылки"""
+        if sent < len(records):
+            # Записи уже учтены при первом сохранении
+            with self.spool_lock:
+                self._write_spool(records[sent:])
+        os.remove(replay_path)
+        self.sent_records += sent
+
+__all__ = ['AnomalyUploader']
@@ -0,0 +1,131 @@
+# Окна анализа, выровненные по часам, и окна нескольких разрешений из одного потока пакетов
+
+import math
+import os
+import time
+import numpy as np
+from logger_config import service_logger
+from traffic_stats import WindowAccumulator
+from packet_processor import FEATURE_NAMES
+from shm_ring import ip_to_int
+import metrics
+
+WINDOW_RESOLUTIONS = '5,60'  # Секунд; каждое разрешение кратно предыдущему, окна моделей - INTERVAL_SECONDS
+WINDOW_GRACE = 0             # Задержка закрытия окна после границы, секунд
+WINDOW_STORE_DIR = 'window_store'
+
+# Окна разрешений, кроме окна моделей: по каталогу window_store/<секунды>s на разрешение
+WINDOW_COLUMNS = [('ip', np.uint32), ('timestamp', np.float64)] + [(name, np.float64) for name in FEATURE_NAMES]
+
+
+def parse_resolutions(text, interval):
+    """Разрешения в секундах по возрастанию; interval (окно моделей) добавляется, если его нет"""
+    values = {float(item) for item in str(text).replace(';', ',').split(',') if item.strip()}
+    values.add(float(interval))
+    resolutions = sorted(values)
+    for smaller, larger in zip(resolutions, resolutions[1:]):
+        factor = larger / smaller
+        if abs(factor - round(factor)) > 1e-9:
+            raise ValueError(f"Разрешение окна {larger:g} с не кратно {smaller:g} с")
+    return resolutions
+
+
+class WindowScheduler:
+    """Границы окон, кратные interval от начала эпохи, по часам захвата (time.time).
+
+    Следующая граница отсчитывается от предыдущей, а не от конца обработки, поэтому
+    окна не смещаются и не зависят от времени расчёта. Метка окна - его граница.
+    Если обработка отстала на целые интервалы, пропущенные границы не закрываются
+    отдельно: пакеты попадают в следующее окно, пропуски считаются в метриках.
+    Границы только растут: если часы переведены назад, ожидается граница после последней
+    закрытой, а окно не закрывается повторно.
+    """
+
+    def __init__(self, interval, grace=None, clock=time.time):
+        self.interval = interval
+        self.grace = grace if grace is not None else float(os.getenv('WINDOW_GRACE', WINDOW_GRACE))
+        self.clock = clock
+        self.last = None
+
+    def next_boundary(self, now):
+        return (math.floor(now / self.interval) + 1) * self.interval
+
+    def wait(self, stop_event):
+        """Ожидание следующей границы; её время в секундах или None при установке stop_event"""
+        now = self.clock() - self.grace
+        boundary = self.next_boundary(now)
+        if self.last is not None:
+            if boundary <= self.last:
+                service_logger.warning(f"Часы переведены назад на {self.last - now:.3f} с, "
+                                       f"следующее окно закроется на прежней сетке")
+                boundary = self.last + self.interval
+            skipped = round((boundary - self.last) / self.interval) - 1
+            if skipped > 0:
+                metrics.WINDOWS_SKIPPED.inc(skipped)
+                service_logger.warning(f"Анализ окон отстал, пропущено границ: {skipped}")
+        # Event.wait отсчитывает монотонное время: если часы идут медленнее, ждём ещё
+        while True:
+            remaining = boundary + self.grace - self.clock()
+            if remaining <= 0:
+                break
+            if stop_event.wait(remaining):
+                return None
+        self.last = boundary
+        return boundary
+
+
+class ResolutionMerger:
+    """Окна нескольких разрешений из окон наименьшего.
+
+    Окна наименьшего разрешения приходят из ShardedStatsTable. Окно каждого следующего
+    уровня - слияние окон предыдущего (WindowAccumulator.merge), пакеты повторно не
+    перебираются. Уровень закрывается, когда граница переходит через кратную его
+    разрешению; первое окно уровня после запуска может быть неполным.
+    """
+
+    def __init__(self, resolutions, interval_gap=0.25):
+        self.resolutions = list(resolutions)
+        self.base = self.resolutions[0]
+        self.factors = [round(resolution / self.base) for resolution in self.resolutions]
+        self.interval_gap = interval_gap
+        self.pending = [{} for _ in self.resolutions[1:]]  # ip -> WindowAccumulator уровня
+        self.last_index = None
+
+    def close(self, closed, boundary):
+        """Окна базового уровня closed, закрытые на boundary -> {разрешение: [(ip, окно)]} закрытых уровней"""
+        index = round(boundary / self.base)
+        previous = index - 1 if self.last_index is None else self.last_index
+        self.last_index = index
+        result = {self.base: closed}
+        windows = closed
+        for level, factor in enumerate(self.factors[1:]):
+            pending = self.pending[level]
+            for ip, window in windows:
+                target = pending.get(ip)
+                if target is None:
+                    target = pending[ip] = WindowAccumulator(self.interval_gap)
+                target.merge(window)
+            if index // factor == previous // factor:
+                # Уровень не закрыт - старшие уровни тем более
+                break
+            windows = list(pending.items())
+            self.pending[level] = {}
+            result[self.resolutions[level + 1]] = windows
+        return result
+
+
+def window_columns(windows, boundary):
+    """Окна [(ip, WindowAccumulator)] -> столбцы WINDOW_COLUMNS для FeatureStore.append"""
+    rows = [(ip, window.features()) for ip, window in windows]
+    rows = [(ip, features) for ip, features in rows if features]
+    columns = {
+        'ip': np.fromiter((ip_to_int(ip) for ip, _ in rows), dtype=np.uint32, count=len(rows)),
+        'timestamp': np.full(len(rows), boundary, dtype=np.float64),
+    }
+    matrix = np.array([features for _, features in rows], dtype=np.float64).reshape(-1, len(FEATURE_NAMES))
+    columns.update({name: matrix[:, n] for n, name in enumerate(FEATURE_NAMES)})
+    return columns
+
+
+__all__ = ['WindowScheduler', 'ResolutionMerger', 'parse_resolutions', 'window_columns', 'WINDOW_COLUMNS',
+           'WINDOW_RESOLUTIONS', 'WINDOW_STORE_DIR']
@@ -258,6 +258,80 @@ app.post('/pgadmin/anomalies', async (req : any, res : any) => {
   }
 });
 
+// Export anomalies by id (keyset pagination, no OFFSET scans)
+const EXPORT_MAX_LIMIT = 10000;
+const EXPORT_COLUMNS = `id, ip, timestamp, fl_byt_s, fl_pck_s, packet_count,
+  fwd_max_pack_size, fwd_avg_packet, bck_max_pack_size, bck_avg_packet,
+  fw_iat_std, fw_iat_min, bck_iat_std, bck_iat_min,
+  anomaly_ae, anomaly_lstm, anomaly_consensus`;
+
+const parseExportRange = (query : any) => {
+  const afterId = query.after_id != null ? parseInt(query.after_id) : 0;
+  const beforeId = query.before_id != null ? parseInt(query.before_id) : null;
+  const limit = Math.min(parseInt(query.limit) || 1000, EXPORT_MAX_LIMIT);
+  if (isNaN(afterId) || (beforeId !== null && isNaN(beforeId)) || limit <= 0) return null;
+  return { afterId, beforeId, limit };
+};
+
+const exportPage = (afterId : number, beforeId : number | null, limit : number) => pool.query(
+  `SELECT ${EXPORT_COLUMNS} FROM traffic_with_anomalies
+   WHERE id > $1 AND ($2::integer IS NULL OR id <= $2)
+   ORDER BY id LIMIT $3`,
+  [afterId, beforeId, limit]
+);
+
+// Id range of rows after after_id, used by agents to split the export into concurrent ranges
+app.get('/pgadmin/anomalies/export/bounds', async (req : any, res : any) => {
+  const afterId = req.query.after_id != null ? parseInt(req.query.after_id) : 0;
+  if (isNaN(afterId)) return res.status(400).json({ success: false, error: 'Invalid after_id' });
+  try {
+    const result = await pool.query(
+      'SELECT MIN(id) AS min_id, MAX(id) AS max_id, COUNT(*) AS count FROM traffic_with_anomalies WHERE id > $1',
+      [afterId]
+    );
+    const row = result.rows[0];
+    res.json({
+      success: true,
+      minId: row.min_id != null ? Number(row.min_id) : null,
+      maxId: row.max_id != null ? Number(row.max_id) : null,
+      count: Number(row.count),
+    });
+  } catch (error) {
+    console.error('Export bounds error:', error);
+    res.status(500).json({ success: false, error: 'Failed to fetch export bounds' });
+  }
+});
+
+// Rows with after_id < id <= before_id ordered by id; format=ndjson streams the whole range
+app.get('/pgadmin/anomalies/export', async (req : any, res : any) => {
+  const range = parseExportRange(req.query);
+  if (!range) return res.status(400).json({ success: false, error: 'Invalid after_id, before_id or limit' });
+  try {
+    if (req.query.format === 'ndjson') {
+      res.setHeader('Content-Type', 'application/x-ndjson');
+      let afterId = range.afterId;
+      for (;;) {
+        const result = await exportPage(afterId, range.beforeId, range.limit);
+        for (const row of result.rows) res.write(JSON.stringify(row) + '\n');
+        if (result.rows.length < range.limit) break;
+        afterId = result.rows[result.rows.length - 1].id;
+      }
+      return res.end();
+    }
+    const result = await exportPage(range.afterId, range.beforeId, range.limit);
+    const lastRow = result.rows[result.rows.length - 1];
+    res.json({
+      success: true,
+      data: result.rows,
+      nextAfterId: result.rows.length === range.limit ? lastRow.id : null,
+    });
+  } catch (error) {
+    console.error('Export anomalies error:', error);
+    if (res.headersSent) return res.end();
+    res.status(500).json({ success: false, error: 'Failed to export anomalies' });
+  }
+});
+
 // Get traffic by user ID
 app.get('/pgadmin/traffic/user/:userId', async (req : any, res : any) => {
   const userId = parseInt(req.params.userId);